@@ -16,24 +16,32 @@ Features:
 """
 
 import csv
+import functools
+import gzip
 import io
 import json
 import logging
+import logging.handlers
+import operator
+import queue
 import os
 import re
 import subprocess
 import tempfile
 import uuid
+import weakref
 import telegram
 import time
 import base64
+import codecs
+import itertools
 import pyotp
 import random
+import signal
 import asyncio
-import traceback
-import sys
+import atexit
+from collections import Counter
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
 from typing import Dict, Optional, Union, Tuple, List, Any
 
 # Import handlers modules with error handling
@@ -58,22 +66,17 @@ except ImportError as e:
     print(f"Could not import card_manager handler: {e}")
     card_manager = None
 
-try:
-    from tabulate import tabulate
-    print("Successfully imported tabulate")
-except ImportError as e:
-    print(f"Could not import tabulate: {e}")
-    # Define a dummy tabulate function
-    def tabulate(data, headers=None, tablefmt="simple"):
-        return str(data)
-
 from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 from cryptography.fernet import Fernet, InvalidToken
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
@@ -82,6 +85,8 @@ from telegram.ext import (
     filters,
 )
 
+import cache
+
 # Import database module with error handling
 try:
     import db
@@ -138,6 +143,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Hand log records to a background thread that owns the real handlers, so console and
+# file writes never block the event loop (skipped if this module is imported again)
+_root_logger = logging.getLogger()
+if not any(isinstance(h, logging.handlers.QueueHandler) for h in _root_logger.handlers):
+    _log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(
+        _log_queue, *_root_logger.handlers, respect_handler_level=True
+    )
+    _root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
 # Environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -146,6 +163,13 @@ FERNET_KEY = os.getenv("FERNET_KEY")
 RECEIPT_CHANNEL_ID = os.getenv("RECEIPT_CHANNEL_ID")
 LOG_SELL_CHID = os.getenv("LOG_SELL_CHID")
 CARD_NUMBER = os.getenv("CARD_NUMBER", "")
+# Telegram chat that receives error alerts (optional)
+ADMIN_ID = os.getenv("ADMIN_ID")
+# Owner accounts (comma separated Telegram ids) that are always admins, without a DB lookup
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit())
+
+# CSV exports stay in memory up to this size, then roll over to a temp file on disk
+CSV_SPOOL_MAX_SIZE = 8 << 20
 
 # Initialize Fernet for encryption/decryption
 if not FERNET_KEY:
@@ -179,19 +203,65 @@ def encrypt(text: Union[str, bytes]) -> bytes:
     return FERNET.encrypt(text)
 
 
+def encrypt_many(values) -> List[bytes]:
+    """Encrypt a batch of values with encrypt(), e.g. one chunk of a CSV import."""
+    return [encrypt(value) for value in values]
+
+
+def _token_bytes(token) -> bytes:
+    """Normalize a stored Fernet token (bytes, memoryview or str) to bytes."""
+    if isinstance(token, memoryview):
+        return token.tobytes()
+    if isinstance(token, str):
+        return token.encode()
+    return token
+
+
 def decrypt_secret(token) -> str:
     """Decrypt Fernet token to plain string, accepting bytes, memoryview or str."""
-    if isinstance(token, memoryview):
-        token = token.tobytes()
-    elif isinstance(token, str):
-        token = token.encode()
     try:
-        return FERNET.decrypt(token).decode()
+        return FERNET.decrypt(_token_bytes(token)).decode()
     except InvalidToken as e:
         logger.error(f"Failed to decrypt: {e}")
         raise ValueError("Failed to decrypt data") from e
 
 
+def decrypt_many(tokens) -> List[str]:
+    """Decrypt a batch of tokens with decrypt_secret(), e.g. one chunk of the CSV export."""
+    return [decrypt_secret(token) for token in tokens]
+
+
+def get_seat_secret(seat_id: int, secret_enc) -> str:
+    """Return the decrypted TOTP secret of a seat, using the short-lived secret cache."""
+    secret = cache.seat_secret_cache.get(seat_id)
+    if secret is None:
+        secret = decrypt_secret(secret_enc)
+        cache.seat_secret_cache.set(seat_id, secret)
+    return secret
+
+
+def get_seat_totp(seat_id: int, secret_enc) -> pyotp.TOTP:
+    """Return a TOTP generator for a seat, reusing the cached one while the seat is unchanged."""
+    totp = cache.seat_totp_cache.get(seat_id)
+    if totp is None:
+        totp = pyotp.TOTP(get_seat_secret(seat_id, secret_enc))
+        cache.seat_totp_cache.set(seat_id, totp)
+    return totp
+
+
+def get_seat_code(seat_id: int, secret_enc) -> str:
+    """Return the current 2FA code of a seat, computing it at most once per TOTP time window."""
+    totp = get_seat_totp(seat_id, secret_enc)
+    window = int(time.time()) // totp.interval
+    cached = cache.seat_code_cache.get(seat_id)
+    if cached is not None and cached[0] == window:
+        return cached[1]
+    
+    code = totp.at(window * totp.interval)
+    cache.seat_code_cache.set(seat_id, (window, code))
+    return code
+
+
 # Keep the old function for backwards compatibility
 def decrypt(token: bytes) -> str:
     """Decrypt bytes using Fernet symmetric encryption (legacy version)."""
@@ -325,24 +395,82 @@ async def send_join_channels_message(update: Update, context: ContextTypes.DEFAU
         )
 
 
-def get_main_menu_keyboard():
-    """Create the main menu inline keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton("⭐️ خرید سرویس", callback_data="buy_service"),
-            InlineKeyboardButton("🔐 مدیریت سرویس", callback_data="manage_service")
-        ],
-        [
-            InlineKeyboardButton("💰 کیف پول", callback_data="wallet"),
-            InlineKeyboardButton("📣 کسب اعتبار  ", callback_data="menu:ref")
-        ],
-        [
-            InlineKeyboardButton("💬 پشتیبانی", url="https://t.me/AccountYarSup")
-        ]
+# Static menu texts, rendered once at import time
+WELCOME_TEXT = (
+    "👤  به ربات \"اکانت یار\" : فروش اکانت قانونی فیلترشکن خوش آمدید 👋\n\n"
+    "✅ سرویس های فعال درحال حاضر:\n"
+    "- اکانت قانونی فیلترشکن پرسرعت ویندسکرایب 🔐\n\n"
+    "از منوی زیر، گزینه مورد نظر خود را انتخاب کنید."
+)
+MEMBERSHIP_CONFIRMED_TEXT = "✅ *عضویت شما تأیید شد!*\n\n" + WELCOME_TEXT
+BACK_TO_MENU_TEXT = (
+    "👤 * به ربات \"اکانت یار\" : فروش اکانت قانونی فیلترشکن خوش آمدید👋*\n\n"
+    "از منوی زیر، گزینه مورد نظر خود را انتخاب کنید."
+)
+ADMIN_PANEL_TEXT = (
+    "💻 *پنل مدیریت*\n\n"
+    "به پنل مدیریت بات خوش آمدید.\n"
+    "لطفا گزینه مورد نظر خود را انتخاب کنید:"
+)
+
+# Order approval / rejection texts, formatted with the order id (and seat details for captions)
+ORDER_APPROVED_TEXT = "✅ سفارش #%d تایید شد."
+ORDER_REJECTED_TEXT = "❌ سفارش #%d رد شد."
+ORDER_APPROVE_ERROR_TEXT = "❌ خطا در تایید سفارش: %s"
+ORDER_REJECT_ERROR_TEXT = "❌ خطا در رد سفارش: %s"
+ORDER_REJECTED_USER_TEXT = (
+    "❌ *سفارش شماره #%d رد شد*\n\n"
+    "✏️ لطفا با پشتیبانی تماس بگیرید یا مجددا تلاش کنید.\n\n"
+    "💬 پشتیبانی: @AccountYarSup"
+)
+RECEIPT_APPROVED_CAPTION = "Order #%d\n\n✅ *تایید شده*\nصندلی: %d (%d/%d)"
+RECEIPT_REJECTED_CAPTION = "Order #%d\n\n❌ *رد شده*"
+MESSAGE_UPDATE_ERROR_TEXT = "خطا در بروزرسانی پیام"
+
+# The main menu never changes, so build it once and reuse it
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("⭐️ خرید سرویس", callback_data="buy_service"),
+        InlineKeyboardButton("🔐 مدیریت سرویس", callback_data="manage_service")
+    ],
+    [
+        InlineKeyboardButton("💰 کیف پول", callback_data="wallet"),
+        InlineKeyboardButton("📣 کسب اعتبار  ", callback_data="menu:ref")
+    ],
+    [
+        InlineKeyboardButton("💬 پشتیبانی", url="https://t.me/AccountYarSup")
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
+
+
+# Static keyboards of the user screens
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")]
+])
+SUBSCRIPTION_OPTIONS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 خرید ویندسکرایب یک‌ماهه", callback_data="buy:1mo")],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")]
+])
+PURCHASE_INFO_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 بازگشت به انتخاب پلن", callback_data="buy_service")]
+])
+
+
+def get_main_menu_keyboard():
+    """Return the main menu inline keyboard."""
+    return MAIN_MENU_MARKUP
 
 
+async def reply(update: Update, text: str, **kwargs):
+    """Edit the message of a callback query, or reply to the user's message, through the outbox."""
+    if update.callback_query:
+        send = update.callback_query.edit_message_text
+    else:
+        send = update.effective_message.reply_text
+    return await outbox.send(send, text, **kwargs)
+
+
+@functools.lru_cache(maxsize=4096)
 def get_admin_approval_keyboard(order_id):
     """Create admin approval keyboard for receipts."""
     keyboard = [
@@ -354,16 +482,6 @@ def get_admin_approval_keyboard(order_id):
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_2fa_button(seat_id):
-    """Create 2FA button for approved orders."""
-    keyboard = [
-        [
-            InlineKeyboardButton("📲 دریافت کد دومرحله ای", callback_data=f"2fa:{seat_id}")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-
 def get_setup_2fa_button(order_id):
     """Create setup 2FA button for approved orders."""
     keyboard = [
@@ -384,88 +502,142 @@ def get_code_2fa_button(order_id):
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_code_2fa_retry_button(order_id):
-    """Create retry 2FA button for second code generation."""
-    keyboard = [
-        [
-            InlineKeyboardButton("📲 دریافت مجدد کد", callback_data=f"code:{order_id}")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def _db_create_or_get_user(tg_id: int, first_name: str, username: Optional[str]) -> int:
+    """Return the internal user id for a Telegram user, creating the user and wallet if needed."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Upsert the user and create the wallet for new users in a single round-trip
+            # (xmax = 0 only for freshly inserted rows)
+            db.execute_prepared(cur, "upsert_user", (tg_id, first_name, username))
+            user_id, created = cur.fetchone()
+            conn.commit()
+            
+            if created:
+                logger.info(f"Created new user: {first_name} (ID: {user_id})")
+            return user_id
+
+
+# Per-user locks, dropped automatically once no handler holds them
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def get_user_lock(tg_id: int) -> asyncio.Lock:
+    """Return the lock guarding per-user state of a Telegram user."""
+    lock = _user_locks.get(tg_id)
+    if lock is None:
+        lock = _user_locks[tg_id] = asyncio.Lock()
+    return lock
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates of different users concurrently, but one at a time per user.
+    
+    Handlers keep per-user state in context.user_data and the admin ConversationHandler,
+    so a double-tapped button and a following text reply must not run side by side.
+    Updates without a user (e.g. channel posts) fall back to their chat.
+    """
+    
+    async def do_process_update(self, update, coroutine) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        
+        if key is None:
+            await coroutine
+            return
+        
+        async with get_user_lock(key):
+            await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
 
 
 async def create_or_get_user(user):
     """Create a user record if it doesn't exist, or return existing user."""
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Check if user exists
-                cur.execute("SELECT id FROM users WHERE tg_id = %s", (user.id,))
-                result = cur.fetchone()
-                
-                if result:
-                    # User exists, return user_id
-                    return result[0]
-                else:
-                    # Create new user
-                    cur.execute(
-                        "INSERT INTO users (tg_id, first_name, username) VALUES (%s, %s, %s) RETURNING id",
-                        (user.id, user.first_name, user.username)
-                    )
-                    user_id = cur.fetchone()[0]
-                    
-                    # Create wallet for the new user
-                    cur.execute(
-                        "INSERT INTO wallets (user_id) VALUES (%s)",
-                        (user_id,)
-                    )
-                    conn.commit()
-                    logger.info(f"Created new user: {user.first_name} (ID: {user_id})")
-                    return user_id
+        return await asyncio.to_thread(_db_create_or_get_user, user.id, user.first_name, user.username)
     except Exception as e:
         logger.error(f"Error creating/getting user: {e}")
         raise
 
 
+def _db_set_referrer(tg_id: int, ref_tg_id: int) -> bool:
+    """Set the referrer of a user if they don't have one yet. Returns True if it was set."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Resolve the referrer and set it only when the user has none, in one statement
+            cur.execute(
+                "UPDATE users SET referrer = r.id FROM users r "
+                "WHERE r.tg_id = %(ref)s AND users.tg_id = %(uid)s AND users.referrer IS NULL",
+                {"ref": ref_tg_id, "uid": tg_id}
+            )
+            updated = cur.rowcount == 1
+            conn.commit()
+            return updated
+
+
+# UTM starts are counted in memory and written to the database in batches
+UTM_FLUSH_INTERVAL = 5  # seconds
+_utm_start_buffer: Counter = Counter()
+
+
+async def flush_utm_starts() -> None:
+    """Write the buffered UTM start counts to the database."""
+    if not _utm_start_buffer:
+        return
+    
+    # Swap the buffer out before awaiting so new starts go into a fresh counter
+    counts = list(_utm_start_buffer.items())
+    _utm_start_buffer.clear()
+    
+    if not await asyncio.to_thread(db.add_utm_starts, counts):
+        # Keep the counts for the next flush
+        _utm_start_buffer.update(dict(counts))
+
+
+async def utm_flush_loop() -> None:
+    """Periodically flush buffered UTM start counts."""
+    while True:
+        await asyncio.sleep(UTM_FLUSH_INTERVAL)
+        try:
+            await flush_utm_starts()
+        except Exception as e:
+            logger.error(f"Error flushing UTM starts: {e}")
+
+
+# Deep-link parameter of the /start command (referral or UTM keyword)
+_START_RE = re.compile(r"/start\s+(\w+)")
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /start command, create user, process UTM, and handle referrals."""
     user = update.effective_user
     
     # Check for UTM parameters or referrals in the start command
+    # (a bare /start - the common case - carries no parameter to look for)
     message_text = update.message.text if update.message else ""
-    match = re.search(r"\/start\s+(\w+)", message_text)
+    match = None if message_text == "/start" else _START_RE.search(message_text)
     
     if match:
         param = match.group(1)
-        
+    
         # Handle referral link
         if param.startswith('ref'):
             try:
                 ref_id = int(param[3:])  # Extract referrer id from 'ref12345'
-                
+            
                 # Check if this is a valid user id and not self-referral
                 if ref_id != user.id:
-                    with db.get_conn() as conn:
-                        with conn.cursor() as cur:
-                            # Check if referrer exists
-                            cur.execute("SELECT id FROM users WHERE tg_id = %s", (ref_id,))
-                            referrer_result = cur.fetchone()
-                            
-                            if referrer_result:
-                                referrer_id = referrer_result[0]
-                                
-                                # Check if user already has a referrer
-                                cur.execute("SELECT referrer FROM users WHERE tg_id = %s", (user.id,))
-                                user_result = cur.fetchone()
-                                
-                                if user_result and user_result[0] is None:
-                                    # Set referrer if user doesn't have one
-                                    cur.execute(
-                                        "UPDATE users SET referrer = %s WHERE tg_id = %s", 
-                                        (referrer_id, user.id)
-                                    )
-                                    conn.commit()
-                                    logger.info(f"User {user.id} set referrer to {ref_id}")
+                    if await asyncio.to_thread(_db_set_referrer, user.id, ref_id):
+                        logger.info(f"User {user.id} set referrer to {ref_id}")
             except Exception as e:
                 logger.error(f"Error processing referral: {e}")
         else:
@@ -473,19 +645,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             utm = param
             context.user_data['utm'] = utm
             logger.info(f"User {user.id} started with UTM: {utm}")
-            
-            # Record UTM start in stats
-            try:
-                with db.get_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO utm_stats (keyword, starts) VALUES (%s, 1) "
-                            "ON CONFLICT (keyword) DO UPDATE SET starts = utm_stats.starts + 1",
-                            (utm,)
-                        )
-                        conn.commit()
-            except Exception as e:
-                logger.error(f"Error recording UTM start: {e}")
+        
+            # Record UTM start in stats (flushed by utm_flush_loop)
+            _utm_start_buffer[utm] += 1
     
     # Create user record if it doesn't exist
     await create_or_get_user(user)
@@ -497,11 +659,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Send welcome message with main menu
-    await update.message.reply_text(
-        f"👤  به ربات \"اکانت یار\" : فروش اکانت قانونی فیلترشکن خوش آمدید 👋\n\n"
-        f"✅ سرویس های فعال درحال حاضر:\n"
-        f"- اکانت قانونی فیلترشکن پرسرعت ویندسکرایب 🔐\n\n"
-        f"از منوی زیر، گزینه مورد نظر خود را انتخاب کنید.",
+    await outbox.send(
+        update.message.reply_text,
+        WELCOME_TEXT,
         reply_markup=get_main_menu_keyboard(),
         parse_mode="Markdown"
     )
@@ -512,50 +672,67 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await start(update, context)
 
 
+def _db_is_admin(user_id: int) -> bool:
+    """Read the admin flag of a user from the database."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, "is_admin", (user_id,))
+            result = cur.fetchone()
+            return result is not None and bool(result[0])
+
+
 async def check_admin(user_id: int) -> bool:
     """Check if a user is an admin."""
+    if user_id in ADMIN_IDS:
+        return True
+    
+    cached = cache.admin_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT is_admin FROM users WHERE tg_id = %s", (user_id,))
-                result = cur.fetchone()
-                return result is not None and result[0]
+        is_admin = await asyncio.to_thread(_db_is_admin, user_id)
+        cache.admin_cache.set(user_id, is_admin)
+        return is_admin
     except Exception as e:
         logger.error(f"Error checking admin status: {e}")
         return False
 
 
-def get_admin_keyboard():
-    """Create admin panel keyboard."""
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 آمار", callback_data="admin:stats"),
-            InlineKeyboardButton("📢 ارسال گروهی", callback_data="admin:broadcast")
-        ],
-        [
-            InlineKeyboardButton("➕ افزودن صندلی", callback_data="admin:addseat"),
-            InlineKeyboardButton("📑 لیست اکانت‌ها", callback_data="admin:listcsv")
-        ],
-        [
-            InlineKeyboardButton("🗂️ مدیریت اکانت‌ها", callback_data="admin:list"),
-            InlineKeyboardButton("💵 تغییر قیمت", callback_data="admin:price")
-        ],
-        [
-            InlineKeyboardButton("💱 تغییر نرخ دلار", callback_data="admin:usd")
-        ],
-        [
-            InlineKeyboardButton("💳 مدیریت کارت‌ها", callback_data="admin:cards"),
-            InlineKeyboardButton("📅 CSV گروهی", callback_data="admin:bulkcsv")
-        ],
-        [
-            InlineKeyboardButton("📉 آمار UTM", callback_data="admin:utm"),
-            InlineKeyboardButton("📃 بکاپ دیتابیس", callback_data="admin:backup")
-        ],
-        [
-            InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")
-        ]
+# The admin panel keyboard is static as well
+ADMIN_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 آمار", callback_data="admin:stats"),
+        InlineKeyboardButton("📢 ارسال گروهی", callback_data="admin:broadcast")
+    ],
+    [
+        InlineKeyboardButton("➕ افزودن صندلی", callback_data="admin:addseat"),
+        InlineKeyboardButton("📑 لیست اکانت‌ها", callback_data="admin:listcsv")
+    ],
+    [
+        InlineKeyboardButton("🗂️ مدیریت اکانت‌ها", callback_data="admin:list"),
+        InlineKeyboardButton("💵 تغییر قیمت", callback_data="admin:price")
+    ],
+    [
+        InlineKeyboardButton("💱 تغییر نرخ دلار", callback_data="admin:usd")
+    ],
+    [
+        InlineKeyboardButton("💳 مدیریت کارت‌ها", callback_data="admin:cards"),
+        InlineKeyboardButton("📅 CSV گروهی", callback_data="admin:bulkcsv")
+    ],
+    [
+        InlineKeyboardButton("📉 آمار UTM", callback_data="admin:utm"),
+        InlineKeyboardButton("📃 بکاپ دیتابیس", callback_data="admin:backup")
+    ],
+    [
+        InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
+
+
+def get_admin_keyboard():
+    """Return the admin panel keyboard."""
+    return ADMIN_MARKUP
 
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -571,14 +748,54 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # Show admin panel
     await update.message.reply_text(
-        f"💻 *پنل مدیریت*\n\n"
-        f"به پنل مدیریت بات خوش آمدید.\n"
-        f"لطفا گزینه مورد نظر خود را انتخاب کنید:",
+        ADMIN_PANEL_TEXT,
         reply_markup=get_admin_keyboard(),
         parse_mode="Markdown"
     )
 
 
+def _db_start_broadcast(broadcast_text: str) -> int:
+    """Log a broadcast in order_log and return the number of recipients."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM users")
+            user_count = cur.fetchone()[0]
+            
+            # Log broadcast event in order_log
+            cur.execute(
+                "INSERT INTO order_log (order_id, event) VALUES (NULL, %s)",
+                (f"Broadcast: {broadcast_text[:50]}{'...' if len(broadcast_text) > 50 else ''}",)
+            )
+            conn.commit()
+            return user_count
+
+
+def _db_fetch_recipient_batch(after_id: int, limit: int) -> list:
+    """Fetch the next (id, tg_id) batch of users after the given internal id."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, tg_id FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                (after_id, limit)
+            )
+            return cur.fetchall()
+
+
+_second_column = operator.itemgetter(1)
+
+
+async def iter_broadcast_recipients(batch_size: Optional[int] = None):
+    """Yield lists of user Telegram ids in batches instead of loading every id at once."""
+    batch_size = batch_size or BROADCAST_BATCH_SIZE
+    last_id = 0
+    while True:
+        rows = await asyncio.to_thread(_db_fetch_recipient_batch, last_id, batch_size)
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield list(map(_second_column, rows))
+
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /broadcast command to send a message to all users."""
     user = update.effective_user
@@ -591,7 +808,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     # Check if message is provided
-    if not context.args or len(''.join(context.args).strip()) == 0:
+    if not context.args or not any(arg.strip() for arg in context.args):
         await update.message.reply_text(
             "لطفا متن پیام را وارد کنید:\n"
             "/broadcast <متن پیام>"
@@ -601,21 +818,9 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Get broadcast message
     broadcast_text = " ".join(context.args)
     
-    # Get all users from database
+    # Count recipients and log the broadcast; the ids themselves are streamed while sending
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT tg_id FROM users")
-                users = [row[0] for row in cur.fetchall()]
-                
-                # Log broadcast event in order_log
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (NULL, %s) RETURNING id",
-                    (f"Broadcast: {broadcast_text[:50]}{'...' if len(broadcast_text) > 50 else ''}",)
-                )
-                log_id = cur.fetchone()[0]
-                conn.commit()
-                
+        user_count = await asyncio.to_thread(_db_start_broadcast, broadcast_text)
     except Exception as e:
         logger.error(f"Error getting users for broadcast: {e}")
         await update.message.reply_text("خطا در دریافت لیست کاربران.")
@@ -623,7 +828,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Confirm broadcast
     await update.message.reply_text(
-        f"📣 *در حال ارسال پیام به {len(users)} کاربر*\n\n"
+        f"📣 *در حال ارسال پیام به {user_count} کاربر*\n\n"
         f"پیام شما:\n"
         f"`{broadcast_text}`\n\n"
         f"لطفا منتظر بمانید. این فرایند ممکن است چند دقیقه طول بکشد.",
@@ -631,11 +836,79 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     
     # Start broadcast in background
-    asyncio.create_task(send_broadcast_messages(context.bot, broadcast_text, users, update.effective_chat.id))
+    asyncio.create_task(
+        send_broadcast_messages(context.bot, broadcast_text, iter_broadcast_recipients(), update.effective_chat.id)
+    )
+
+
+def _db_write_backup(backup_file, timestamp: str) -> int:
+    """
+    Write a gzip-compressed, psql-restorable dump of all public tables to backup_file.
+    
+    Table data is streamed with COPY ... TO STDOUT straight into the gzip stream,
+    inside a single read-only snapshot.
+    
+    Returns:
+        Number of tables written
+    """
+    with gzip.GzipFile(fileobj=backup_file, mode="wb") as gz:
+        # Write backup header
+        gz.write(
+            f"-- Wind Reseller Database Backup\n"
+            f"-- Generated on: {timestamp}\n"
+            f"-- PostgreSQL Database Backup (restore with: gunzip -c <file> | psql)\n\n"
+            f"BEGIN;\n\n".encode()
+        )
+        
+        with db.get_conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    # Dump every table from the same consistent snapshot
+                    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    
+                    # Get all table names
+                    cur.execute("""
+                        SELECT tablename FROM pg_tables 
+                        WHERE schemaname = 'public' 
+                        ORDER BY tablename
+                    """)
+                    tables = [row[0] for row in cur.fetchall()]
+                    
+                    for table in tables:
+                        # Get column names in table order; generated columns (seats.free_slots)
+                        # can't be copied out or in, the restore recomputes them
+                        cur.execute("""
+                            SELECT column_name
+                            FROM information_schema.columns 
+                            WHERE table_name = %s AND table_schema = 'public'
+                              AND is_generated = 'NEVER'
+                            ORDER BY ordinal_position
+                        """, (table,))
+                        columns = sql.SQL(", ").join(sql.Identifier(row[0]) for row in cur.fetchall())
+                        table_ident = sql.Identifier("public", table)
+                        
+                        # Write table data as a COPY block
+                        gz.write(f"-- Table: {table}\n".encode())
+                        gz.write(
+                            sql.SQL("COPY {} ({}) FROM stdin;\n").format(table_ident, columns).as_string(conn).encode()
+                        )
+                        cur.copy_expert(
+                            sql.SQL("COPY {} ({}) TO STDOUT").format(table_ident, columns).as_string(conn),
+                            gz
+                        )
+                        gz.write(b"\\.\n\n")
+            finally:
+                # Nothing was modified; just end the snapshot transaction
+                conn.rollback()
+        
+        # Write backup footer
+        gz.write(f"COMMIT;\n\n-- Backup completed at {timestamp}\n".encode())
+    
+    return len(tables)
 
 
 async def backup_db(bot, status_message):
-    """Create a database backup using Python and send it to the sales log channel."""
+    """Create a compressed database backup and send it to the sales log channel."""
     if not LOG_SELL_CHID:
         await status_message.edit_text(
             "❌ *خطا: LOG_SELL_CHID تنظیم نشده است*",
@@ -646,116 +919,42 @@ async def backup_db(bot, status_message):
     try:
         # Create a timestamp for the backup
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"wind_reseller_backup_{timestamp}.sql"
+        backup_filename = f"wind_reseller_backup_{timestamp}.sql.gz"
         
-        with tempfile.TemporaryDirectory() as temp_dir:
-            backup_path = Path(temp_dir) / backup_filename
-            
+        with tempfile.TemporaryFile() as backup_file:
             await status_message.edit_text(
                 "💾 *در حال ایجاد بکاپ...*",
                 parse_mode="Markdown"
             )
             
-            # Create backup using Python
-            with open(backup_path, "w", encoding="utf-8") as backup_file:
-                # Write backup header
-                backup_file.write(f"-- Wind Reseller Database Backup\n")
-                backup_file.write(f"-- Generated on: {timestamp}\n")
-                backup_file.write(f"-- PostgreSQL Database Backup\n\n")
-                backup_file.write("BEGIN;\n\n")
-                
-                # Get database connection
-                with db.get_conn() as conn:
-                    with conn.cursor() as cur:
-                        # Get all table names
-                        cur.execute("""
-                            SELECT tablename FROM pg_tables 
-                            WHERE schemaname = 'public' 
-                            ORDER BY tablename
-                        """)
-                        tables = [row[0] for row in cur.fetchall()]
-                        
-                        await status_message.edit_text(
-                            f"💾 *در حال بکاپ {len(tables)} جدول...*",
-                            parse_mode="Markdown"
-                        )
-                        
-                        for table in tables:
-                            # Get table structure
-                            cur.execute(f"""
-                                SELECT column_name, data_type, is_nullable, column_default
-                                FROM information_schema.columns 
-                                WHERE table_name = %s AND table_schema = 'public'
-                                ORDER BY ordinal_position
-                            """, (table,))
-                            columns = cur.fetchall()
-                            
-                            # Write table structure comment
-                            backup_file.write(f"-- Table: {table}\n")
-                            
-                            # Get table data
-                            cur.execute(f"SELECT * FROM {table}")
-                            rows = cur.fetchall()
-                            
-                            if rows:
-                                # Get column names
-                                column_names = [desc[0] for desc in cur.description]
-                                
-                                # Write INSERT statements
-                                for row in rows:
-                                    values = []
-                                    for value in row:
-                                        if value is None:
-                                            values.append("NULL")
-                                        elif isinstance(value, str):
-                                            # Escape single quotes
-                                            escaped_value = value.replace("'", "''")
-                                            values.append(f"'{escaped_value}'")
-                                        elif isinstance(value, (int, float)):
-                                            values.append(str(value))
-                                        elif isinstance(value, bool):
-                                            values.append("TRUE" if value else "FALSE")
-                                        else:
-                                            # For other types, convert to string and escape
-                                            escaped_value = str(value).replace("'", "''")
-                                            values.append(f"'{escaped_value}'")
-                                    
-                                    backup_file.write(
-                                        f"INSERT INTO {table} ({', '.join(column_names)}) "
-                                        f"VALUES ({', '.join(values)});\n"
-                                    )
-                                
-                                backup_file.write(f"\n")
-                        
-                        # Write backup footer
-                        backup_file.write("COMMIT;\n")
-                        backup_file.write(f"\n-- Backup completed at {timestamp}\n")
+            # Dump the database off the event loop
+            table_count = await asyncio.to_thread(_db_write_backup, backup_file, timestamp)
             
-            # Check if backup file exists and has content
-            if not backup_path.exists() or backup_path.stat().st_size == 0:
+            # Check if backup file has content
+            file_size = backup_file.tell()
+            if file_size == 0:
                 await status_message.edit_text(
                     "❌ *خطا: فایل بکاپ ایجاد نشد*",
                     parse_mode="Markdown"
                 )
                 return
+            backup_file.seek(0)
             
             # Send the backup file to the sales log channel
             await status_message.edit_text(
-                "📤 *در حال ارسال فایل بکاپ...*",
+                f"📤 *در حال ارسال فایل بکاپ ({table_count} جدول)...*",
                 parse_mode="Markdown"
             )
             
-            file_size = backup_path.stat().st_size
             file_size_mb = file_size / (1024 * 1024)
             
             try:
-                with open(backup_path, "rb") as backup_file:
-                    await bot.send_document(
-                        chat_id=LOG_SELL_CHID,
-                        document=backup_file,
-                        filename=backup_filename,
-                        caption=f"📂 *بکاپ دیتابیس* - {timestamp}\n💾 حجم: {file_size_mb:.2f} MB"
-                    )
+                await bot.send_document(
+                    chat_id=LOG_SELL_CHID,
+                    document=backup_file,
+                    filename=backup_filename,
+                    caption=f"📂 *بکاپ دیتابیس* - {timestamp}\n💾 حجم: {file_size_mb:.2f} MB"
+                )
                 
                 # Update status message
                 await status_message.edit_text(
@@ -782,36 +981,185 @@ async def backup_db(bot, status_message):
         )
 
 
-async def send_broadcast_messages(bot, message, user_ids, admin_chat_id):
-    """Send broadcast messages to all users with rate limiting and error handling."""
-    # Constants for broadcasting - updated per requirements
-    CHUNK_SIZE = 20  # Number of users to process in each chunk (changed from 30 to 20)
-    SLEEP_BETWEEN_MESSAGES = 0.1  # Seconds to sleep between individual messages
-    SLEEP_BETWEEN_CHUNKS = 3  # Seconds to sleep between chunks
+class AsyncRateLimiter:
+    """Token bucket that lets at most `rate` operations start per `period` seconds."""
+    
+    def __init__(self, rate: float, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        """Wait until a token is available and consume it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate / self.period)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class Outbox:
+    """
+    Central queue for outgoing Telegram requests.
+    
+    Worker tasks drain the queue under one shared token bucket, so replies and broadcasts
+    together stay under the bot-wide flood limit. Replies are queued ahead of bulk sends.
+    Posts to groups and channels can additionally be paced per chat (`pace_chat`), since
+    Telegram only allows about 20 messages per minute there.
+    Until start() is called (e.g. when imported by scripts) requests are sent directly.
+    """
+    
+    PRIORITY_REPLY = 0
+    PRIORITY_BULK = 1
+    
+    def __init__(self, limiter: AsyncRateLimiter, workers: int, chat_interval: float = 3.0):
+        self.limiter = limiter
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self._chat_next: Dict[Any, float] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._seq = itertools.count()
+    
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop."""
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self) -> None:
+        """Stop the worker tasks; requests still queued are cancelled."""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        while self._queue is not None and not self._queue.empty():
+            fut = self._queue.get_nowait()[-1]
+            fut.cancel()
+    
+    async def send(self, fn, *args, priority: int = PRIORITY_REPLY, pace_chat=None, **kwargs):
+        """Queue a Telegram API call and wait for its result."""
+        if pace_chat is not None:
+            # Reserve the chat's next slot and wait for it here, without holding a worker
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(pace_chat, 0.0))
+            self._chat_next[pace_chat] = slot + self.chat_interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        
+        if not self._tasks:
+            return await fn(*args, **kwargs)
+        
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), fn, args, kwargs, fut))
+        return await fut
+    
+    async def _worker(self) -> None:
+        while True:
+            _, _, fn, args, kwargs, fut = await self._queue.get()
+            try:
+                if fut.done():
+                    # The caller gave up waiting
+                    continue
+                await self.limiter.acquire()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(result)
+            finally:
+                self._queue.task_done()
+
+
+# Strong references to fire-and-forget tasks, so they aren't garbage collected mid-flight
+_background_tasks: set = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run a coroutine as a background task that nobody awaits."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# Outgoing message tuning - Telegram allows about 30 messages per second per bot
+OUTBOX_WORKERS = 30  # Maximum number of in-flight send requests
+OUTBOX_RATE_PER_SECOND = 25  # Stay just under the global flood limit
+outbox = Outbox(AsyncRateLimiter(OUTBOX_RATE_PER_SECOND), workers=OUTBOX_WORKERS)
+
+BROADCAST_CONCURRENCY = 30  # Maximum number of broadcast sends queued at once
+BROADCAST_BATCH_SIZE = 1000  # Recipients fetched from the database per batch
+
+# Characters that make legacy Markdown parse a message
+_MARKDOWN_TOKEN_RE = re.compile(r"[*_`\[]")
+
+
+def _db_log_event(event: str) -> None:
+    """Write an order_log entry that isn't tied to an order."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO order_log (order_id, event) VALUES (NULL, %s)", (event,))
+            conn.commit()
+
+
+async def send_broadcast_messages(bot, message, recipient_batches, admin_chat_id):
+    """
+    Send broadcast messages to all users with rate limiting and error handling.
     
+    Args:
+        recipient_batches: Async iterable yielding lists of Telegram user ids
+    """
     success_count = 0
     error_count = 0
     blocked_count = 0
     retry_count = 0
     
-    # Process users in chunks to avoid hitting rate limits
-    for i in range(0, len(user_ids), CHUNK_SIZE):
-        chunk = user_ids[i:i+CHUNK_SIZE]
-        logger.info(f"Processing broadcast chunk {i//CHUNK_SIZE + 1}/{(len(user_ids) + CHUNK_SIZE - 1) // CHUNK_SIZE}")
+    # Plain text needs no server-side parsing; text with Markdown tokens keeps its
+    # formatting, falling back to an escaped copy (built once) if Telegram rejects it
+    text = message
+    parse_mode = "Markdown" if _MARKDOWN_TOKEN_RE.search(message) else None
+    
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def send_text(user_id):
+        nonlocal text
+        try:
+            await outbox.send(bot.send_message, chat_id=user_id, text=text, parse_mode=parse_mode,
+                              priority=Outbox.PRIORITY_BULK)
+        except BadRequest as e:
+            if parse_mode is None or "can't parse entities" not in str(e).lower():
+                raise
+            if text is message:
+                logger.warning("Broadcast text is not valid Markdown, sending it escaped")
+                text = escape_markdown(message)
+            await outbox.send(bot.send_message, chat_id=user_id, text=text, parse_mode=parse_mode,
+                              priority=Outbox.PRIORITY_BULK)
+    
+    async def send_one(user_id):
+        nonlocal success_count, error_count, blocked_count, retry_count
         
-        # Process each user in the chunk
-        for user_id in chunk:
+        async with semaphore:
             try:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode="Markdown"
-                )
+                await send_text(user_id)
                 success_count += 1
                 
-                # Small delay between messages to avoid flood limits
-                await asyncio.sleep(SLEEP_BETWEEN_MESSAGES)
-                
             except RetryAfter as e:
                 # Handle Telegram rate limiting
                 retry_seconds = e.retry_after
@@ -821,11 +1169,7 @@ async def send_broadcast_messages(bot, message, user_ids, admin_chat_id):
                 
                 # Retry this user
                 try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        parse_mode="Markdown"
-                    )
+                    await send_text(user_id)
                     success_count += 1
                 except Exception as retry_e:
                     logger.error(f"Failed to send message on retry: {retry_e}")
@@ -840,10 +1184,14 @@ async def send_broadcast_messages(bot, message, user_ids, admin_chat_id):
                 # Other errors
                 logger.error(f"Error sending broadcast message to {user_id}: {e}")
                 error_count += 1
-        
-        # Sleep between chunks to avoid hitting rate limits
-        if i + CHUNK_SIZE < len(user_ids):  # If not the last chunk
-            await asyncio.sleep(SLEEP_BETWEEN_CHUNKS)
+    
+    # Send each batch concurrently; the semaphore and the outbox keep us under the flood limits
+    # while the next batch of recipients is fetched only when needed
+    batch_number = 0
+    async for user_ids in recipient_batches:
+        batch_number += 1
+        logger.info(f"Processing broadcast batch {batch_number} ({len(user_ids)} users)")
+        await asyncio.gather(*(send_one(user_id) for user_id in user_ids))
     
     # Send summary to admin
     summary = (
@@ -857,13 +1205,10 @@ async def send_broadcast_messages(bot, message, user_ids, admin_chat_id):
     
     try:
         # Log to database that broadcast completed
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (NULL, %s)",
-                    (f"Broadcast completed: {success_count} sent, {error_count} errors, {blocked_count} blocked",)
-                )
-                conn.commit()
+        await asyncio.to_thread(
+            _db_log_event,
+            f"Broadcast completed: {success_count} sent, {error_count} errors, {blocked_count} blocked"
+        )
         
         # Send summary to admin
         await bot.send_message(
@@ -875,159 +1220,101 @@ async def send_broadcast_messages(bot, message, user_ids, admin_chat_id):
         logger.error(f"Failed to send broadcast summary to admin: {e}")
 
 
+def _db_get_approved_services(tg_id: int) -> list:
+    """Fetch a user's approved orders with seat information by Telegram id."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, "approved_services", (tg_id,))
+            return cur.fetchall()
+
+
 async def manage_services(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show and manage user's approved services."""
     user = update.effective_user
     
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Get user ID
-                cur.execute("SELECT id FROM users WHERE tg_id = %s", (user.id,))
-                result = cur.fetchone()
-                if not result:
-                    # User not found in database
-                    user_id = await create_or_get_user(user)
-                else:
-                    user_id = result[0]
-                
-                # Get user's approved orders with seat information
-                cur.execute(
-                    """SELECT o.id, s.email, s.id as seat_id 
-                       FROM orders o 
-                       JOIN seats s ON o.seat_id = s.id 
-                       WHERE o.user_id = %s AND o.status = 'approved' 
-                       ORDER BY o.approved_at DESC""",
-                    (user_id,)
-                )
-                orders = cur.fetchall()
-                
-                # Create message and keyboard
-                if not orders:
-                    message = (
-                        f"🔐 *مدیریت سرویس*\n\n"
-                        f"❌ شما هیچ سرویس فعالی ندارید.\n\n"
-                        f"👉 برای خرید سرویس از منوی اصلی گزینه 'خرید سرویس' را انتخاب کنید."
-                    )
-                    keyboard = [
-                        [InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")]
-                    ]
-                else:
-                    message = f"🔐 *مدیریت سرویس*\n\nسرویس‌های فعال شما:\n"
-                    
-                    # Create buttons for each service
-                    keyboard = []
-                    for order_id, email, seat_id in orders:
-                        message += f"\n✅ سرویس #{order_id}: `{email}`"
-                    
-                    # Add back button
-                    message += "\n\n📧 اطلاعات حساب شما در بالا نمایش داده شده است."
-                    keyboard.append([InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Send message
-                if update.callback_query:
-                    await update.callback_query.edit_message_text(
-                        message,
-                        parse_mode="Markdown",
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await update.message.reply_text(
-                        message,
-                        parse_mode="Markdown",
-                        reply_markup=reply_markup
-                    )
+        # Get user's approved orders with seat information in one round-trip
+        # (an unknown user simply has no services)
+        orders = await asyncio.to_thread(_db_get_approved_services, user.id)
+        
+        # Create message
+        if not orders:
+            message = (
+                f"🔐 *مدیریت سرویس*\n\n"
+                f"❌ شما هیچ سرویس فعالی ندارید.\n\n"
+                f"👉 برای خرید سرویس از منوی اصلی گزینه 'خرید سرویس' را انتخاب کنید."
+            )
+        else:
+            lines = ["🔐 *مدیریت سرویس*\n\nسرویس‌های فعال شما:\n"]
+            lines.extend(f"✅ سرویس #{order_id}: `{email}`" for order_id, email in orders)
+            lines.append("\n📧 اطلاعات حساب شما در بالا نمایش داده شده است.")
+            message = "\n".join(lines)
+        
+        # Send message
+        await reply(update, message, parse_mode="Markdown", reply_markup=BACK_TO_MENU_MARKUP)
     
     except Exception as e:
         logger.error(f"Error managing services: {e}")
         error_message = "متأسفانه در نمایش سرویس‌ها خطایی رخ داد. لطفا بعدا تلاش کنید."
-        
-        if update.callback_query:
-            await update.callback_query.edit_message_text(error_message)
-        else:
-            await update.message.reply_text(error_message)
+        await reply(update, error_message)
 
 
-async def show_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show user's wallet balance and free credit."""
-    user = update.effective_user
-    
-    try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Get user ID
-                cur.execute("SELECT id FROM users WHERE tg_id = %s", (user.id,))
-                result = cur.fetchone()
-                if not result:
-                    # User not found in database
-                    user_id = await create_or_get_user(user)
-                else:
-                    user_id = result[0]
-                    
-                # Get wallet information
+def _db_get_or_create_wallet(user_id: int) -> tuple:
+    """Return (balance, free_credit) for a user, creating the wallet if it doesn't exist."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT balance, free_credit FROM wallets WHERE user_id = %s",
+                (user_id,)
+            )
+            wallet = cur.fetchone()
+            
+            if not wallet:
+                # Create wallet if it doesn't exist
                 cur.execute(
-                    "SELECT balance, free_credit FROM wallets WHERE user_id = %s",
+                    "INSERT INTO wallets (user_id) VALUES (%s) RETURNING balance, free_credit",
                     (user_id,)
                 )
                 wallet = cur.fetchone()
-                
-                if not wallet:
-                    # Create wallet if it doesn't exist
-                    cur.execute(
-                        "INSERT INTO wallets (user_id) VALUES (%s) RETURNING balance, free_credit",
-                        (user_id,)
-                    )
-                    wallet = cur.fetchone()
-                    conn.commit()
-                
-                balance, free_credit = wallet
-                
-                # Format numbers with Persian style
-                def format_currency(amount):
-                    # Format with thousand separators
-                    formatted = f"{int(amount):,}"
-                    # Replace numbers with Persian digits if needed
-                    return formatted + " تومان"
-                
-                # Create wallet message
-                message = (
-                    f"💰 *کیف پول شما*\n\n"
-                    f"💵 موجودی: *{format_currency(balance)}*\n"
-                    f"🎁 اعتبار رایگان: *{format_currency(free_credit)}*\n\n"
-                    f"💫 موجودی کل: *{format_currency(balance + free_credit)}*\n\n"
-                    f"📝 از منوی اصلی می‌توانید سرویس خریداری کنید."
-                )
-                
-                # Create back button
-                keyboard = [
-                    [InlineKeyboardButton("🔙 بازگشت به منو", callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Send wallet information
-                if update.callback_query:
-                    await update.callback_query.edit_message_text(
-                        message,
-                        parse_mode="Markdown",
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await update.message.reply_text(
-                        message,
-                        parse_mode="Markdown",
-                        reply_markup=reply_markup
-                    )
+                conn.commit()
+            
+            return wallet
+
+
+async def show_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show user's wallet balance and free credit."""
+    user = update.effective_user
+    
+    try:
+        # Get user ID (creates the user if not found in database)
+        user_id = await create_or_get_user(user)
+        
+        # Get wallet information
+        balance, free_credit = await asyncio.to_thread(_db_get_or_create_wallet, user_id)
+        
+        # Format numbers with Persian style
+        def format_currency(amount):
+            # Format with thousand separators
+            formatted = f"{int(amount):,}"
+            # Replace numbers with Persian digits if needed
+            return formatted + " تومان"
+        
+        # Create wallet message
+        message = (
+            f"💰 *کیف پول شما*\n\n"
+            f"💵 موجودی: *{format_currency(balance)}*\n"
+            f"🎁 اعتبار رایگان: *{format_currency(free_credit)}*\n\n"
+            f"💫 موجودی کل: *{format_currency(balance + free_credit)}*\n\n"
+            f"📝 از منوی اصلی می‌توانید سرویس خریداری کنید."
+        )
+        
+        # Send wallet information
+        await reply(update, message, parse_mode="Markdown", reply_markup=BACK_TO_MENU_MARKUP)
                 
     except Exception as e:
         logger.error(f"Error showing wallet: {e}")
         error_message = "متأسفانه در نمایش اطلاعات کیف پول خطایی رخ داد. لطفا بعدا تلاش کنید."
-        
-        if update.callback_query:
-            await update.callback_query.edit_message_text(error_message)
-        else:
-            await update.message.reply_text(error_message)
+        await reply(update, error_message)
 
 
 async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1035,52 +1322,72 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await show_purchase_info(update, context)
 
 
+# Message templates of the purchase flow, joined once at import time
+SUBSCRIPTION_TEXT_TEMPLATE = (
+    "🥇 *ویژگی‌های اکانت ویندسکرایب یک‌ماهه (تک‌کاربره):*\n\n"
+    "• اتصال سریع و پایدار\n"
+    "• بدون محدودیت حجم مصرفی\n"
+    "• قابل استفاده روی *یک دستگاه*\n"
+    "• مدت زمان: *۱ ماه*\n"
+    "• قیمت: *{price_display}*\n\n"
+)
+PAYMENT_TEXT_TEMPLATE = (
+    "💳 اطلاعات پرداخت:\n\n"
+    "🕊 نوع پلن: اشتراک یک‌ماهه ویندسکرایب\n\n"
+    "مبلغ {amount_display} تومان به کارت زیر واریز کرده و اسکرین شات واریز رو همین‌جا در ربات ارسال کنید\n"
+    "🔻🔻\n"
+    "`{card_number}`\n"
+    "{card_title}\n\n"
+    "تایید تراکنش شما به نوبت در سریع‌ترین زمان ممکن انجام خواهد شد🙏\n\n"
+    "❔در صورت مشکل در پرداخت، از همراه بانک، تاپ، ۷۸۰، بله یا خودپرداز ATM استفاده کنید"
+)
+
+
+@functools.lru_cache(maxsize=8)
+def get_subscription_text(one_month_price: int) -> str:
+    """Render the subscription options message for a price."""
+    return SUBSCRIPTION_TEXT_TEMPLATE.format(price_display=f"{one_month_price:,} تومان")
+
+
 async def show_subscription_options(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show available subscription options."""
     # Get the one-month price from settings
-    one_month_price = int(db.get_setting('one_month_price', '70000'))
-    
-    # Create formatted price display
-    one_month_price_display = f"{one_month_price:,} تومان"
-    
-    # Create message with subscription features
-    message = (
-        f"🥇 *ویژگی‌های اکانت ویندسکرایب یک‌ماهه (تک‌کاربره):*\n\n"
-        f"• اتصال سریع و پایدار\n"
-        f"• بدون محدودیت حجم مصرفی\n"
-        f"• قابل استفاده روی *یک دستگاه*\n"
-        f"• مدت زمان: *۱ ماه*\n"
-        f"• قیمت: *{one_month_price_display}*\n\n"
-    )
-    
-    # Create keyboard with only one-month subscription option
-    keyboard = [
-        [
-            InlineKeyboardButton(f"💳 خرید ویندسکرایب یک‌ماهه", callback_data="buy:1mo")
-        ],
-        [
-            InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_menu")
-        ]
-    ]
+    one_month_price = await asyncio.to_thread(db.get_setting_int, 'one_month_price', 70000)
     
     # Send message with keyboard
-    if isinstance(update, Update) and update.callback_query:
-        await update.callback_query.edit_message_text(
-            message, 
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        await update.effective_message.reply_text(
-            message, 
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    await reply(
+        update,
+        get_subscription_text(one_month_price),
+        parse_mode="Markdown",
+        reply_markup=SUBSCRIPTION_OPTIONS_MARKUP
+    )
+
+
+def _db_create_order(tg_id: int, amount: int, utm_keyword: Optional[str]) -> Optional[int]:
+    """Create a pending one-month order for a user. Returns the order ID, or None if the user doesn't exist."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Look up the user, create the order and log it in a single round-trip
+            db.execute_prepared(cur, "create_order", (tg_id, amount, utm_keyword))
+            result = cur.fetchone()
+            conn.commit()
+            return result[0] if result else None
+
+
+@functools.lru_cache(maxsize=64)
+def get_payment_text(amount: int, card_title: str, card_number: str) -> str:
+    """Render the payment details message for a price and card."""
+    return PAYMENT_TEXT_TEMPLATE.format(
+        amount_display=f"{amount:,}",
+        card_number=card_number,
+        card_title=card_title
+    )
+
 
 async def show_purchase_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show purchase information and payment details."""
     # Get a random active card using the new card management system
-    card_title, card_number = card_manager.get_random_payment_card()
+    card_title, card_number = await asyncio.to_thread(card_manager.get_random_payment_card)
     
     if not card_number:
         card_title = "کارت بانکی"
@@ -1088,80 +1395,153 @@ async def show_purchase_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error("No active cards found in database and no fallback card configured")
     
     # Get one-month price from settings
-    amount = int(db.get_setting('one_month_price', '70000'))
-    plan_description = "اشتراک یک‌ماهه ویندسکرایب"
-    amount_display = f"{amount:,}"
+    amount = await asyncio.to_thread(db.get_setting_int, 'one_month_price', 70000)
     
     # Get user ID
     user = update.effective_user
     
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Get user_id from database
-                cur.execute("SELECT id FROM users WHERE tg_id = %s", (user.id,))
-                result = cur.fetchone()
-                if not result:
-                    # User not found, create user
-                    user_id = await create_or_get_user(user)
-                else:
-                    user_id = result[0]
-                
-                # Create new pending order
-                utm_keyword = context.user_data.get('utm', None)
-                cur.execute(
-                    "INSERT INTO orders (user_id, amount, utm_keyword) VALUES (%s, %s, %s) RETURNING id",
-                    (user_id, amount, utm_keyword)
-                )
-                order_id = cur.fetchone()[0]
-                
-                # Log order creation
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (%s, %s)",
-                    (order_id, "Order created for one-month plan")
-                )
-                conn.commit()
+        utm_keyword = context.user_data.get('utm', None)
+        order_id = await asyncio.to_thread(_db_create_order, user.id, amount, utm_keyword)
+        if order_id is None:
+            # User not found, create user and try again
+            await create_or_get_user(user)
+            order_id = await asyncio.to_thread(_db_create_order, user.id, amount, utm_keyword)
     except Exception as e:
         logger.error(f"Error creating order: {e}")
-        if isinstance(update, Update) and update.effective_message:
-            await update.effective_message.reply_text(
-                "خطا در ثبت سفارش. لطفا بعدا تلاش کنید."
-            )
+        await outbox.send(update.effective_message.reply_text, "خطا در ثبت سفارش. لطفا بعدا تلاش کنید.")
         return
     
     # Store order_id in user_data for handling receipt
     context.user_data['pending_order_id'] = order_id
     
-    # Create new payment message format
-    message = (
-        f"💳 اطلاعات پرداخت:\n\n"
-        f"🕊 نوع پلن: {plan_description}\n\n"
-        f"مبلغ {amount_display} تومان به کارت زیر واریز کرده و اسکرین شات واریز رو همین‌جا در ربات ارسال کنید\n"
-        f"🔻🔻\n"
-        f"`{card_number}`\n"
-        f"{card_title}\n\n"
-        f"تایید تراکنش شما به نوبت در سریع‌ترین زمان ممکن انجام خواهد شد🙏\n\n"
-        f"❔در صورت مشکل در پرداخت، از همراه بانک، تاپ، ۷۸۰، بله یا خودپرداز ATM استفاده کنید"
+    # Send the payment details as a new message, keeping the plan message above it
+    await outbox.send(
+        update.effective_message.reply_text,
+        get_payment_text(amount, card_title, card_number),
+        parse_mode="Markdown",
+        reply_markup=PURCHASE_INFO_MARKUP
     )
+
+
+def _db_get_pending_order(tg_id: int) -> Optional[int]:
+    """Return the latest pending order ID of a user, or None if there is none."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, "pending_order", (tg_id,))
+            result = cur.fetchone()
+            return result[0] if result else None
+
+
+def _db_submit_receipt(order_id: int, file_id: str, chat_id: int) -> bool:
+    """
+    Store a receipt and move its order to the 'receipt' status.
+    Returns False if the order is no longer pending (e.g. a duplicate photo).
+    """
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Update the order status, store the receipt and log the event in one round-trip;
+            # only the first receipt of a pending order gets through
+            db.execute_prepared(cur, "submit_receipt", (order_id, file_id, chat_id))
+            submitted = cur.fetchone() is not None
+            conn.commit()
+            return submitted
+
+
+def _db_get_receipt_details(order_id: int) -> tuple:
+    """Return (amount, card_number, card_holder_name) for the receipt caption of an order."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Get order amount
+            cur.execute(
+                "SELECT amount FROM orders WHERE id = %s",
+                (order_id,)
+            )
+            order_result = cur.fetchone()
+            amount = order_result[0] if order_result else 0
+            
+            # Get card info (first active card if no specific one is set)
+            cur.execute(
+                "SELECT card_number, title FROM cards WHERE active = true LIMIT 1"
+            )
+            card_result = cur.fetchone()
+            if card_result:
+                card_number = card_result[0]
+                card_holder_name = card_result[1]  # title field used as holder name
+            else:
+                # Fallback to environment variable
+                card_number = CARD_NUMBER if CARD_NUMBER else "نامشخص"
+                card_holder_name = "نامشخص"
+            
+            return amount, card_number, card_holder_name
+
+
+# Channel message IDs of forwarded receipts are written to the database in batches
+RECEIPT_MSG_FLUSH_INTERVAL = 0.25  # seconds
+RECEIPT_MSG_FLUSH_SIZE = 100  # Flush right away once this many are buffered
+_receipt_msg_buffer: Dict[int, int] = {}
+
+
+async def flush_receipt_msgs() -> None:
+    """Write the buffered receipt channel message IDs to the database."""
+    if not _receipt_msg_buffer:
+        return
     
-    # Add back button
-    keyboard = [
-        [InlineKeyboardButton("🔙 بازگشت به انتخاب پلن", callback_data="buy_service")]
-    ]
+    # Swap the buffer out before awaiting so new IDs go into a fresh dict
+    rows = list(_receipt_msg_buffer.items())
+    _receipt_msg_buffer.clear()
     
-    # Send message
-    if isinstance(update, Update) and update.effective_message:
-        await update.effective_message.reply_text(
-            message, 
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    if not await asyncio.to_thread(db.set_receipt_channel_msgs, rows):
+        # Keep the IDs for the next flush, unless a newer one was buffered meanwhile
+        for order_id, msg_id in rows:
+            _receipt_msg_buffer.setdefault(order_id, msg_id)
+
+
+async def receipt_msg_flush_loop() -> None:
+    """Periodically flush buffered receipt channel message IDs."""
+    while True:
+        await asyncio.sleep(RECEIPT_MSG_FLUSH_INTERVAL)
+        try:
+            await flush_receipt_msgs()
+        except Exception as e:
+            logger.error(f"Error flushing receipt channel message IDs: {e}")
+
+
+async def forward_receipt(bot, order_id: int, file_id: str, user_display: str) -> None:
+    """Post a receipt with its order details and approval buttons to the receipt channel."""
+    try:
+        # Get order details and card info
+        amount, card_number, card_holder_name = await asyncio.to_thread(
+            _db_get_receipt_details, order_id
         )
-    elif isinstance(update, Update) and update.callback_query:
-        await update.callback_query.edit_message_text(
-            message, 
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        
+        # Create detailed caption
+        caption = (
+            f"🧾 رسید جدید پرداخت کارت به کارت:\n\n"
+            f"👤 کاربر: {user_display}\n"
+            f"🔢 شماره تراکنش: #{order_id}\n"
+            f"💰 مبلغ: {amount:,} تومان\n\n"
+            f"💳 کارت مقصد:\n"
+            f"🔢 {card_number}\n"
+            f"👤 {card_holder_name}"
+        )
+        
+        # Forward with order info in caption
+        forwarded_msg = await outbox.send(
+            bot.send_photo,
+            pace_chat=RECEIPT_CHANNEL_ID,
+            chat_id=RECEIPT_CHANNEL_ID,
+            photo=file_id,
+            caption=caption,
+            reply_markup=get_admin_approval_keyboard(order_id)
         )
+        
+        # Save forwarded message ID (flushed by receipt_msg_flush_loop)
+        _receipt_msg_buffer[order_id] = forwarded_msg.message_id
+        if len(_receipt_msg_buffer) >= RECEIPT_MSG_FLUSH_SIZE:
+            await flush_receipt_msgs()
+    except Exception as e:
+        logger.error(f"Error forwarding receipt to admin channel: {e}")
 
 
 async def handle_receipt_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1175,37 +1555,20 @@ async def handle_receipt_photo(update: Update, context: ContextTypes.DEFAULT_TYP
     if not pending_order_id:
         # Check if user has any pending orders in database
         try:
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    # Get user_id
-                    cur.execute("SELECT id FROM users WHERE tg_id = %s", (user.id,))
-                    result = cur.fetchone()
-                    if not result:
-                        await update.message.reply_text(
-                            "شما سفارش فعالی ندارید. ابتدا از طریق /buy سفارش جدیدی ثبت کنید."
-                        )
-                        return
-                        
-                    user_id = result[0]
-                    
-                    # Check for pending orders
-                    cur.execute(
-                        "SELECT id FROM orders WHERE user_id = %s AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
-                        (user_id,)
-                    )
-                    result = cur.fetchone()
-                    if result:
-                        pending_order_id = result[0]
-                        # Store in user_data for future use
-                        context.user_data['pending_order_id'] = pending_order_id
-                    else:
-                        await update.message.reply_text(
-                            "شما سفارش فعالی ندارید. ابتدا از طریق /buy سفارش جدیدی ثبت کنید."
-                        )
-                        return
+            pending_order_id = await asyncio.to_thread(_db_get_pending_order, user.id)
+            if not pending_order_id:
+                await outbox.send(
+                    update.message.reply_text,
+                    "شما سفارش فعالی ندارید. ابتدا از طریق /buy سفارش جدیدی ثبت کنید."
+                )
+                return
+            
+            # Store in user_data for future use
+            context.user_data['pending_order_id'] = pending_order_id
         except Exception as e:
             logger.error(f"Error checking for pending orders: {e}")
-            await update.message.reply_text(
+            await outbox.send(
+                update.message.reply_text,
                 "خطا در بررسی سفارشات. لطفا بعدا تلاش کنید."
             )
             return
@@ -1215,99 +1578,36 @@ async def handle_receipt_photo(update: Update, context: ContextTypes.DEFAULT_TYP
     file_id = photo.file_id
     
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Update order status to 'receipt'
-                cur.execute(
-                    "UPDATE orders SET status = 'receipt' WHERE id = %s", 
-                    (pending_order_id,)
-                )
-                
-                # Store receipt information
-                cur.execute(
-                    "INSERT INTO receipts (order_id, tg_file_id, orig_chat_id) VALUES (%s, %s, %s)",
-                    (pending_order_id, file_id, chat_id)
-                )
-                
-                # Log event
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (%s, %s)",
-                    (pending_order_id, "Receipt submitted")
-                )
-                conn.commit()
+        submitted = await asyncio.to_thread(_db_submit_receipt, pending_order_id, file_id, chat_id)
     except Exception as e:
         logger.error(f"Error processing receipt: {e}")
-        await update.message.reply_text(
+        await outbox.send(
+            update.message.reply_text,
             "خطا در ذخیره رسید. لطفا بعدا تلاش کنید."
         )
         return
     
+    if not submitted:
+        # A receipt for this order was already received; don't forward it again
+        context.user_data.pop('pending_order_id', None)
+        await outbox.send(
+            update.message.reply_text,
+            "رسید این سفارش قبلاً ثبت شده و در انتظار تایید می‌باشد ✅"
+        )
+        return
+    
     # Send confirmation to user
-    await update.message.reply_text(
+    await outbox.send(
+        update.message.reply_text,
         f"با تشکر، سفارش شما ثبت شد و در انتظار تایید می‌باشد ✅\n\n"
         f"فرایند تایید ممکنه تا چند ساعت زمان ببره لطفا از پیام مکرر به پشتیبانی خودداری کنید\n\n"
         f"💬 پشتیبانی: @AccountYarSupport"
     )
     
-    # Forward receipt to admin channel
+    # Forward receipt to admin channel in the background; the user already has their answer
     if RECEIPT_CHANNEL_ID:
-        try:
-            # Get order details and card info
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    # Get order amount
-                    cur.execute(
-                        "SELECT amount FROM orders WHERE id = %s",
-                        (pending_order_id,)
-                    )
-                    order_result = cur.fetchone()
-                    amount = order_result[0] if order_result else 0
-                    
-                    # Get card info (first active card if no specific one is set)
-                    cur.execute(
-                        "SELECT card_number, title FROM cards WHERE active = true LIMIT 1"
-                    )
-                    card_result = cur.fetchone()
-                    if card_result:
-                        card_number = card_result[0]
-                        card_holder_name = card_result[1]  # title field used as holder name
-                    else:
-                        # Fallback to environment variable
-                        card_number = CARD_NUMBER if CARD_NUMBER else "نامشخص"
-                        card_holder_name = "نامشخص"
-            
-            # Format user display
-            user_display = f"@{user.username}" if user.username else f"کاربر #{user.id}"
-            
-            # Create detailed caption
-            caption = (
-                f"🧾 رسید جدید پرداخت کارت به کارت:\n\n"
-                f"👤 کاربر: {user_display}\n"
-                f"🔢 شماره تراکنش: #{pending_order_id}\n"
-                f"💰 مبلغ: {amount:,} تومان\n\n"
-                f"💳 کارت مقصد:\n"
-                f"🔢 {card_number}\n"
-                f"👤 {card_holder_name}"
-            )
-            
-            # Forward with order info in caption
-            forwarded_msg = await context.bot.send_photo(
-                chat_id=RECEIPT_CHANNEL_ID,
-                photo=file_id,
-                caption=caption,
-                reply_markup=get_admin_approval_keyboard(pending_order_id)
-            )
-            
-            # Save forwarded message ID
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE receipts SET channel_msg_id = %s WHERE order_id = %s",
-                        (forwarded_msg.message_id, pending_order_id)
-                    )
-                    conn.commit()
-        except Exception as e:
-            logger.error(f"Error forwarding receipt to admin channel: {e}")
+        user_display = f"@{user.username}" if user.username else f"کاربر #{user.id}"
+        spawn_background(forward_receipt(context.bot, pending_order_id, file_id, user_display))
     else:
         logger.error("RECEIPT_CHANNEL_ID not set, could not forward receipt")
     
@@ -1320,6 +1620,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text("Help message")
 
 
+def _db_update_seat(seat_id: int, email: Optional[str], pass_enc: Optional[bytes],
+                    secret_enc: Optional[bytes], max_slots: Optional[int]) -> Optional[tuple]:
+    """
+    Update the given fields of a seat (None keeps the current value).
+    Returns the seat's (email, max_slots) after the update, or None if the seat doesn't exist.
+    """
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE seats SET email = COALESCE(%s, email), pass_enc = COALESCE(%s, pass_enc), "
+                "secret_enc = COALESCE(%s, secret_enc), max_slots = COALESCE(%s, max_slots) "
+                "WHERE id = %s RETURNING email, max_slots",
+                (email, pass_enc, secret_enc, max_slots, seat_id)
+            )
+            result = cur.fetchone()
+            conn.commit()
+            return result
+
+
 async def process_seat_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process seat edit input from a message."""
     message = update.message
@@ -1338,87 +1657,73 @@ async def process_seat_edit(update: Update, context: ContextTypes.DEFAULT_TYPE)
         while len(parts) < 4:
             parts.append('-')
         
-        # Extract the parts
+        # Extract the parts ('-' keeps the current value)
         username, password, secret, slots = parts
         
-        # Fetch current row data
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Get current seat data
-                cur.execute(
-                    "SELECT email, pass_enc, secret_enc, max_slots FROM seats WHERE id = %s",
-                    (seat_id,)
-                )
-                result = cur.fetchone()
-                
-                if not result:
-                    await message.reply_text(
-                        f"❌ *خطا: صندلی شماره {seat_id} یافت نشد*",
-                        parse_mode="Markdown"
-                    )
-                    context.user_data.pop('edit_seat_id', None)
-                    context.user_data.pop('edit_return_page', None)
-                    return
-                
-                current_username, current_pass_enc, current_secret_enc, current_max_slots = result
-                
-                # Prepare new values
-                new_username = username if username != '-' else current_username
-                new_pass_enc = encrypt(password) if password != '-' else current_pass_enc
-                new_secret_enc = encrypt(secret) if secret != '-' else current_secret_enc
-                
-                # Handle slots conversion
-                try:
-                    new_slots = int(slots) if slots != '-' else current_max_slots
-                except ValueError:
-                    await message.reply_text(
-                        "❌ *خطا: تعداد صندلی باید یک عدد باشد*",
-                        parse_mode="Markdown"
-                    )
-                    return
-                
-                # Validate username if it's changing
-                if username != '-' and len(new_username.strip()) < 3:
-                    await message.reply_text(
-                        "❌ *خطا: نام کاربری باید حداقل ۳ کاراکتر باشد*",
-                        parse_mode="Markdown"
-                    )
-                    return
-                
-                # Check if any changes were made
-                if (new_username == current_username and 
-                    new_pass_enc == current_pass_enc and 
-                    new_secret_enc == current_secret_enc and 
-                    new_slots == current_max_slots):
-                    await message.reply_text(
-                        "ℹ️ *هیچ تغییری اعمال نشد*",
-                        parse_mode="Markdown"
-                    )
-                    context.user_data.pop('edit_seat_id', None)
-                    context.user_data.pop('edit_return_page', None)
-                    return
-                
-                # Update the seat
-                cur.execute(
-                    "UPDATE seats SET email=%s, pass_enc=%s, secret_enc=%s, max_slots=%s WHERE id=%s",
-                    (new_username, new_pass_enc, new_secret_enc, new_slots, seat_id)
-                )
-                conn.commit()
-                
-                # Confirm success
-                await message.reply_text(
-                    f"✅ *ویرایش شد*\n\n"
-                    f"👤 نام کاربری: `{new_username}`\n"
-                    f"💺 صندلی‌ها: {new_slots}",
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data=f"admin:list|{return_page}")]
-                    ])
-                )
-                
-                # Clear edit mode
-                context.user_data.pop('edit_seat_id', None)
-                context.user_data.pop('edit_return_page', None)
+        # Handle slots conversion
+        try:
+            new_slots = int(slots) if slots != '-' else None
+        except ValueError:
+            await message.reply_text(
+                "❌ *خطا: تعداد صندلی باید یک عدد باشد*",
+                parse_mode="Markdown"
+            )
+            return
+        
+        # Validate username if it's changing
+        new_username = username if username != '-' else None
+        if new_username is not None and len(new_username.strip()) < 3:
+            await message.reply_text(
+                "❌ *خطا: نام کاربری باید حداقل ۳ کاراکتر باشد*",
+                parse_mode="Markdown"
+            )
+            return
+        
+        # Check if any changes were requested
+        if new_username is None and password == '-' and secret == '-' and new_slots is None:
+            await message.reply_text(
+                "ℹ️ *هیچ تغییری اعمال نشد*",
+                parse_mode="Markdown"
+            )
+            context.user_data.pop('edit_seat_id', None)
+            context.user_data.pop('edit_return_page', None)
+            return
+        
+        # Encrypt the new credentials before touching the database
+        new_pass_enc = await asyncio.to_thread(encrypt, password) if password != '-' else None
+        new_secret_enc = await asyncio.to_thread(encrypt, secret) if secret != '-' else None
+        
+        # Update the seat in a single round-trip
+        result = await asyncio.to_thread(
+            _db_update_seat, seat_id, new_username, new_pass_enc, new_secret_enc, new_slots
+        )
+        
+        if not result:
+            await message.reply_text(
+                f"❌ *خطا: صندلی شماره {seat_id} یافت نشد*",
+                parse_mode="Markdown"
+            )
+            context.user_data.pop('edit_seat_id', None)
+            context.user_data.pop('edit_return_page', None)
+            return
+        
+        cache.invalidate_seat(seat_id)
+        new_username, new_slots = result
+        
+        # Confirm success
+        await message.reply_text(
+            f"✅ *ویرایش شد*\n\n"
+            f"👤 نام کاربری: `{new_username}`\n"
+            f"💺 صندلی‌ها: {new_slots}",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data=f"admin:list|{return_page}")]
+            ])
+        )
+        
+        # Clear edit mode
+        context.user_data.pop('edit_seat_id', None)
+        context.user_data.pop('edit_return_page', None)
                 
     except Exception as e:
         logger.error(f"Error editing seat: {e}")
@@ -1447,7 +1752,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         text = update.message.text
         
         # Log the message
-        logger.info(f"Received message from {user_id}: {text}")
+        logger.info("Received message from %s: %s", user_id, text)
         
         # Check if we're in seat edit mode
         if 'edit_seat_id' in context.user_data:
@@ -1456,13 +1761,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
         # Check if we're expecting card info
         if context.user_data.get('awaiting_card_info', False):
-            from handlers import admin_cards
             await admin_cards.process_add_card(update, context)
             return
             
         # Check if we're expecting card edit info
         if 'edit_card_id' in context.user_data:
-            from handlers import admin_cards
             await admin_cards.process_edit_card(update, context)
             return
             
@@ -1481,240 +1784,237 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await message_handler(update, context)
 
 
-async def get_available_seat():
-    """Find an available seat where sold < max_slots."""
-    try:
-        with db.get_conn() as conn:
-            # Start a transaction with row locking
-            conn.autocommit = False
-            with conn.cursor() as cur:
-                # Find a seat with available slots
-                cur.execute(
-                    "SELECT id, email, pass_enc, secret_enc, max_slots, sold FROM seats "
-                    "WHERE status = 'active' AND sold < max_slots "
-                    "ORDER BY sold DESC LIMIT 1 FOR UPDATE"
-                )
-                result = cur.fetchone()
-                
-                if not result:
-                    conn.rollback()
-                    return None
-                    
-                seat_id, email, pass_enc, secret_enc, max_slots, sold = result
-                
-                # Increment sold count
-                cur.execute(
-                    "UPDATE seats SET sold = sold + 1 WHERE id = %s",
-                    (seat_id,)
-                )
-                
-                # Commit the transaction
-                conn.commit()
+def _db_take_available_seat(cur) -> Optional[dict]:
+    """
+    Claim one slot of an active seat where sold < max_slots and return the seat.
+    
+    Runs on the caller's cursor and doesn't commit, so the claim is part of the caller's
+    transaction and is undone if that transaction rolls back.
+    """
+    # Pick and increment a seat in one atomic statement; seats locked by a
+    # concurrent approval are skipped instead of waited for
+    db.execute_prepared(cur, "take_seat")
+    result = cur.fetchone()
+    
+    if not result:
+        return None
+    
+    seat_id, email, pass_enc, secret_enc, max_slots, sold = result
+    return {
+        "id": seat_id,
+        "email": email,
+        "pass_enc": pass_enc,
+        "secret_enc": secret_enc,
+        "max_slots": max_slots,
+        "sold": sold  # Already includes the increment
+    }
+
+
+def _db_approve_order(order_id: int) -> tuple:
+    """Assign a seat to an order and mark it approved. Returns (success, result or error message)."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Get and lock the order with its user and receipt in one round-trip; the status is
+            # checked here so two admins can't approve the same order at once
+            cur.execute(
+                "SELECT o.status, o.user_id, o.amount, o.utm_keyword, u.tg_id, u.referrer, r.channel_msg_id "
+                "FROM orders o "
+                "JOIN users u ON o.user_id = u.id "
+                "LEFT JOIN receipts r ON r.order_id = o.id "
+                "WHERE o.id = %s FOR UPDATE OF o",
+                (order_id,)
+            )
+            order = cur.fetchone()
+            
+            if not order:
+                logger.error(f"Order {order_id} not found in database")
+                return False, "خطا: سفارش یافت نشد"
+            
+            # If order exists but is not in pending or receipt status, give specific error
+            status = order[0]
+            if status not in ('pending', 'receipt'):
+                logger.error(f"Order {order_id} exists but status is '{status}', not 'pending' or 'receipt'")
+                return False, f"خطا: سفارش در وضعیت '{status}' است، نه قابل تایید"
                 
-                return {
-                    "id": seat_id,
-                    "email": email,
-                    "pass_enc": pass_enc,
-                    "secret_enc": secret_enc,
-                    "max_slots": max_slots,
-                    "sold": sold + 1  # Include the increment
+            _, user_id, amount, utm_keyword, tg_id, referrer_id, channel_msg_id = order
+            
+            # Claim a seat in the same transaction, so the slot is released again
+            # if the approval below fails
+            try:
+                seat = _db_take_available_seat(cur)
+            except Exception as e:
+                logger.error(f"Error getting available seat: {e}")
+                seat = None
+            if not seat:
+                logger.error(f"No available seats for order {order_id}")
+                conn.rollback()
+                return False, "خطا: هیچ صندلی خالی برای تخصیص وجود ندارد"
+            
+            # Process referral commission if user has a referrer (10% of the order)
+            commission = float(amount) * 0.10 if referrer_id is not None else 0
+            
+            # Approve the order, log it, credit the referrer and update the UTM stats
+            # in a single round-trip
+            cur.execute(
+                """WITH ord AS (
+                       UPDATE orders SET status = 'approved', seat_id = %(seat_id)s, approved_at = now()
+                       WHERE id = %(order_id)s
+                       RETURNING id
+                   ), lg AS (
+                       INSERT INTO order_log (order_id, event)
+                       SELECT id, 'Order approved' FROM ord
+                       UNION ALL
+                       SELECT id, %(referral_event)s FROM ord WHERE %(referrer_id)s IS NOT NULL
+                   ), ref AS (
+                       UPDATE wallets SET balance = balance + %(commission)s,
+                                          referral_earned = referral_earned + %(commission)s
+                       WHERE user_id = %(referrer_id)s
+                   ), utm AS (
+                       INSERT INTO utm_stats (keyword, buys, amount)
+                       SELECT %(utm_keyword)s, 1, %(amount)s WHERE %(utm_keyword)s IS NOT NULL
+                       ON CONFLICT (keyword) DO UPDATE
+                       SET buys = utm_stats.buys + 1, amount = utm_stats.amount + EXCLUDED.amount
+                   )
+                   SELECT id FROM ord""",
+                {
+                    "seat_id": seat["id"],
+                    "order_id": order_id,
+                    "referrer_id": referrer_id,
+                    "commission": commission,
+                    "referral_event": f"Referral commission of {commission} credited to user {referrer_id}",
+                    "utm_keyword": utm_keyword or None,
+                    "amount": amount,
                 }
-    except Exception as e:
-        logger.error(f"Error getting available seat: {e}")
-        try:
-            conn.rollback()
-        except:
-            pass
-        return None
+            )
+            
+            if referrer_id is not None:
+                logger.info(f"Credited referrer {referrer_id} with {commission} for order {order_id}")
+            
+            conn.commit()
+            
+            return True, {
+                "tg_id": tg_id,
+                "order_id": order_id,
+                "seat": seat,
+                "channel_msg_id": channel_msg_id
+            }
 
 
 async def approve_order(order_id):
     """Approve an order and assign a seat."""
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # First check if order exists at all
-                cur.execute(
-                    "SELECT status FROM orders WHERE id = %s",
-                    (order_id,)
-                )
-                order_check = cur.fetchone()
-                
-                if not order_check:
-                    logger.error(f"Order {order_id} not found in database")
-                    return False, "خطا: سفارش یافت نشد"
-                
-                # If order exists but is not in pending or receipt status, give specific error
-                if order_check[0] not in ('pending', 'receipt'):
-                    logger.error(f"Order {order_id} exists but status is '{order_check[0]}', not 'pending' or 'receipt'")
-                    return False, f"خطا: سفارش در وضعیت '{order_check[0]}' است، نه قابل تایید"
-                
-                # Get order details
-                cur.execute(
-                    "SELECT o.user_id, o.amount, o.utm_keyword, u.tg_id, u.referrer FROM orders o "
-                    "JOIN users u ON o.user_id = u.id "
-                    "WHERE o.id = %s AND o.status IN ('pending', 'receipt')",
-                    (order_id,)
-                )
-                order = cur.fetchone()
-                
-                if not order:
-                    logger.error(f"Order {order_id} not found or not in pending/receipt status")
-                    return False, "خطا: سفارش یافت نشد یا در وضعیت قابل تایید نیست"
-                    
-                user_id, amount, utm_keyword, tg_id, referrer_id = order
-                
-                # Get an available seat
-                seat = await get_available_seat()
-                if not seat:
-                    logger.error(f"No available seats for order {order_id}")
-                    return False, "خطا: هیچ صندلی خالی برای تخصیص وجود ندارد"
-                
-                # Update order status and assign seat
-                cur.execute(
-                    "UPDATE orders SET status = 'approved', seat_id = %s, approved_at = %s "
-                    "WHERE id = %s",
-                    (seat["id"], datetime.now(), order_id)
-                )
-                
-                # Log the approval
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (%s, %s)",
-                    (order_id, "Order approved")
-                )
-                
-                # Process referral commission if user has a referrer
-                if referrer_id is not None:
-                    # Calculate 10% commission
-                    commission = float(amount) * 0.10
-                    
-                    # Credit the referrer's wallet
-                    cur.execute(
-                        "UPDATE wallets SET balance = balance + %s, "
-                        "referral_earned = referral_earned + %s "
-                        "WHERE user_id = %s",
-                        (commission, commission, referrer_id)
-                    )
-                    
-                    # Log the referral commission
-                    logger.info(f"Credited referrer {referrer_id} with {commission} for order {order_id}")
-                    
-                    # Add a log entry for the referral commission
-                    cur.execute(
-                        "INSERT INTO order_log (order_id, event) VALUES (%s, %s)",
-                        (order_id, f"Referral commission of {commission} credited to user {referrer_id}")
-                    )
-                
-                # Update UTM stats if keyword exists
-                if utm_keyword:
-                    # Increment buys count
-                    db.inc_utm(utm_keyword, 'buys')
-                    # Increment amount
-                    db.inc_utm(utm_keyword, 'amount', amount)
-                
-                conn.commit()
-                
-                # Send sell report to LOG_SELL_CHID
-                if LOG_SELL_CHID:
-                    try:
-                        # Get seat details
-                        cur.execute(
-                            "SELECT email, pass_enc, secret_enc, max_slots, sold FROM seats WHERE id = %s",
-                            (seat["id"],)
-                        )
-                        seat_details = cur.fetchone()
-                        if seat_details:
-                            email, pass_enc, secret_enc, max_slots, sold = seat_details
-                            remaining_slots = max_slots - sold
-                            
-                            # Decrypt password and secret
-                            password = decrypt(pass_enc)
-                            secret = decrypt(secret_enc)
-                            
-                            # Get username if available
-                            cur.execute(
-                                "SELECT username FROM users WHERE id = %s",
-                                (user_id,)
-                            )
-                            username_result = cur.fetchone()
-                            username = username_result[0] if username_result else "نامشخص"
-                            
-                            # Create sell report message
-                            sell_report = (
-                                f"✅ گزارش فروش\n\n"
-                                f"اکانت ویندسکرایب یک ماهه برای کاربر @{username} ارسال شد\n\n"
-                                f"👤 نام کاربری: {email}\n"
-                                f"🔑 رمز عبور: {password}\n"
-                                f"🔐 کد 2FA اکانت: {secret}\n\n"
-                                f"💺 ظرفیت کل صندلی های باقی مانده: {remaining_slots}"
-                            )
-                            
-                            # Send sell report to LOG_SELL_CHID
-                            await context.bot.send_message(
-                                chat_id=LOG_SELL_CHID,
-                                text=sell_report
-                            )
-                    except Exception as e:
-                        logger.error(f"Error sending sell report to LOG_SELL_CHID: {e}")
-                
-                return True, {
-                    "tg_id": tg_id,
-                    "order_id": order_id,
-                    "seat": seat
-                }
+        return await asyncio.to_thread(_db_approve_order, order_id)
     except Exception as e:
         logger.error(f"Error approving order: {e}")
         return False, str(e)
 
 
+async def edit_query_message(query, text: str) -> None:
+    """
+    Replace the text of a callback query's message.
+    
+    Receipt messages are photos, so when the message has no text the result is shown
+    as an alert and written to the caption instead.
+    """
+    try:
+        await query.edit_message_text(text)
+    except telegram.error.BadRequest as e:
+        if "There is no text in the message to edit" not in str(e):
+            # For other BadRequest errors, just log and notify
+            logger.error(f"Error updating message of callback query: {e}")
+            await query.answer(MESSAGE_UPDATE_ERROR_TEXT, show_alert=True)
+            return
+        
+        await query.answer(text, show_alert=True)
+        try:
+            await query.edit_message_caption(text)
+        except Exception:
+            # If we can't edit caption either, just log it
+            logger.info(f"Could not edit message or caption: {text}")
+
+
+async def update_receipt_caption(bot, channel_msg_id: Optional[int], caption: str) -> None:
+    """
+    Replace the caption of an order's receipt in the receipt channel, if it was posted there.
+    
+    Goes through the outbox paced like the receipt posts themselves, and is meant to run
+    with spawn_background so the admin's button press doesn't wait for the channel.
+    """
+    if not channel_msg_id:
+        return
+    
+    for attempt in range(2):
+        try:
+            await outbox.send(
+                bot.edit_message_caption,
+                pace_chat=RECEIPT_CHANNEL_ID,
+                chat_id=RECEIPT_CHANNEL_ID,
+                message_id=channel_msg_id,
+                caption=caption,
+                parse_mode="Markdown"
+            )
+            return
+        except RetryAfter as e:
+            # The channel is rate limited; wait it out once, then give up
+            if attempt:
+                logger.error(f"Error updating receipt caption: {e}")
+                return
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Error updating receipt caption: {e}")
+            return
+
+
+def _db_reject_order(order_id: int) -> tuple:
+    """Mark an order rejected. Returns (success, {tg_id, channel_msg_id} or error message)."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Reject the order, log it and get the user's Telegram ID for notification
+            # and the receipt's channel message for its caption
+            cur.execute(
+                """WITH o AS (
+                       UPDATE orders SET status = 'rejected'
+                       FROM users u
+                       WHERE orders.id = %(order_id)s AND orders.status IN ('pending', 'receipt')
+                         AND u.id = orders.user_id
+                       RETURNING orders.id, u.tg_id
+                   ), l AS (
+                       INSERT INTO order_log (order_id, event)
+                       SELECT id, 'Order rejected' FROM o
+                   )
+                   SELECT o.tg_id, r.channel_msg_id FROM o
+                   LEFT JOIN receipts r ON r.order_id = o.id""",
+                {"order_id": order_id}
+            )
+            result = cur.fetchone()
+            conn.commit()
+            
+            if result:
+                return True, {"tg_id": result[0], "channel_msg_id": result[1]}
+            
+            # Nothing was updated; look at the order only to explain why
+            cur.execute(
+                "SELECT status FROM orders WHERE id = %s",
+                (order_id,)
+            )
+            order_check = cur.fetchone()
+            
+            if not order_check:
+                logger.error(f"Order {order_id} not found in database")
+                return False, "خطا: سفارش یافت نشد"
+            
+            # If order exists but is not in pending or receipt status, give specific error
+            if order_check[0] not in ('pending', 'receipt'):
+                logger.error(f"Order {order_id} exists but status is '{order_check[0]}', not 'pending' or 'receipt'")
+                return False, f"خطا: سفارش در وضعیت '{order_check[0]}' است، نه قابل رد"
+            
+            return False, "خطا: کاربر یافت نشد"
+
+
 async def reject_order(order_id):
     """Reject an order."""
     try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # First check if order exists at all
-                cur.execute(
-                    "SELECT status FROM orders WHERE id = %s",
-                    (order_id,)
-                )
-                order_check = cur.fetchone()
-                
-                if not order_check:
-                    logger.error(f"Order {order_id} not found in database")
-                    return False, "خطا: سفارش یافت نشد"
-                
-                # If order exists but is not in pending or receipt status, give specific error
-                if order_check[0] not in ('pending', 'receipt'):
-                    logger.error(f"Order {order_id} exists but status is '{order_check[0]}', not 'pending' or 'receipt'")
-                    return False, f"خطا: سفارش در وضعیت '{order_check[0]}' است، نه قابل رد"
-                
-                # Get user's Telegram ID for notification
-                cur.execute(
-                    "SELECT u.tg_id FROM users u JOIN orders o ON u.id = o.user_id "
-                    "WHERE o.id = %s",
-                    (order_id,)
-                )
-                result = cur.fetchone()
-                if not result:
-                    return False, "خطا: کاربر یافت نشد"
-                    
-                tg_id = result[0]
-                
-                # Update order status
-                cur.execute(
-                    "UPDATE orders SET status = 'rejected' WHERE id = %s",
-                    (order_id,)
-                )
-                
-                # Log the rejection
-                cur.execute(
-                    "INSERT INTO order_log (order_id, event) VALUES (%s, %s)",
-                    (order_id, "Order rejected")
-                )
-                
-                conn.commit()
-                
-                return True, tg_id
+        return await asyncio.to_thread(_db_reject_order, order_id)
     except Exception as e:
         logger.error(f"Error rejecting order: {e}")
         return False, str(e)
@@ -1729,180 +2029,193 @@ ADMIN_WAITING_PRICE = 5
 ADMIN_WAITING_EDIT_SEAT = 6
 
 
-async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show admin statistics."""
-    query = update.callback_query
+def _db_get_admin_stats() -> dict:
+    """Collect the figures shown on the admin statistics screen."""
+    # Get USD rate first; it may need its own connection, so not while holding this one
+    usd_rate = db.get_setting_int('usd_rate', 70000)  # Default 70,000 Toman per USD
     
-    try:
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                # Get USD rate with error handling
-                try:
-                    usd_rate = int(db.get_setting('usd_rate', '70000'))  # Default 70,000 Toman per USD
-                except:
-                    usd_rate = 70000
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # Totals in a single round-trip
+            cur.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM orders WHERE status = 'approved'),
+                    (SELECT COALESCE(SUM(amount), 0) FROM orders WHERE status = 'approved'),
+                    (SELECT COALESCE(SUM(sold), 0) FROM seats),
+                    (SELECT COALESCE(SUM(free_slots), 0) FROM seats WHERE status = 'active')
+            """)
+            total_users, approved_sales, total_amount, seats_sold, available_slots = cur.fetchone()
+            
+            # User registration statistics with error handling
+            users_today = 0
+            users_this_month = 0
+            
+            try:
+                # Check if joined_at column exists in users table
+                cur.execute("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = 'users' AND column_name = 'joined_at'
+                """)
+                has_joined_at = cur.fetchone() is not None
                 
-                # User registration statistics with error handling
+                if has_joined_at:
+                    # Users registered today
+                    cur.execute("""
+                        SELECT COUNT(*) 
+                        FROM users 
+                        WHERE DATE(joined_at) = CURRENT_DATE
+                    """)
+                    users_today = cur.fetchone()[0]
+                    
+                    # Users registered this month
+                    cur.execute("""
+                        SELECT COUNT(*) 
+                        FROM users 
+                        WHERE DATE(joined_at) >= DATE_TRUNC('month', CURRENT_DATE)
+                    """)
+                    users_this_month = cur.fetchone()[0]
+            
+            except Exception as user_error:
+                logger.error(f"Error getting user stats: {user_error}")
+                conn.rollback()
                 users_today = 0
                 users_this_month = 0
-                total_users = 0
+            
+            # Sales statistics with error handling
+            today_count, today_amount = 0, 0
+            week_count, week_amount = 0, 0
+            month_count, month_amount = 0, 0
+            
+            try:
+                # Check if created_at column exists in orders table
+                cur.execute("""
+                    SELECT column_name 
+                    FROM information_schema.columns 
+                    WHERE table_name = 'orders' AND column_name = 'created_at'
+                """)
+                has_orders_created_at = cur.fetchone() is not None
                 
-                try:
-                    # Check if joined_at column exists in users table
+                if has_orders_created_at:
+                    # Today's sales
                     cur.execute("""
-                        SELECT column_name 
-                        FROM information_schema.columns 
-                        WHERE table_name = 'users' AND column_name = 'joined_at'
+                        SELECT COUNT(*), COALESCE(SUM(amount), 0) 
+                        FROM orders 
+                        WHERE status = 'approved' 
+                        AND DATE(created_at) = CURRENT_DATE
                     """)
-                    has_joined_at = cur.fetchone() is not None
-                    
-                    if has_joined_at:
-                        # Users registered today
-                        cur.execute("""
-                            SELECT COUNT(*) 
-                            FROM users 
-                            WHERE DATE(joined_at) = CURRENT_DATE
-                        """)
-                        users_today = cur.fetchone()[0]
-                        
-                        # Users registered this month
-                        cur.execute("""
-                            SELECT COUNT(*) 
-                            FROM users 
-                            WHERE DATE(joined_at) >= DATE_TRUNC('month', CURRENT_DATE)
-                        """)
-                        users_this_month = cur.fetchone()[0]
+                    today_count, today_amount = cur.fetchone()
+                    today_amount = today_amount or 0
                     
-                    # Total users
-                    cur.execute("SELECT COUNT(*) FROM users")
-                    total_users = cur.fetchone()[0]
-                    
-                except Exception as user_error:
-                    logger.error(f"Error getting user stats: {user_error}")
-                    # Fallback to just total users
-                    cur.execute("SELECT COUNT(*) FROM users")
-                    total_users = cur.fetchone()[0]
-                    users_today = 0
-                    users_this_month = 0
-                
-                # Get approved sales count
-                cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'approved'")
-                approved_sales = cur.fetchone()[0]
-                
-                # Get seats sold
-                cur.execute("SELECT SUM(sold) FROM seats")
-                seats_sold = cur.fetchone()[0] or 0
-                
-                # Get available seats
-                cur.execute("SELECT SUM(max_slots - sold) FROM seats WHERE status = 'active'")
-                available_slots = cur.fetchone()[0] or 0
-                
-                # Sales statistics with error handling
-                today_count, today_amount = 0, 0
-                week_count, week_amount = 0, 0
-                month_count, month_amount = 0, 0
-                total_amount = 0
-                
-                try:
-                    # Check if created_at column exists in orders table
+                    # This week's sales (current week)
                     cur.execute("""
-                        SELECT column_name 
-                        FROM information_schema.columns 
-                        WHERE table_name = 'orders' AND column_name = 'created_at'
+                        SELECT COUNT(*), COALESCE(SUM(amount), 0) 
+                        FROM orders 
+                        WHERE status = 'approved' 
+                        AND DATE(created_at) >= DATE_TRUNC('week', CURRENT_DATE)
                     """)
-                    has_orders_created_at = cur.fetchone() is not None
-                    
-                    if has_orders_created_at:
-                        # Today's sales
-                        cur.execute("""
-                            SELECT COUNT(*), COALESCE(SUM(amount), 0) 
-                            FROM orders 
-                            WHERE status = 'approved' 
-                            AND DATE(created_at) = CURRENT_DATE
-                        """)
-                        today_count, today_amount = cur.fetchone()
-                        today_amount = today_amount or 0
-                        
-                        # This week's sales (current week)
-                        cur.execute("""
-                            SELECT COUNT(*), COALESCE(SUM(amount), 0) 
-                            FROM orders 
-                            WHERE status = 'approved' 
-                            AND DATE(created_at) >= DATE_TRUNC('week', CURRENT_DATE)
-                        """)
-                        week_count, week_amount = cur.fetchone()
-                        week_amount = week_amount or 0
-                        
-                        # This month's sales
-                        cur.execute("""
-                            SELECT COUNT(*), COALESCE(SUM(amount), 0) 
-                            FROM orders 
-                            WHERE status = 'approved' 
-                            AND DATE(created_at) >= DATE_TRUNC('month', CURRENT_DATE)
-                        """)
-                        month_count, month_amount = cur.fetchone()
-                        month_amount = month_amount or 0
-                    
-                    # Total sales
-                    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM orders WHERE status = 'approved'")
-                    total_amount = cur.fetchone()[0] or 0
-                    
-                except Exception as sales_error:
-                    logger.error(f"Error getting sales stats: {sales_error}")
-                    # Fallback to just total amount
-                    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM orders WHERE status = 'approved'")
-                    total_amount = cur.fetchone()[0] or 0
-                
-                # Convert to USD
-                today_usd = today_amount / usd_rate if usd_rate > 0 else 0
-                week_usd = week_amount / usd_rate if usd_rate > 0 else 0
-                month_usd = month_amount / usd_rate if usd_rate > 0 else 0
-                total_usd = total_amount / usd_rate if usd_rate > 0 else 0
-                
-                # Format statistics message
-                stats_message = (
-                    f"📊 *آمار سیستم*\n\n"
-                    f"👤 *کاربران:*\n"
-                    f"├ امروز: {users_today:,}\n"
-                    f"├ این ماه: {users_this_month:,}\n"
-                    f"└ کل: {total_users:,}\n\n"
-                    
-                    f"💺 صندلی‌های فروخته: *{int(seats_sold):,}*\n"
-                    f"💿 ظرفیت باقیمانده: *{int(available_slots):,}*\n\n"
-                    
-                    f"💰 *فروش امروز:*\n"
-                    f"├ تعداد: {today_count:,}\n"
-                    f"├ تومان: {today_amount:,}\n"
-                    f"└ دلار: ${today_usd:.2f}\n\n"
-                    
-                    f"📅 *فروش هفته:*\n"
-                    f"├ تعداد: {week_count:,}\n"
-                    f"├ تومان: {week_amount:,}\n"
-                    f"└ دلار: ${week_usd:.2f}\n\n"
+                    week_count, week_amount = cur.fetchone()
+                    week_amount = week_amount or 0
                     
-                    f"📆 *فروش این ماه:*\n"
-                    f"├ تعداد: {month_count:,}\n"
-                    f"├ تومان: {month_amount:,}\n"
-                    f"└ دلار: ${month_usd:.2f}\n\n"
-                    
-                    f"🏆 *فروش کل:*\n"
-                    f"├ تعداد: {approved_sales:,}\n"
-                    f"├ تومان: {total_amount:,}\n"
-                    f"└ دلار: ${total_usd:.2f}\n\n"
-                    
-                    f"💱 نرخ دلار: {usd_rate:,} تومان"
-                )
-                
-                # Send statistics
-                await query.edit_message_text(
-                    stats_message,
-                    reply_markup=get_admin_keyboard(),
-                    parse_mode="Markdown"
-                )
+                    # This month's sales
+                    cur.execute("""
+                        SELECT COUNT(*), COALESCE(SUM(amount), 0) 
+                        FROM orders 
+                        WHERE status = 'approved' 
+                        AND DATE(created_at) >= DATE_TRUNC('month', CURRENT_DATE)
+                    """)
+                    month_count, month_amount = cur.fetchone()
+                    month_amount = month_amount or 0
+            
+            except Exception as sales_error:
+                logger.error(f"Error getting sales stats: {sales_error}")
+                conn.rollback()
+            
+            return {
+                "usd_rate": usd_rate,
+                "users_today": users_today,
+                "users_this_month": users_this_month,
+                "total_users": total_users,
+                "approved_sales": approved_sales,
+                "seats_sold": seats_sold,
+                "available_slots": available_slots,
+                "today_count": today_count,
+                "today_amount": today_amount,
+                "week_count": week_count,
+                "week_amount": week_amount,
+                "month_count": month_count,
+                "month_amount": month_amount,
+                "total_amount": total_amount,
+            }
+
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show admin statistics."""
+    query = update.callback_query
+    
+    try:
+        stats = await asyncio.to_thread(_db_get_admin_stats)
+        usd_rate = stats["usd_rate"]
+        users_today = stats["users_today"]
+        users_this_month = stats["users_this_month"]
+        total_users = stats["total_users"]
+        approved_sales = stats["approved_sales"]
+        seats_sold = stats["seats_sold"]
+        available_slots = stats["available_slots"]
+        today_count, today_amount = stats["today_count"], stats["today_amount"]
+        week_count, week_amount = stats["week_count"], stats["week_amount"]
+        month_count, month_amount = stats["month_count"], stats["month_amount"]
+        total_amount = stats["total_amount"]
+        
+        # Convert to USD
+        today_usd = today_amount / usd_rate if usd_rate > 0 else 0
+        week_usd = week_amount / usd_rate if usd_rate > 0 else 0
+        month_usd = month_amount / usd_rate if usd_rate > 0 else 0
+        total_usd = total_amount / usd_rate if usd_rate > 0 else 0
+        
+        # Format statistics message
+        stats_message = (
+            f"📊 *آمار سیستم*\n\n"
+            f"👤 *کاربران:*\n"
+            f"├ امروز: {users_today:,}\n"
+            f"├ این ماه: {users_this_month:,}\n"
+            f"└ کل: {total_users:,}\n\n"
+            
+            f"💺 صندلی‌های فروخته: *{int(seats_sold):,}*\n"
+            f"💿 ظرفیت باقیمانده: *{int(available_slots):,}*\n\n"
+            
+            f"💰 *فروش امروز:*\n"
+            f"├ تعداد: {today_count:,}\n"
+            f"├ تومان: {today_amount:,}\n"
+            f"└ دلار: ${today_usd:.2f}\n\n"
+            
+            f"📅 *فروش هفته:*\n"
+            f"├ تعداد: {week_count:,}\n"
+            f"├ تومان: {week_amount:,}\n"
+            f"└ دلار: ${week_usd:.2f}\n\n"
+            
+            f"📆 *فروش این ماه:*\n"
+            f"├ تعداد: {month_count:,}\n"
+            f"├ تومان: {month_amount:,}\n"
+            f"└ دلار: ${month_usd:.2f}\n\n"
+            
+            f"🏆 *فروش کل:*\n"
+            f"├ تعداد: {approved_sales:,}\n"
+            f"├ تومان: {total_amount:,}\n"
+            f"└ دلار: ${total_usd:.2f}\n\n"
+            
+            f"💱 نرخ دلار: {usd_rate:,} تومان"
+        )
+        
+        # Send statistics
+        await query.edit_message_text(
+            stats_message,
+            reply_markup=get_admin_keyboard(),
+            parse_mode="Markdown"
+        )
     except Exception as e:
-        logger.error(f"Error getting admin stats: {e}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error getting admin stats: %s", e)
         await query.edit_message_text(
             f"خطا در دریافت آمار: {str(e)[:100]}",
             reply_markup=get_admin_keyboard()
@@ -1914,7 +2227,7 @@ async def handle_admin_card(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     
     # Get current card number
-    current_card = db.get_setting('card_number', CARD_NUMBER)
+    current_card = await asyncio.to_thread(db.get_setting, 'card_number', CARD_NUMBER)
     
     await query.edit_message_text(
         f"💳 *تغییر شماره کارت*\n\n"
@@ -1936,11 +2249,11 @@ async def handle_admin_usd_rate(update: Update, context: ContextTypes.DEFAULT_TY
     logger.info(f"handle_admin_usd_rate called for user {update.effective_user.id}")
     
     # Get current USD rate
-    current_rate = db.get_setting('usd_rate', '0')
+    current_rate = await asyncio.to_thread(db.get_setting_int, 'usd_rate', 0)
     
     await query.edit_message_text(
         f"💲 *تغییر نرخ دلار*\n\n"
-        f"نرخ فعلی دلار: `{current_rate} تومان`\n\n"
+        f"نرخ فعلی دلار: `{current_rate:,} تومان`\n\n"
         f"لطفا نرخ جدید دلار را به تومان وارد کنید:",
         parse_mode="Markdown"
     )
@@ -2002,6 +2315,102 @@ async def handle_bulk_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ADMIN_WAITING_CSV
 
 
+# Seats decrypted per chunk when exporting the CSV list
+CSV_EXPORT_CHUNK_SIZE = 500
+
+# Characters that force a CSV field to be quoted (same rule as csv.QUOTE_MINIMAL)
+_CSV_SPECIAL_CHARS = frozenset(',"\r\n')
+
+
+def _csv_field(value: str) -> str:
+    """Quote a CSV field only when it contains a delimiter, quote or line break."""
+    if _CSV_SPECIAL_CHARS.isdisjoint(value):
+        return value
+    return '"' + value.replace('"', '""') + '"'
+
+
+class _SeatsCsvSink:
+    """
+    Write target for COPY (email, pass token, secret token, free_slots) TO STDOUT in CSV format.
+    
+    Postgres already emits the username CSV-quoted; the two token columns are decrypted
+    per chunk of records and written out as the final seats CSV rows.
+    """
+    
+    def __init__(self, out):
+        self.out = out
+        self._partial = b""
+        self._records = []
+    
+    def write(self, data: bytes) -> None:
+        # copy_expert hands over arbitrary chunks; only complete records are processed
+        pieces = (self._partial + data).split(b"\n")
+        tail = pieces.pop()
+        record = b""
+        for piece in pieces:
+            record += piece
+            if record.count(b'"') % 2:
+                # Line break inside a quoted username, the record continues
+                record += b"\n"
+                continue
+            self._records.append(record)
+            record = b""
+        self._partial = record + tail
+        
+        if len(self._records) >= CSV_EXPORT_CHUNK_SIZE:
+            self.flush()
+    
+    def flush(self) -> None:
+        if not self._records:
+            return
+        
+        # Tokens and slot counts never need quoting, so split from the right
+        fields = [record.rsplit(b",", 3) for record in self._records]
+        self._records = []
+        
+        # Decrypt the chunk's passwords and secrets in one batch each
+        passwords = decrypt_many(field[1] for field in fields)
+        secrets = decrypt_many(field[2] for field in fields)
+        
+        self.out.write("".join(
+            f"{field[0].decode()},{_csv_field(password)},{_csv_field(secret)},{field[3].decode()}\r\n"
+            for field, password, secret in zip(fields, passwords, secrets)
+        ).encode())
+
+
+def _db_write_seats_csv(csv_file) -> tuple:
+    """
+    Write the active seats with decrypted credentials as gzip-compressed CSV into a binary file.
+    Returns (seat_count, total_free_slots).
+    """
+    with gzip.GzipFile(fileobj=csv_file, mode="wb", compresslevel=6) as gz, db.get_conn() as conn:
+        # Header uses the same \r\n line ending as the rows
+        gz.write(b"username,password,secret,free_slots\r\n")
+        
+        with conn.cursor() as cur:
+            # Totals come from Postgres up front, so the row path only writes
+            cur.execute(
+                "SELECT COUNT(*), COALESCE(SUM(free_slots), 0) "
+                "FROM seats WHERE status='active'"
+            )
+            seat_count, total_free_slots = cur.fetchone()
+            
+            # Postgres formats and streams the rows; tokens are ASCII so they go out as text.
+            # Database still uses 'email' field, but content is username
+            sink = _SeatsCsvSink(gz)
+            cur.copy_expert(
+                "COPY (SELECT email, convert_from(pass_enc, 'UTF8'), convert_from(secret_enc, 'UTF8'), free_slots "
+                "FROM seats WHERE status='active') TO STDOUT WITH (FORMAT csv)",
+                sink
+            )
+            sink.flush()
+        
+        # End the read-only transaction
+        conn.rollback()
+    
+    return seat_count, total_free_slots
+
+
 async def handle_list_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate and send a CSV file with active seat information."""
     query = update.callback_query
@@ -2020,62 +2429,34 @@ async def handle_list_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             parse_mode="Markdown"
         )
         
-        # Get all active seats with available slots
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT email, pass_enc, secret_enc, max_slots-sold AS free_slots "
-                    "FROM seats WHERE status='active'"
-                )
-                seats = cur.fetchall()
-                
-                # Calculate total free slots
-                total_free_slots = sum(seat[3] for seat in seats)
-        
-        # Generate CSV file
-        import io
-        import csv
-        from datetime import datetime
-        
-        # Create CSV in memory
-        csv_buffer = io.StringIO()
-        csv_writer = csv.writer(csv_buffer)
-        
-        # Write header
-        csv_writer.writerow(['username', 'password', 'secret', 'free_slots'])
-        
-        # Write data rows
-        for seat in seats:
-            username = seat[0]  # Database still uses 'email' field, but content is username
-            password = decrypt_secret(seat[1])  # Decrypt password
-            secret = decrypt_secret(seat[2])    # Decrypt secret
-            free_slots = seat[3]
-            
-            csv_writer.writerow([username, password, secret, free_slots])
-        
-        # Get the CSV content
-        csv_content = csv_buffer.getvalue()
-        csv_buffer.close()
-        
-        # Create a bytes buffer from the CSV content
-        bytes_buffer = io.BytesIO(csv_content.encode('utf-8'))
+        # Stream CSV rows into a spooled file so large exports are not buffered in memory
+        csv_spool = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE, mode='w+b')
+        try:
+            seat_count, total_free_slots = await asyncio.to_thread(_db_write_seats_csv, csv_spool)
+        except Exception:
+            csv_spool.close()
+            raise
+        csv_spool.seek(0)
         
         # Generate filename with current date
         current_date = datetime.now().strftime("%Y%m%d")
-        filename = f"seats_{current_date}.csv"
+        filename = f"seats_{current_date}.csv.gz"
         
         # Send the CSV file
-        await context.bot.send_document(
-            chat_id=user.id,
-            document=bytes_buffer,
-            filename=filename,
-            caption=f"صندلی خالی: {total_free_slots}"
-        )
+        try:
+            await context.bot.send_document(
+                chat_id=user.id,
+                document=csv_spool,
+                filename=filename,
+                caption=f"صندلی خالی: {total_free_slots}"
+            )
+        finally:
+            csv_spool.close()
         
         # Update status message
         await status_msg.edit_text(
             f"✅ *لیست اکانت‌ها با موفقیت ارسال شد*\n\n"
-            f"🗂️ تعداد کل اکانت‌ها: {len(seats)}\n"
+            f"🗂️ تعداد کل اکانت‌ها: {seat_count}\n"
             f"💺 صندلی‌های خالی: {total_free_slots}",
             parse_mode="Markdown",
             reply_markup=get_admin_keyboard()
@@ -2090,6 +2471,45 @@ async def handle_list_csv(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=get_admin_keyboard()
         )
 
+UTM_TABLE_HEADERS = ("Keyword", "Starts", "Buys", "Amount (T)")
+
+
+def format_utm_table(rows: List[Tuple[str, str, str, str]]) -> str:
+    """
+    Render UTM stats rows as a monospace grid: keyword left-aligned, numbers right-aligned.
+    The last row is treated as the totals row and set apart by a border.
+    """
+    widths = [len(header) for header in UTM_TABLE_HEADERS]
+    for row in rows:
+        for j, cell in enumerate(row):
+            if len(cell) > widths[j]:
+                widths[j] = len(cell)
+    
+    border = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+    
+    def format_row(row):
+        keyword, *numbers = row
+        cells = [keyword.ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in zip(numbers, widths[1:])]
+        return "| " + " | ".join(cells) + " |"
+    
+    lines = [border, format_row(UTM_TABLE_HEADERS), border.replace("-", "=")]
+    lines += [format_row(row) for row in rows[:-1]]
+    lines += [border, format_row(rows[-1]), border]
+    return "\n".join(lines)
+
+
+def _db_get_utm_stats() -> list:
+    """Read the UTM stats rows (keyword, starts, buys, amount), most started first."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT keyword, starts, buys, amount "
+                "FROM utm_stats ORDER BY starts DESC"
+            )
+            return cur.fetchall()
+
+
 async def handle_utm_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show UTM tracking statistics."""
     query = update.callback_query
@@ -2103,13 +2523,7 @@ async def handle_utm_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     try:
         # Fetch UTM stats from database
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT keyword, starts, buys, amount "
-                    "FROM utm_stats ORDER BY starts DESC"
-                )
-                utm_stats = cur.fetchall()
+        utm_stats = await asyncio.to_thread(_db_get_utm_stats)
         
         if not utm_stats:
             # No stats available
@@ -2121,9 +2535,6 @@ async def handle_utm_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             )
             return
         
-        # Format stats using tabulate in English
-        headers = ["Keyword", "Starts", "Buys", "Amount (T)"]
-        
         # Format the data for better readability
         formatted_data = []
         total_starts = 0
@@ -2131,25 +2542,25 @@ async def handle_utm_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         total_amount = 0
         
         for keyword, starts, buys, amount in utm_stats:
-            formatted_data.append([
+            formatted_data.append((
                 keyword,
                 f"{starts:,}",
                 f"{buys:,}",
                 f"{amount:,}"
-            ])
+            ))
             total_starts += starts
             total_buys += buys
             total_amount += amount
         
         # Add totals row
-        formatted_data.append([
+        formatted_data.append((
             "TOTAL",
             f"{total_starts:,}",
             f"{total_buys:,}",
             f"{total_amount:,}"
-        ])
+        ))
         
-        table = tabulate(formatted_data, headers=headers, tablefmt="grid")
+        table = format_utm_table(formatted_data)
         
         # Calculate conversion rate
         conversion_rate = (total_buys / total_starts * 100) if total_starts > 0 else 0
@@ -2195,7 +2606,7 @@ async def handle_change_price(update: Update, context: ContextTypes.DEFAULT_TYPE
         return -1
     
     # Get current price
-    current_price = int(db.get_setting('one_month_price', '70000'))
+    current_price = await asyncio.to_thread(db.get_setting_int, 'one_month_price', 70000)
     
     # Set the awaiting flag and price type
     context.user_data['awaiting_price'] = True
@@ -2219,6 +2630,200 @@ async def process_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     return await handle_price_input(update, context)
 
 
+# Seats inserted per statement/commit during a CSV import
+CSV_IMPORT_BATCH_SIZE = 500
+
+# Minimum seconds between import progress edits of the status message
+CSV_STATUS_INTERVAL = 2.0
+
+# Import errors listed in the final report; further errors are only counted
+CSV_ERRORS_SHOWN = 5
+
+# Columns every imported seat row must fill
+CSV_REQUIRED_FIELDS = ('username', 'password', 'secret')
+
+# Bytes of an uploaded CSV inspected to pick its text encoding
+CSV_ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+def _detect_csv_encoding(sample: bytes) -> str:
+    """
+    Pick the text encoding of an uploaded CSV from its first bytes.
+    BOMs win; otherwise UTF-8 if the sample decodes, else latin-1 (never fails).
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    
+    try:
+        # Incremental decode so a character cut at the sample boundary is not an error
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def _db_insert_seats(conn, rows) -> int:
+    """
+    Insert a batch of (email, pass_enc, secret_enc, max_slots) seats in one statement
+    and commit it on the given connection; a failed batch is rolled back.
+    Existing emails are skipped; returns the number of seats actually inserted.
+    """
+    try:
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """INSERT INTO seats (email, pass_enc, secret_enc, max_slots)
+                   VALUES %s
+                   ON CONFLICT (email) DO NOTHING
+                   RETURNING email""",
+                rows,
+                page_size=len(rows),
+                fetch=True
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(inserted)
+
+
+def _ingest_seats_csv(csv_file, encoding: str, report_progress) -> Dict[str, Any]:
+    """
+    Parse a seats CSV (binary file object), then encrypt and insert the seats in batches.
+    Runs in a worker thread; report_progress(stats) is called with a snapshot of
+    the counters at most once per CSV_STATUS_INTERVAL seconds. Returns the final import stats.
+    """
+    stats = {
+        "total_rows": 0,
+        "success_count": 0,
+        "duplicate_count": 0,
+        "error_count": 0,
+        "errors": [],
+        "extra_errors": 0,
+    }
+    
+    def add_error(message):
+        # Only the first few errors are shown, the rest are just counted
+        if len(stats["errors"]) < CSV_ERRORS_SHOWN:
+            stats["errors"].append(message)
+        else:
+            stats["extra_errors"] += 1
+    
+    # Valid rows are buffered and inserted in batches
+    pending = []
+    next_report = time.monotonic() + CSV_STATUS_INTERVAL
+    
+    def flush_pending():
+        if not pending:
+            return
+        first_row, last_row = pending[0][0], pending[-1][0]
+        try:
+            pass_encs = encrypt_many(row[2] for row in pending)
+            secret_encs = encrypt_many(row[3] for row in pending)
+            rows = [
+                (row[1], pass_enc, secret_enc, row[4])
+                for row, pass_enc, secret_enc in zip(pending, pass_encs, secret_encs)
+            ]
+            inserted = _db_insert_seats(conn, rows)
+            stats["success_count"] += inserted
+            stats["duplicate_count"] += len(rows) - inserted
+            logger.info(f"Added {inserted} seats from CSV rows {first_row}-{last_row}")
+        except Exception as batch_error:
+            logger.error(f"Error inserting CSV rows {first_row}-{last_row}, retrying row by row: {batch_error}")
+            insert_rows_individually()
+        pending.clear()
+    
+    def insert_rows_individually():
+        # Isolates the offending row(s) of a failed batch; each row commits on its own
+        for row_number, username, password, secret, max_slots in pending:
+            try:
+                inserted = _db_insert_seats(conn, [(username, encrypt(password), encrypt(secret), max_slots)])
+                if inserted:
+                    stats["success_count"] += 1
+                else:
+                    stats["duplicate_count"] += 1
+            except Exception as row_error:
+                stats["error_count"] += 1
+                error_str = str(row_error)[:100]
+                add_error(f"Row {row_number}: {error_str}")
+                logger.error(f"Error inserting CSV row {row_number}: {error_str}")
+    
+    # Read and process the file with the correct encoding, reusing one connection for all batches
+    csv_file.seek(0)
+    csv_text = io.TextIOWrapper(csv_file, encoding=encoding, newline='')
+    with db.get_conn() as conn:
+        # Plain csv.reader with column positions taken from the (already validated) header
+        reader = csv.reader(csv_text)
+        header = next(reader, [])
+        field_indexes = [header.index(field) for field in CSV_REQUIRED_FIELDS]
+        slots_index = header.index('slots') if 'slots' in header else None
+        row_width = max(field_indexes + [slots_index or 0]) + 1
+        
+        # Blank lines are skipped, as DictReader did
+        for i, row in enumerate(filter(None, reader), 1):
+            stats["total_rows"] = i
+            try:
+                # Short rows read as empty cells
+                if len(row) < row_width:
+                    row += [''] * (row_width - len(row))
+                
+                # Extract data with detailed validation
+                values = [row[index].strip() for index in field_indexes]
+                if not all(values):
+                    stats["error_count"] += 1
+                    add_error(f"Row {i}: Missing {CSV_REQUIRED_FIELDS[values.index('')]}")
+                    continue
+                
+                username, password, secret = values
+                
+                # Validate username (should be at least 3 characters)
+                if len(username) < 3:
+                    stats["error_count"] += 1
+                    add_error(f"Row {i}: Username too short")
+                    continue
+                
+                # Username validation passed - no email format required
+                
+                # Get slots (optional); checked up front instead of catching int() failures
+                max_slots = 15  # Default value
+                slots = row[slots_index].strip() if slots_index is not None else ''
+                digits = slots[1:] if slots[:1] in ('-', '+') else slots
+                if digits.isdecimal():
+                    max_slots = int(slots)
+                    if max_slots < 1:
+                        stats["error_count"] += 1
+                        add_error(f"Row {i}: Slots must be at least 1")
+                        continue
+                elif slots:
+                    # Use default if conversion fails
+                    add_error(f"Row {i}: Invalid slots value, using default")
+                
+                # Credentials are encrypted per batch when it is flushed
+                pending.append((i, username, password, secret, max_slots))
+            except Exception as row_error:
+                stats["error_count"] += 1
+                error_str = str(row_error)[:100]
+                add_error(f"Row {i}: {error_str}")
+                logger.error(f"Error processing row {i}: {error_str}")
+            
+            if len(pending) >= CSV_IMPORT_BATCH_SIZE:
+                flush_pending()
+            
+            # Report progress at most once per CSV_STATUS_INTERVAL seconds
+            now = time.monotonic()
+            if now >= next_report:
+                report_progress(dict(stats, errors=None))
+                next_report = now + CSV_STATUS_INTERVAL
+        
+        flush_pending()
+    
+    # Leave the underlying file open; the handler closes it
+    csv_text.detach()
+    return stats
+
+
 async def process_csv_upload_direct(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process the uploaded CSV file for bulk seat import directly."""
     message = update.message
@@ -2246,59 +2851,46 @@ async def process_csv_upload_direct(update: Update, context: ContextTypes.DEFAUL
         parse_mode="Markdown"
     )
     
-    csv_file_path = f"temp_{message.message_id}.csv"
+    # Small uploads stay in memory; large ones roll over to a temp file
+    csv_file = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE, mode='w+b')
     
     try:
         # Download the file
         file = await context.bot.get_file(document.file_id)
-        await file.download_to_drive(csv_file_path)
+        await file.download_to_memory(csv_file)
         
         await status_msg.edit_text(
             "✅ *فایل با موفقیت دانلود شد، در حال پردازش...*",
             parse_mode="Markdown"
         )
         
-        # Process CSV
-        success_count = 0
-        duplicate_count = 0
-        error_count = 0
-        errors = []
+        # Sniff the encoding once from the first bytes, then read the header with it
+        csv_file.seek(0)
+        working_encoding = _detect_csv_encoding(csv_file.read(CSV_ENCODING_SAMPLE_SIZE))
         
-        # Try opening with different encodings to find the correct one
-        encodings = ['utf-8', 'latin-1', 'cp1256']
-        working_encoding = None
         header_fields = None
+        csv_file.seek(0)
+        csv_text = io.TextIOWrapper(csv_file, encoding=working_encoding, newline='')
+        try:
+            header_fields = csv.DictReader(csv_text).fieldnames
+        except Exception as enc_error:
+            logger.error(f"Error reading CSV header with encoding {working_encoding}: {enc_error}")
+        finally:
+            csv_text.detach()
         
-        # First find the correct encoding and read headers
-        for encoding in encodings:
-            try:
-                with open(csv_file_path, 'r', newline='', encoding=encoding) as csvfile:
-                    test_reader = csv.DictReader(csvfile)
-                    # Test reading headers to verify encoding
-                    header_fields = test_reader.fieldnames
-                    if header_fields:  # Successfully parsed headers
-                        working_encoding = encoding
-                        break
-            except Exception as enc_error:
-                logger.error(f"Error with encoding {encoding}: {enc_error}")
-                continue
-        
-        if not working_encoding or not header_fields:
+        if not header_fields:
             await status_msg.edit_text(
                 "❌ *خطا در خواندن فایل CSV: فرمت فایل نامعتبر است*",
                 parse_mode="Markdown",
                 reply_markup=get_admin_keyboard()
             )
-            if os.path.exists(csv_file_path):
-                os.remove(csv_file_path)
             return
         
         # Log the fieldnames for debugging
         logger.info(f"CSV fieldnames: {header_fields}")
         
         # Verify required columns
-        required_fields = ['username', 'password', 'secret']
-        missing_fields = [field for field in required_fields if field not in header_fields]
+        missing_fields = [field for field in CSV_REQUIRED_FIELDS if field not in header_fields]
         
         if missing_fields:
             await status_msg.edit_text(
@@ -2307,103 +2899,46 @@ async def process_csv_upload_direct(update: Update, context: ContextTypes.DEFAUL
                 parse_mode="Markdown",
                 reply_markup=get_admin_keyboard()
             )
-            if os.path.exists(csv_file_path):
-                os.remove(csv_file_path)
             return
         
-        # Now process rows with the correct encoding
-        total_rows = 0
+        # Parse and insert the rows in a worker thread; progress snapshots come back
+        # through a queue so the status message can be updated from the event loop
+        loop = asyncio.get_running_loop()
+        progress_queue = asyncio.Queue()
+        ingest_task = asyncio.ensure_future(asyncio.to_thread(
+            _ingest_seats_csv,
+            csv_file,
+            working_encoding,
+            lambda snapshot: loop.call_soon_threadsafe(progress_queue.put_nowait, snapshot)
+        ))
         
-        # Read and process the file with the correct encoding
-        with open(csv_file_path, 'r', newline='', encoding=working_encoding) as csvfile:
-            reader = csv.DictReader(csvfile)
-            
-            for i, row in enumerate(reader, 1):
-                total_rows = i
-                try:
-                    # Extract data with detailed validation
-                    if 'username' not in row or not row['username'].strip():
-                        error_count += 1
-                        errors.append(f"Row {i}: Missing username")
-                        continue
-                        
-                    if 'password' not in row or not row['password'].strip():
-                        error_count += 1
-                        errors.append(f"Row {i}: Missing password")
-                        continue
-                        
-                    if 'secret' not in row or not row['secret'].strip():
-                        error_count += 1
-                        errors.append(f"Row {i}: Missing secret")
-                        continue
-                    
-                    username = row['username'].strip()
-                    password = row['password'].strip()
-                    secret = row['secret'].strip()
-                    
-                    # Validate username (should be at least 3 characters)
-                    if len(username.strip()) < 3:
-                        error_count += 1
-                        errors.append(f"Row {i}: Username too short")
-                        continue
-                    
-                    # Username validation passed - no email format required
-                    
-                    # Get slots (optional)
-                    max_slots = 15  # Default value
-                    if 'slots' in row and row['slots'] and row['slots'].strip():
-                        try:
-                            max_slots = int(row['slots'].strip())
-                            if max_slots <= 0:
-                                max_slots = 15
-                        except ValueError:
-                            # Use default if conversion fails
-                            errors.append(f"Row {i}: Invalid slots value, using default")
-                            max_slots = 15
-                    
-                    # Encrypt credentials
-                    pass_enc = encrypt(password)
-                    secret_enc = encrypt(secret)
-                    
-                    # Insert into database
-                    with db.get_conn() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute(
-                                """INSERT INTO seats (email, pass_enc, secret_enc, max_slots)
-                                   VALUES (%s, %s, %s, %s)
-                                   ON CONFLICT (email) DO NOTHING
-                                   RETURNING id""",
-                                (username, pass_enc, secret_enc, max_slots)
-                            )
-                            result = cur.fetchone()
-                            conn.commit()
-                            
-                            if result is None or cur.rowcount == 0:
-                                # Username already exists
-                                duplicate_count += 1
-                            else:
-                                success_count += 1
-                                logger.info(f"Added seat: {username}")
-                                
-                except Exception as row_error:
-                    error_count += 1
-                    error_str = str(row_error)[:100]
-                    errors.append(f"Row {i}: {error_str}")
-                    logger.error(f"Error processing row {i}: {error_str}")
-                
-                # Update status every 5 rows
-                if i % 5 == 0:
-                    try:
-                        await status_msg.edit_text(
-                            f"⏳ *در حال پردازش ردیف‌های CSV...*\n\n"
-                            f"پردازش شده: {i}\n"
-                            f"موفق: {success_count}\n"
-                            f"تکراری: {duplicate_count}\n"
-                            f"خطا: {error_count}",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as status_error:
-                        logger.error(f"Error updating status: {status_error}")
+        while not ingest_task.done():
+            try:
+                progress = await asyncio.wait_for(progress_queue.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            # Skip to the newest snapshot if several arrived while editing
+            while not progress_queue.empty():
+                progress = progress_queue.get_nowait()
+            try:
+                await status_msg.edit_text(
+                    f"⏳ *در حال پردازش ردیف‌های CSV...*\n\n"
+                    f"پردازش شده: {progress['total_rows']}\n"
+                    f"موفق: {progress['success_count']}\n"
+                    f"تکراری: {progress['duplicate_count']}\n"
+                    f"خطا: {progress['error_count']}",
+                    parse_mode="Markdown"
+                )
+            except Exception as status_error:
+                logger.error(f"Error updating status: {status_error}")
+        
+        stats = await ingest_task
+        total_rows = stats["total_rows"]
+        success_count = stats["success_count"]
+        duplicate_count = stats["duplicate_count"]
+        error_count = stats["error_count"]
+        errors = stats["errors"]
+        extra_errors = stats["extra_errors"]
         
         # Show final results
         result_message = f"✅ *افزودن گروهی اکانت‌ها انجام شد*\n\n"
@@ -2414,12 +2949,12 @@ async def process_csv_upload_direct(update: Update, context: ContextTypes.DEFAUL
         
         if errors:
             result_message += "\n📋 *خطاها:*\n"
-            # Show first 5 errors max
-            for error in errors[:5]:
+            # Show first CSV_ERRORS_SHOWN errors max
+            for error in errors:
                 result_message += f"- {error}\n"
             
-            if len(errors) > 5:
-                result_message += f"و {len(errors) - 5} خطای دیگر..."
+            if extra_errors:
+                result_message += f"و {extra_errors} خطای دیگر..."
         
         await status_msg.edit_text(
             result_message,
@@ -2436,16 +2971,28 @@ async def process_csv_upload_direct(update: Update, context: ContextTypes.DEFAUL
         )
     
     finally:
-        # Clean up temp file
-        try:
-            if os.path.exists(csv_file_path):
-                os.remove(csv_file_path)
-        except Exception as e:
-            logger.error(f"Error cleaning up temp file: {e}")
+        # Drop the downloaded upload (in memory or its rollover temp file)
+        csv_file.close()
     
     return -1  # End conversation
 
 
+def _db_add_seat(username: str, password: str, secret: str, max_slots: int) -> Optional[int]:
+    """Encrypt and insert one seat. Returns the new seat id, or None if the username already exists."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO seats (email, pass_enc, secret_enc, max_slots)
+                   VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (email) DO NOTHING
+                   RETURNING id""",
+                (username, encrypt(password), encrypt(secret), max_slots)
+            )
+            result = cur.fetchone()
+            conn.commit()
+            return result[0] if result else None
+
+
 async def process_add_seat_direct(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process the add seat input message directly."""
     message = update.message
@@ -2506,36 +3053,17 @@ async def process_add_seat_direct(update: Update, context: ContextTypes.DEFAULT_
             )
             return
         
-        # Encrypt credentials
-        pass_enc = encrypt(password)
-        secret_enc = encrypt(secret)
-        
-        # Insert into database
-        with db.get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """INSERT INTO seats (email, pass_enc, secret_enc, max_slots)
-                       VALUES (%s, %s, %s, %s)
-                       ON CONFLICT (email) DO NOTHING
-                       RETURNING id""",
-                    (username, pass_enc, secret_enc, max_slots)
-                )
-                
-                result = cur.fetchone()
-                conn.commit()
-                
-                # Check if the insert was successful
-                if result is None or cur.rowcount == 0:
-                    # Username already exists
-                    await message.reply_text(
-                        f"⚠️ *این نام کاربری قبلاً ثبت شده است*\n\n"
-                        f"👤 نام کاربری: `{username}`",
-                        parse_mode="Markdown",
-                        reply_markup=get_admin_keyboard()
-                    )
-                    return
-                
-                seat_id = result[0]
+        # Encrypt the credentials and insert the seat in a worker thread
+        seat_id = await asyncio.to_thread(_db_add_seat, username, password, secret, max_slots)
+        if seat_id is None:
+            # Username already exists
+            await message.reply_text(
+                f"⚠️ *این نام کاربری قبلاً ثبت شده است*\n\n"
+                f"👤 نام کاربری: `{username}`",
+                parse_mode="Markdown",
+                reply_markup=get_admin_keyboard()
+            )
+            return
         
         # Confirm success
         await message.reply_text(
@@ -2585,7 +3113,7 @@ async def admin_process_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             return ADMIN_WAITING_CARD
         
         # Set card number
-        db.set_setting('card_number', message_text)
+        await asyncio.to_thread(db.set_setting, 'card_number', message_text)
         await update.message.reply_text(
             f"✅ شماره کارت به `{message_text}` تغییر یافت.",
             parse_mode="Markdown",
@@ -2600,7 +3128,7 @@ async def admin_process_input(update: Update, context: ContextTypes.DEFAULT_TYPE
                 raise ValueError("Rate must be positive")
                 
             # Set USD rate
-            db.set_setting('usd_rate', str(rate))
+            await asyncio.to_thread(db.set_setting, 'usd_rate', str(rate))
             await update.message.reply_text(
                 f"✅ نرخ دلار به `{rate:,} تومان` تغییر یافت.",
                 parse_mode="Markdown",
@@ -2615,353 +3143,251 @@ async def admin_process_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     return -1  # End conversation
 
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
-    """Handle callback queries from inline keyboards."""
+def require_admin(handler):
+    """Wrap an admin-only callback handler; other users get the no-access message instead."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args) -> Any:
+        if not await check_admin(update.effective_user.id):
+            await update.callback_query.edit_message_text("شما دسترسی ادمین ندارید.")
+            return None
+        return await handler(update, context, *args)
+    return wrapper
+
+
+async def _cb_referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+    """Show the referral menu."""
+    # Handle referral menu
+    await referral.show_referral_menu(update, context)
+
+
+async def _cb_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+    """Return to the main menu."""
     query = update.callback_query
-    await query.answer()  # Answer the callback query to stop loading indicator
     
-    # Extract callback data
-    data = query.data
+    # Return to main menu
+    await query.edit_message_text(
+        BACK_TO_MENU_TEXT,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode="Markdown"
+    )
+
+
+async def _cb_check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+    """Re-check channel membership after the user says they joined."""
+    query = update.callback_query
     user = update.effective_user
     
-    # Log all callback queries for debugging
-    logger.info(f"Callback handler processing: '{data}' from user {user.id}")
-    
-    # Skip membership check for admin callbacks and check_membership itself
-    skip_membership_check = (
-        data == "check_membership" or 
-        data.startswith("admin:") or 
-        data.startswith("approve:") or 
-        data.startswith("reject:") or
-        data.startswith("seat:") or
-        await check_admin(user.id)
-    )
+    # Check channel membership when user clicks the button
+    is_member, missing_channels = await check_channel_membership(user.id, context.bot)
+    if is_member:
+        # User is now a member, show main menu
+        await query.edit_message_text(
+            MEMBERSHIP_CONFIRMED_TEXT,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode="Markdown"
+        )
+    else:
+        # User is still not a member, show join channels message again
+        await send_join_channels_message(update, context, missing_channels)
+
+
+async def _cb_noop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+    """Navigation spacer buttons; nothing to do."""
+    # callback_handler already answered the query (with a client-side cache time)
+
+
+async def _cb_seat(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Seat management buttons of the accounts list (seat:<action>:<id>)."""
+    from handlers.admin_accounts import handle_seat_delete, handle_seat_edit_prompt
     
-    # Check channel membership for regular users (not admins)
-    if not skip_membership_check:
-        is_member, missing_channels = await check_channel_membership(user.id, context.bot)
-        if not is_member:
-            await send_join_channels_message(update, context, missing_channels)
-            return
+    # Extract seat action and ID; the format is fixed (seat:<action>:<id>), so no regex needed
+    action, _, seat_id = arg.partition(":")
+    if not (action and seat_id.isdecimal()):
+        return
     
-    if data == "buy_service":
-        # Show subscription options
-        await show_subscription_options(update, context)
-        
-    elif data == "buy:1mo":
-        # Show purchase info for one-month plan
-        await show_purchase_info(update, context)
-        
-    elif data == "wallet":
-        # Handle wallet button
-        await show_wallet(update, context)
-        
-    elif data == "menu:ref":
-        # Handle referral menu
-        from handlers.referral import show_referral_menu
-        await show_referral_menu(update, context)
-        
-    elif data == "manage_service":
-        # Handle manage service button
-        await manage_services(update, context)
-        
-    elif data == "back_to_menu":
-        # Return to main menu
+    # Both handlers check admin access and return to the last viewed page of the list
+    if action == "del":
+        await handle_seat_delete(update, context, int(seat_id))
+    elif action == "edit":
+        await handle_seat_edit_prompt(update, context, int(seat_id))
+
+
+async def _admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Return to the admin panel."""
+    query = update.callback_query
+    try:
         await query.edit_message_text(
-            f"👤 * به ربات \"اکانت یار\" : فروش اکانت قانونی فیلترشکن خوش آمدید👋*\n\n"
-            f"از منوی زیر، گزینه مورد نظر خود را انتخاب کنید.",
-            reply_markup=get_main_menu_keyboard(),
+            ADMIN_PANEL_TEXT,
+            reply_markup=ADMIN_MARKUP,
             parse_mode="Markdown"
         )
-        
-    elif data == "check_membership":
-        # Check channel membership when user clicks the button
-        is_member, missing_channels = await check_channel_membership(user.id, context.bot)
-        if is_member:
-            # User is now a member, show main menu
-            await query.edit_message_text(
-                f"✅ *عضویت شما تأیید شد!*\n\n"
-                f"👤  به ربات \"اکانت یار\" : فروش اکانت قانونی فیلترشکن خوش آمدید 👋\n\n"
-                f"✅ سرویس های فعال درحال حاضر:\n"
-                f"- اکانت قانونی فیلترشکن پرسرعت ویندسکرایب 🔐\n\n"
-                f"از منوی زیر، گزینه مورد نظر خود را انتخاب کنید.",
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="Markdown"
-            )
-        else:
-            # User is still not a member, show join channels message again
-            await send_join_channels_message(update, context, missing_channels)
-    
-    # Seat management callbacks
-    elif data.startswith("seat:"):
-        # Check if user is admin
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.edit_message_text("شما دسترسی ادمین ندارید.")
-            return
-            
-        # Extract seat action and ID
-        match = re.match(r'^seat:(\w+):(\d+)$', data)
-        if match:
-            action, seat_id = match.groups()
-            seat_id = int(seat_id)
-            
-            if action == "del":
-                # Handle seat deletion
-                try:
-                    # Get the current page to return to it after deletion
-                    page_match = re.search(r"admin:list\|(\d+)", context.user_data.get('last_list_page', 'admin:list|1'))
-                    current_page = int(page_match.group(1)) if page_match else 1
-                    
-                    # Update seat status to disabled
-                    with db.get_conn() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute(
-                                "UPDATE seats SET status='disabled' WHERE id=%s", 
-                                (seat_id,)
-                            )
-                            conn.commit()
-                            
-                    # Show confirmation
-                    await query.answer("حذف شد", show_alert=True)
-                    
-                    # Refresh the current page
-                    from handlers.admin_accounts import handle_accounts_list
-                    await handle_accounts_list(update, context, current_page)
-                    
-                except Exception as e:
-                    logger.error(f"Error deleting seat: {e}")
-                    await query.answer(f"خطا در حذف صندلی: {str(e)[:200]}", show_alert=True)
+    except Exception as e:
+        logger.exception("Error in admin:back callback for user %s: %s", update.effective_user.id, e)
+        await query.answer(f"خطا: {str(e)[:100]}", show_alert=True)
+
+
+async def _admin_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Payment cards list (admin:cards[|<page>]); admin:card is the legacy name of the same list."""
+    await admin_cards.show_cards_list(update, context, int(page) if page.isdecimal() else 0)
+
+
+async def _admin_usd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Change USD rate."""
+    return await handle_admin_usd_rate(update, context)
+
+
+async def _admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Show statistics."""
+    await admin_stats(update, context)
+
+
+async def _admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Show broadcast prompt."""
+    await update.callback_query.edit_message_text(
+        f"📣 *ارسال پیام گروهی*\n\n"
+        f"برای ارسال پیام گروهی از دستور /broadcast استفاده کنید:\n\n"
+        f"`/broadcast متن پیام شما`\n\n"
+        f"این پیام به تمام کاربران بات ارسال خواهد شد.",
+        parse_mode="Markdown",
+        reply_markup=ADMIN_MARKUP
+    )
+
+
+async def _admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Create database backup."""
+    status_msg = await update.callback_query.edit_message_text(
+        "📂 *در حال تهیه بکاپ از دیتابیس...*",
+        parse_mode="Markdown"
+    )
+    await backup_db(context.bot, status_msg)
+
+
+async def _admin_addseat(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Add a new seat (account)."""
+    await handle_add_seat(update, context)
+
+
+async def _admin_bulkcsv(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Bulk add seats from CSV."""
+    await handle_bulk_csv(update, context)
+
+
+async def _admin_price(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Change service price."""
+    try:
+        from handlers import admin_price
+    except ImportError:
+        # Fallback to built-in handler
+        await handle_change_price(update, context)
+    else:
+        await admin_price.handle_change_price(update, context, "service_price")
+
+
+async def _admin_utm(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Show UTM statistics."""
+    await handle_utm_stats(update, context)
+
+
+async def _admin_listcsv(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Generate and send CSV list of accounts."""
+    await handle_list_csv(update, context)
+
+
+async def _admin_list(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Account management list with pagination (admin:list[|<page>])."""
+    from handlers.admin_accounts import handle_accounts_list
+    await handle_accounts_list(update, context, int(page) if page.isdecimal() else 1)
+
+
+async def _admin_deleteall(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Show delete all accounts confirmation prompt."""
+    from handlers.admin_accounts import handle_delete_all_accounts_prompt
+    await handle_delete_all_accounts_prompt(update, context)
+
+
+async def _admin_deleteall_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str) -> Any:
+    """Delete all accounts after confirmation."""
+    from handlers.admin_accounts import handle_delete_all_accounts_confirm
+    await handle_delete_all_accounts_confirm(update, context)
+
+
+# Admin panel actions (admin:<action>[|<page>]); handlers get the page part, or "" if there is none
+ADMIN_ACTIONS = {
+    "back": _admin_back,
+    "cards": _admin_cards,
+    "card": _admin_cards,
+    "usd": _admin_usd,
+    "stats": _admin_stats,
+    "broadcast": _admin_broadcast,
+    "backup": _admin_backup,
+    "addseat": _admin_addseat,
+    "bulkcsv": _admin_bulkcsv,
+    "price": _admin_price,
+    "utm": _admin_utm,
+    "listcsv": _admin_listcsv,
+    "list": _admin_list,
+    "deleteall": _admin_deleteall,
+    "deleteall:confirm": _admin_deleteall_confirm,
+}
+
+
+@require_admin
+async def _cb_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Admin panel buttons (admin:<action>), dispatched through ADMIN_ACTIONS."""
+    action, _, page = arg.partition("|")
+    handler = ADMIN_ACTIONS.get(action)
+    if handler is not None:
+        return await handler(update, context, page)
+
+
+def _db_get_sales_report_info(tg_id: int) -> tuple:
+    """Return the buyer's (username, first_name) row and the free capacity of all active seats."""
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT username, first_name FROM users WHERE tg_id = %s", (tg_id,))
+            user_details = cur.fetchone()
             
-            elif action == "edit":
-                # Handle seat edit
-                try:
-                    # Save seat_id in context for the message handler
-                    context.user_data['edit_seat_id'] = seat_id
-                    
-                    # Get the current page to return to after editing
-                    page_match = re.search(r"admin:list\|(\d+)", context.user_data.get('last_list_page', 'admin:list|1'))
-                    current_page = int(page_match.group(1)) if page_match else 1
-                    context.user_data['edit_return_page'] = current_page
-                    
-                    # Create keyboard
-                    keyboard = [
-                        [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data=f"admin:list|{current_page}")]
-                    ]
-                    
-                    # Show edit prompt
-                    await query.edit_message_text(
-                        f"✏️ *ویرایش صندلی شماره #{seat_id}*\n\n"
-                        f"نام کاربری پسورد سکرت اسلات (برای نگه‌داشتن مقدار فعلی از - استفاده کن)\n\n"
-                        f"مثال:\n`newusername - newsecret 25`\n\n"
-                        f"یا برای حفظ همه مقادیر:\n`- - - -`",
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                except Exception as e:
-                    logger.error(f"Error preparing seat edit: {e}")
-                    await query.answer(f"خطا در آماده‌سازی ویرایش: {str(e)[:200]}", show_alert=True)
+            # Get total remaining capacity across all seats
+            cur.execute("SELECT SUM(free_slots) FROM seats WHERE status = 'active'")
+            remaining_capacity = cur.fetchone()[0] or 0
+            return user_details, remaining_capacity
+
+
+@require_admin
+async def _cb_approve(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Approve an order from its receipt message (approve:<order_id>)."""
+    query = update.callback_query
     
-    # Admin panel callbacks
-    elif data.startswith("admin:"):
-        # Handle admin back button first
-        if data == "admin:back":
-            try:
-                logger.info(f"admin:back callback received from user {user.id}")
-                
-                # Check if user is admin
-                is_admin = await check_admin(user.id)
-                logger.info(f"User {user.id} admin check result: {is_admin}")
-                
-                if not is_admin:
-                    logger.warning(f"User {user.id} attempted admin:back but is not admin")
-                    await query.answer("شما اجازه دسترسی به این بخش را ندارید.", show_alert=True)
-                    return
-                
-                logger.info(f"Getting admin keyboard...")
-                try:
-                    admin_keyboard = get_admin_keyboard()
-                    logger.info(f"Admin keyboard created successfully")
-                except Exception as kb_error:
-                    logger.error(f"Error creating admin keyboard: {kb_error}")
-                    raise kb_error
-                
-                logger.info(f"Editing message for admin:back - user {user.id}")
-                
-                # Return to admin panel
-                await query.edit_message_text(
-                    f"💻 *پنل مدیریت*\n\n"
-                    f"به پنل مدیریت بات خوش آمدید.\n"
-                    f"لطفا گزینه مورد نظر خود را انتخاب کنید:",
-                    reply_markup=admin_keyboard,
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"Successfully returned to admin panel for user {user.id}")
-                return
-                
-            except Exception as e:
-                logger.error(f"Error in admin:back callback for user {user.id}: {e}")
-                import traceback
-                logger.error(f"Full traceback: {traceback.format_exc()}")
-                await query.answer(f"خطا: {str(e)[:100]}", show_alert=True)
-                return
-        
-        # Check if user is admin for other admin actions
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.edit_message_text("شما دسترسی ادمین ندارید.")
-            return
-            
-        admin_action = data.split(":")[1]
-        
-        if admin_action == "cards" or admin_action.startswith("cards|"):
-            # Cards management
-            # Check if pagination parameter is included
-            page = 0
-            if "|" in admin_action:
-                try:
-                    page = int(admin_action.split("|")[1])
-                except (ValueError, IndexError):
-                    page = 0
-            
-            # Show cards list
-            await admin_cards.show_cards_list(update, context, page)
-            return
-            
-        elif admin_action == "card":
-            # Legacy card management - redirect to new system
-            await admin_cards.show_cards_list(update, context)
-            return
-            
-        elif admin_action == "usd":
-            # Change USD rate
-            return await handle_admin_usd_rate(update, context)
-            
-        elif admin_action == "stats":
-            # Show statistics
-            await admin_stats(update, context)
-            
-        elif admin_action == "broadcast":
-            # Show broadcast prompt
-            await query.edit_message_text(
-                f"📣 *ارسال پیام گروهی*\n\n"
-                f"برای ارسال پیام گروهی از دستور /broadcast استفاده کنید:\n\n"
-                f"`/broadcast متن پیام شما`\n\n"
-                f"این پیام به تمام کاربران بات ارسال خواهد شد.",
-                parse_mode="Markdown",
-                reply_markup=get_admin_keyboard()
-            )
-            
-        elif admin_action == "backup":
-            # Create database backup
-            status_msg = await query.edit_message_text(
-                "📂 *در حال تهیه بکاپ از دیتابیس...*",
-                parse_mode="Markdown"
-            )
-            await backup_db(context.bot, status_msg)
-            
-        elif admin_action == "addseat":
-            # Add a new seat (account)
-            await handle_add_seat(update, context)
-            
-        elif admin_action == "bulkcsv":
-            # Bulk add seats from CSV
-            await handle_bulk_csv(update, context)
-            
-        elif admin_action == "price":
-            # Change service price
-            try:
-                from handlers.admin_price import handle_change_price
-                await handle_change_price(update, context, "service_price")
-            except ImportError:
-                # Fallback to built-in handler
-                await handle_change_price(update, context)
-            
-        elif admin_action == "usd":
-            # Change USD rate
-            await handle_admin_usd_rate(update, context)
-            
-        elif admin_action == "utm":
-            # Show UTM statistics
-            await handle_utm_stats(update, context)
-            
-        elif admin_action == "listcsv":
-            # Generate and send CSV list of accounts
-            await handle_list_csv(update, context)
-            
-        elif admin_action == "list" or admin_action.startswith("list|"):
-            # Handle account management list with pagination
-            from handlers.admin_accounts import handle_accounts_list
-            
-            # Check if page number is specified
-            page = 1
-            if "|" in admin_action:
-                try:
-                    page = int(admin_action.split("|")[1])
-                except (ValueError, IndexError):
-                    page = 1
-            
-            await handle_accounts_list(update, context, page)
-            
-        elif admin_action == "deleteall":
-            # Show delete all accounts confirmation prompt
-            from handlers.admin_accounts import handle_delete_all_accounts_prompt
-            await handle_delete_all_accounts_prompt(update, context)
-            
-        elif admin_action.startswith("deleteall:"):
-            # Handle delete all accounts confirmation
-            if admin_action == "deleteall:confirm":
-                from handlers.admin_accounts import handle_delete_all_accounts_confirm
-                await handle_delete_all_accounts_confirm(update, context)
-            
-        # Other admin actions would be handled here
+    # Extract order ID
+    order_id = int(arg)
     
-    # Handle order approval
-    elif data.startswith("approve:"):
-        # Check if user is admin
-        is_admin = False
-        try:
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT is_admin FROM users WHERE tg_id = %s", (user.id,))
-                    result = cur.fetchone()
-                    is_admin = result and result[0]
-        except Exception as e:
-            logger.error(f"Error checking admin status: {e}")
-        
-        if not is_admin:
-            await query.edit_message_text("شما دسترسی ادمین ندارید.")
-            return
+    # Process approval
+    success, result = await approve_order(order_id)
+    
+    if success:
+        # Send credentials to user
+        order_data = result
+        seat = order_data["seat"]
+        tg_id = order_data["tg_id"]
+        order_id = order_data["order_id"]
         
-        # Extract order ID
-        order_id = int(data.split(":")[1])
+        # Decrypt credentials
+        username = seat["email"]  # Database still uses 'email' field, but content is username
+        password = decrypt(seat["pass_enc"])
         
-        # Process approval
-        success, result = await approve_order(order_id)
+        # Send message to user
+        user_message = (
+            f"🎉 *سفارش شماره #{order_id} تایید شد*\n\n"
+            f"👤 نام کاربری: `{username}`\n"
+            f"🔑 رمز عبور: `{password}`\n\n"
+            f"✅ برای آموزش ورود به اکانت و دریافت کد 2FA، روی دکمه زیر کلیک کنید.\n\n"
+            f"❌ لطفا اطلاعات حساب خود را با احتیاط نگهداری کنید."
+        )
         
-        if success:
-            # Send credentials to user
-            order_data = result
-            seat = order_data["seat"]
-            tg_id = order_data["tg_id"]
-            order_id = order_data["order_id"]
-            
-            # Decrypt credentials
-            username = seat["email"]  # Database still uses 'email' field, but content is username
-            password = decrypt(seat["pass_enc"])
-            
-            # Send message to user
-            user_message = (
-                f"🎉 *سفارش شماره #{order_id} تایید شد*\n\n"
-                f"👤 نام کاربری: `{username}`\n"
-                f"🔑 رمز عبور: `{password}`\n\n"
-                f"✅ برای آموزش ورود به اکانت و دریافت کد 2FA، روی دکمه زیر کلیک کنید.\n\n"
-                f"❌ لطفا اطلاعات حساب خود را با احتیاط نگهداری کنید."
-            )
-            
+        async def notify_user():
             try:
-                await context.bot.send_message(
+                await outbox.send(
+                    context.bot.send_message,
                     chat_id=tg_id,
                     text=user_message,
                     parse_mode="Markdown",
@@ -2969,556 +3395,484 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 )
             except Exception as e:
                 logger.error(f"Error sending credentials to user: {e}")
-            
+        
+        async def send_sales_report():
             # Send sales report to LOG_SELL_CHID channel if configured
-            if LOG_SELL_CHID:
-                try:
-                    # Get user details for the report
-                    with db.get_conn() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute("SELECT username, first_name FROM users WHERE tg_id = %s", (tg_id,))
-                            user_details = cur.fetchone()
-                            
-                            # Get total remaining capacity across all seats
-                            cur.execute("SELECT SUM(max_slots - sold) FROM seats WHERE status = 'active'")
-                            remaining_capacity = cur.fetchone()[0] or 0
-                            
-                    username = user_details[0] if user_details and user_details[0] else user_details[1] if user_details else "کاربر"
-                    user_mention = f"@{username}" if username and not username.startswith('کاربر') else username
-                    
-                    # Decrypt TOTP secret for the report
-                    totp_secret = decrypt_secret(seat["secret_enc"])
-                    
-                    sales_report = (
-                        f"✅ گزارش فروش\n\n"
-                        f"اکانت ویندسکرایب یک ماهه برای کاربر {user_mention} ارسال شد\n\n"
-                        f"👤 نام کاربری: {username}\n"
-                        f"🔑 رمز عبور: {password}\n"
-                        f"🔐 کد 2FA اکانت: {totp_secret}\n\n"
-                        f"💺 ظرفیت کل صندلی های باقی مانده: {remaining_capacity}"
-                    )
-                    
-                    await context.bot.send_message(
-                        chat_id=LOG_SELL_CHID,
-                        text=sales_report
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending sales report: {e}")
-            
-            # Update receipt message caption
-            try:
-                # Get receipt channel message ID
-                with db.get_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "SELECT channel_msg_id FROM receipts WHERE order_id = %s",
-                            (order_id,)
-                        )
-                        result = cur.fetchone()
-                        if result and result[0]:
-                            channel_msg_id = result[0]
-                            
-                            # Update caption
-                            await context.bot.edit_message_caption(
-                                chat_id=RECEIPT_CHANNEL_ID,
-                                message_id=channel_msg_id,
-                                caption=f"Order #{order_id}\n\n✅ *تایید شده*\nصندلی: {seat['id']} ({seat['sold']}/{seat['max_slots']})",
-                                parse_mode="Markdown"
-                            )
-            except Exception as e:
-                logger.error(f"Error updating receipt caption: {e}")
-            
-            # Update admin message - safely
-            try:
-                # First try to edit message text
-                await query.edit_message_text(f"✅ سفارش #{order_id} تایید شد.")
-            except telegram.error.BadRequest as e:
-                if "There is no text in the message to edit" in str(e):
-                    # If message has no text (e.g. it's a photo), answer callback query instead
-                    await query.answer(f"✅ سفارش #{order_id} تایید شد.", show_alert=True)
-                    
-                    # Try to edit caption if it's a media message
-                    try:
-                        await query.edit_message_caption(f"✅ سفارش #{order_id} تایید شد.")
-                    except Exception:
-                        # If we can't edit caption either, just log it
-                        logger.info(f"Could not edit message or caption for order #{order_id} approval")
-                else:
-                    # For other BadRequest errors, just log and notify
-                    logger.error(f"Error updating admin message on approval: {e}")
-                    await query.answer("خطا در بروزرسانی پیام", show_alert=True)
-        else:
-            # Show error
+            if not LOG_SELL_CHID:
+                return
             try:
-                # First try to edit message text
-                await query.edit_message_text(
-                    f"❌ خطا در تایید سفارش: {result}"
+                # Get user details and the remaining capacity for the report
+                user_details, remaining_capacity = await asyncio.to_thread(_db_get_sales_report_info, tg_id)
+                
+                username = user_details[0] if user_details and user_details[0] else user_details[1] if user_details else "کاربر"
+                user_mention = f"@{username}" if username and not username.startswith('کاربر') else username
+                
+                # Decrypt TOTP secret for the report
+                totp_secret = decrypt_secret(seat["secret_enc"])
+                
+                sales_report = (
+                    f"✅ گزارش فروش\n\n"
+                    f"اکانت ویندسکرایب یک ماهه برای کاربر {user_mention} ارسال شد\n\n"
+                    f"👤 نام کاربری: {username}\n"
+                    f"🔑 رمز عبور: {password}\n"
+                    f"🔐 کد 2FA اکانت: {totp_secret}\n\n"
+                    f"💺 ظرفیت کل صندلی های باقی مانده: {remaining_capacity}"
                 )
-            except telegram.error.BadRequest as e:
-                if "There is no text in the message to edit" in str(e):
-                    # If message has no text (e.g. it's a photo), answer callback query instead
-                    await query.answer(f"❌ خطا در تایید سفارش: {result}", show_alert=True)
-                    
-                    # Try to edit caption if it's a media message
-                    try:
-                        await query.edit_message_caption(f"❌ خطا در تایید سفارش: {result}")
-                    except Exception:
-                        # If we can't edit caption either, just log it
-                        logger.info(f"Could not edit message or caption for order error")
-                else:
-                    # For other BadRequest errors, just log and notify
-                    logger.error(f"Error updating admin message on approval error: {e}")
-                    await query.answer("خطا در بروزرسانی پیام", show_alert=True)
-    
-    # Handle order rejection
-    elif data.startswith("reject:"):
-        # Check if user is admin
-        is_admin = False
-        try:
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT is_admin FROM users WHERE tg_id = %s", (user.id,))
-                    result = cur.fetchone()
-                    is_admin = result and result[0]
-        except Exception as e:
-            logger.error(f"Error checking admin status: {e}")
-        
-        if not is_admin:
-            await query.edit_message_text("شما دسترسی ادمین ندارید.")
-            return
+                
+                await outbox.send(
+                    context.bot.send_message,
+                    pace_chat=LOG_SELL_CHID,
+                    chat_id=LOG_SELL_CHID,
+                    text=sales_report
+                )
+            except Exception as e:
+                logger.error(f"Error sending sales report: {e}")
         
-        # Extract order ID
-        order_id = int(data.split(":")[1])
+        # The receipt caption in the channel is paced, so it is updated in the background
+        spawn_background(update_receipt_caption(
+            context.bot,
+            order_data["channel_msg_id"],
+            RECEIPT_APPROVED_CAPTION % (order_id, seat['id'], seat['sold'], seat['max_slots'])
+        ))
         
-        # Process rejection
-        success, result = await reject_order(order_id)
+        # The user notification, sales report and admin message are independent,
+        # so they are sent concurrently
+        results = await asyncio.gather(
+            notify_user(),
+            send_sales_report(),
+            edit_query_message(query, ORDER_APPROVED_TEXT % order_id),
+            return_exceptions=True
+        )
+        for outcome in results:
+            if isinstance(outcome, Exception):
+                logger.error(f"Error finishing approval of order #{order_id}: {outcome}")
+    else:
+        # Show error
+        await edit_query_message(query, ORDER_APPROVE_ERROR_TEXT % (result,))
+
+
+@require_admin
+async def _cb_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Reject an order from its receipt message (reject:<order_id>)."""
+    query = update.callback_query
+    
+    # Extract order ID
+    order_id = int(arg)
+    
+    # Process rejection
+    success, result = await reject_order(order_id)
+    
+    if success:
+        tg_id = result["tg_id"]
         
-        if success:
-            tg_id = result
-            
-            # Notify user
+        async def notify_user():
             try:
-                await context.bot.send_message(
+                await outbox.send(
+                    context.bot.send_message,
                     chat_id=tg_id,
-                    text=f"❌ *سفارش شماره #{order_id} رد شد*\n\n"
-                         f"✏️ لطفا با پشتیبانی تماس بگیرید یا مجددا تلاش کنید.\n\n"
-                         f"💬 پشتیبانی: @AccountYarSup",
+                    text=ORDER_REJECTED_USER_TEXT % order_id,
                     parse_mode="Markdown"
                 )
             except Exception as e:
                 logger.error(f"Error notifying user about rejection: {e}")
-            
-            # Update receipt message caption
-            try:
-                # Get receipt channel message ID
-                with db.get_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "SELECT channel_msg_id FROM receipts WHERE order_id = %s",
-                            (order_id,)
-                        )
-                        result = cur.fetchone()
-                        if result and result[0]:
-                            channel_msg_id = result[0]
-                            
-                            # Update caption
-                            await context.bot.edit_message_caption(
-                                chat_id=RECEIPT_CHANNEL_ID,
-                                message_id=channel_msg_id,
-                                caption=f"Order #{order_id}\n\n❌ *رد شده*",
-                                parse_mode="Markdown"
-                            )
-            except Exception as e:
-                logger.error(f"Error updating receipt caption: {e}")
-            
-            # Update admin message - safely
-            try:
-                # First try to edit message text
-                await query.edit_message_text(f"❌ سفارش #{order_id} رد شد.")
-            except telegram.error.BadRequest as e:
-                if "There is no text in the message to edit" in str(e):
-                    # If message has no text (e.g. it's a photo), answer callback query instead
-                    await query.answer(f"❌ سفارش #{order_id} رد شد.", show_alert=True)
-                    
-                    # Try to edit caption if it's a media message
-                    try:
-                        await query.edit_message_caption(f"❌ سفارش #{order_id} رد شد.")
-                    except Exception:
-                        # If we can't edit caption either, just log it
-                        logger.info(f"Could not edit message or caption for order #{order_id} rejection")
-                else:
-                    # For other BadRequest errors, just log and notify
-                    logger.error(f"Error updating admin message on rejection: {e}")
-                    await query.answer("خطا در بروزرسانی پیام", show_alert=True)
-        else:
-            # Show error
-            try:
-                # First try to edit message text
-                await query.edit_message_text(
-                    f"❌ خطا در رد سفارش: {result}"
-                )
-            except telegram.error.BadRequest as e:
-                if "There is no text in the message to edit" in str(e):
-                    # If message has no text (e.g. it's a photo), answer callback query instead
-                    await query.answer(f"❌ خطا در رد سفارش: {result}", show_alert=True)
-                    
-                    # Try to edit caption if it's a media message
-                    try:
-                        await query.edit_message_caption(f"❌ خطا در رد سفارش: {result}")
-                    except Exception:
-                        # If we can't edit caption either, just log it
-                        logger.info(f"Could not edit message or caption for order #{order_id} rejection")
-                else:
-                    # For other BadRequest errors, just log and notify
-                    logger.error(f"Error updating admin message on rejection: {e}")
-                    await query.answer("خطا در بروزرسانی پیام", show_alert=True)
-    
-    # Handle 2FA code request
-    elif data.startswith("2fa:"):
-        # Extract seat ID
-        seat_id = int(data.split(":")[1])
-        
-        # Get the secret for the seat
-        try:
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT secret_enc FROM seats WHERE id = %s", (seat_id,))
-                    result = cur.fetchone()
-                    if not result:
-                        await query.edit_message_text("خطا: اطلاعات صندلی یافت نشد.")
-                        return
-                    
-                    secret_enc = result[0]
-                    
-                    # Decrypt the secret
-                    secret = decrypt(secret_enc)
-                    
-                    # Generate 2FA code using TOTP
-                    import pyotp
-                    totp = pyotp.TOTP(secret)
-                    code = totp.now()
-                    
-                    # Calculate remaining seconds until code expires (codes are valid for 30 seconds + 30 sec buffer)
-                    remaining_seconds = (30 - (int(time.time()) % 30)) + 30
-                    
-                    # Create appropriate message based on attempt count
-                    if new_count == 1:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه"
-                        full_message = (
-                            f"📲 *کد 2FA شما:*\n\n"
-                            f"`{code}`\n\n"
-                            f"⏰ این کد {remaining_seconds} ثانیه اعتبار دارد\n\n"
-                            f"🔑 *دریافت کد مجدد:* (مهلت دریافت 2 دقیقه!)\n\n"
-                            f"⚠️ *توجه:* این آخرین باری است که می‌توانید کد دریافت کنید"
-                        )
-                        keyboard = get_code_2fa_retry_button(order_id)
-                    elif new_count == 2:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه (دفعهٔ دوم)"
-                        full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد (دفعهٔ دوم).\n\n⚠️ *توجه:* این آخرین باری است که می‌توانید کد دریافت کنید"
-                        keyboard = None
-                    else:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه"
-                        full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد"
-                        keyboard = None
-                    
-                    # Show alert with code and TTL
-                    await query.answer(alert_message, show_alert=True)
-                    
-                    # Also send the code as a separate message for easier copying
-                    await context.bot.send_message(
-                        chat_id=user.id,
-                        text=full_message,
-                        parse_mode="Markdown",
-                        reply_markup=keyboard
-                    )
-        except Exception as e:
-            logger.error(f"Error generating TOTP code: {e}")
-            # Log detailed error information using the enhanced logger
-            if ENHANCED_LOGGING:
-                log_exception(e, {"order_id": order_id, "callback_data": data})
-            await query.answer("خطا در تولید کد", show_alert=True)
-            # Also send as regular message
-            await context.bot.send_message(
-                chat_id=user.id,
-                text="❌ *خطا در تولید کد 2FA*\n\n"
-                     "متأسفانه در تولید کد خطایی رخ داده است. "
-                     "لطفاً مجدداً تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
-                     "💬 پشتیبانی: @AccountYarSup",
-                parse_mode="Markdown"
-            )
-    
-    # Handle seat operations
-    elif data.startswith("seat:"):
-        # Handle seat operations (delete, edit, info)
-        parts = data.split(":")
-        if len(parts) < 3:
-            await query.answer("درخواست نامعتبر", show_alert=True)
-            return
-            
-        action = parts[1]
-        seat_id = int(parts[2])
-        
-        # Import account management handlers
-        from handlers.admin_accounts import handle_seat_delete, handle_seat_edit_prompt
-        
-        if action == "del":
-            # Handle seat deletion
-            await handle_seat_delete(update, context, seat_id)
-        elif action == "edit":
-            # Handle seat editing
-            await handle_seat_edit_prompt(update, context, seat_id)
-        elif action == "info":
-            # Show seat info (currently redirects to edit for simplicity)
-            await handle_seat_edit_prompt(update, context, seat_id)
-
-    # Admin: Card management
-    elif data == "admin:card" or data == "admin:cards":
-        # Check if user is admin
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.answer("شما اجازه دسترسی به این بخش را ندارید.", show_alert=True)
-            return
-
-        # Redirect to new card management system
-        await admin_cards.show_cards_list(update, context)
         
-    # Card management callbacks
-    elif data == "card:add":
-        # Check if user is admin
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.answer("شما اجازه دسترسی به این بخش را ندارید.", show_alert=True)
-            return
+        # The receipt caption in the channel is paced, so it is updated in the background
+        spawn_background(update_receipt_caption(
+            context.bot, result["channel_msg_id"], RECEIPT_REJECTED_CAPTION % order_id
+        ))
         
+        # The user notification and admin message are independent
+        results = await asyncio.gather(
+            notify_user(),
+            edit_query_message(query, ORDER_REJECTED_TEXT % order_id),
+            return_exceptions=True
+        )
+        for outcome in results:
+            if isinstance(outcome, Exception):
+                logger.error(f"Error finishing rejection of order #{order_id}: {outcome}")
+    else:
+        # Show error
+        await edit_query_message(query, ORDER_REJECT_ERROR_TEXT % (result,))
+
+
+@require_admin
+async def _cb_card(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Payment card management buttons (card:add, card:del:<id>, card:edit:<id>)."""
+    query = update.callback_query
+    
+    if arg == "add":
         await admin_cards.add_card_prompt(update, context)
-        
-    elif data.startswith("card:del:"):
-        # Check if user is admin
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.answer("شما اجازه دسترسی به این بخش را ندارید.", show_alert=True)
-            return
-        
+    
+    elif arg.startswith("del:"):
         try:
-            card_id = int(data.split(":")[2])
+            card_id = int(arg[4:])
             await admin_cards.delete_card(update, context, card_id)
         except (ValueError, IndexError) as e:
             logger.error(f"Invalid card deletion ID format: {e}")
             await query.answer("خطا در حذف کارت", show_alert=True)
-            
-    elif data.startswith("card:edit:"):
-        # Check if user is admin
-        is_admin = await check_admin(user.id)
-        if not is_admin:
-            await query.answer("شما اجازه دسترسی به این بخش را ندارید.", show_alert=True)
-            return
-        
+    
+    elif arg.startswith("edit:"):
         try:
-            card_id = int(data.split(":")[2])
+            card_id = int(arg[5:])
             await admin_cards.edit_card_prompt(update, context)
         except (ValueError, IndexError) as e:
             logger.error(f"Invalid card edit ID format: {e}")
             await query.answer("خطا در ویرایش کارت", show_alert=True)
 
-    # Handle quick TOTP code generation with limited retries
-    elif data.startswith("code:"):
-        # Extract order ID from callback data
-        order_id = int(data.split(":")[1])
-        
-        try:
-            from datetime import datetime, timezone
-            
-            with db.get_conn() as conn:
-                with conn.cursor() as cur:
-                    # Get current 2FA usage info
-                    cur.execute("SELECT twofa_count, twofa_last, twofa_disabled FROM orders WHERE id = %s", (order_id,))
-                    result = cur.fetchone()
-                    
-                    if not result:
-                        await query.answer("خطا: سفارش یافت نشد", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="❌ خطا: سفارش یافت نشد"
-                        )
-                        return
-                    
-                    twofa_count, twofa_last, twofa_disabled = result
-                    now = datetime.now(timezone.utc)
-                    
-                    # Check if 2FA is permanently disabled
-                    if twofa_disabled:
-                        await query.answer("شما کد رو دریافت کردید و در صورت مشکل با پشتیبانی @AccountYarSup تماس بگیرید.", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="⏰ *مهلت استفاده از کد 2FA به پایان رسیده*\n\n"
-                                 "شما قبلاً کد 2FA خود را دریافت کرده‌اید. اگر مشکلی دارید، "
-                                 "لطفاً با پشتیبانی تماس بگیرید.\n\n"
-                                 "💬 پشتیبانی: @AccountYarSup",
-                            parse_mode="Markdown"
-                        )
-                        return
-                    
-                    # Check if we need to disable 2FA due to timeout
-                    if twofa_count > 0 and twofa_last and (now - twofa_last).total_seconds() >= 120:
-                        # 120 seconds passed since first attempt - disable permanently
-                        cur.execute("UPDATE orders SET twofa_disabled = TRUE WHERE id = %s", (order_id,))
-                        conn.commit()
-                        await query.answer("مهلت دریافت کد به پایان رسیده است. در صورت مشکل با پشتیبانی تماس بگیرید.", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="⏰ *مهلت دریافت کد 2FA به پایان رسیده*\n\n"
-                                 "بیش از 2 دقیقه از اولین درخواست شما گذشته است. "
-                                 "اگر مشکلی دارید، لطفاً با پشتیبانی تماس بگیرید.",
-                            parse_mode="Markdown"
-                        )
-                        return
-                    
-                    # Check retry limits
-                    if twofa_count >= 2:
-                        # Already used 2 times - disable permanently
-                        cur.execute("UPDATE orders SET twofa_disabled = TRUE WHERE id = %s", (order_id,))
-                        conn.commit()
-                        await query.answer("شما کد رو دریافت کردید و در صورت مشکل با پشتیبانی تماس بگیرید.", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="⚡ *حداکثر تعداد درخواست کد 2FA*\n\n"
-                                 "شما 2 بار کد 2FA دریافت کرده‌اید و دیگر امکان دریافت کد جدید وجود ندارد. "
-                                 "اگر مشکلی دارید، لطفاً با پشتیبانی تماس بگیرید.",
-                            parse_mode="Markdown"
-                        )
-                        return
-                    
-                    # Get seat ID and secret for this order
-                    cur.execute("SELECT seat_id FROM orders WHERE id = %s", (order_id,))
-                    result = cur.fetchone()
-                    if not result or not result[0]:
-                        await query.answer("خطا: اطلاعات صندلی یافت نشد", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="❌ خطا: اطلاعات صندلی یافت نشد"
-                        )
-                        return
-                        
-                    seat_id = result[0]
-                    
-                    # Get the secret for the seat
-                    cur.execute("SELECT secret_enc FROM seats WHERE id = %s", (seat_id,))
-                    result = cur.fetchone()
-                    if not result:
-                        await query.answer("خطا: اطلاعات رمز یافت نشد", show_alert=True)
-                        # Also send as regular message
-                        await context.bot.send_message(
-                            chat_id=user.id,
-                            text="❌ خطا: اطلاعات رمز یافت نشد"
-                        )
-                        return
-                    
-                    secret_enc = result[0]
-                    
-                    # Decrypt secret
-                    secret = decrypt(secret_enc)
-                    
-                    # Generate TOTP code
-                    import pyotp
-                    import time
-                    
-                    totp = pyotp.TOTP(secret)
-                    code = totp.now()
-                    
-                    # Calculate remaining seconds until code expires (codes are valid for 30 seconds + 30 sec buffer)
-                    remaining_seconds = (30 - (int(time.time()) % 30)) + 30
-                    
-                    # Update usage count and timestamp
-                    new_count = twofa_count + 1
-                    
-                    # If this is the second code, disable 2FA permanently
-                    if new_count >= 2:
-                        cur.execute(
-                            "UPDATE orders SET twofa_count = %s, twofa_last = %s, twofa_disabled = TRUE WHERE id = %s",
-                            (new_count, now, order_id)
-                        )
-                    else:
-                        cur.execute(
-                            "UPDATE orders SET twofa_count = %s, twofa_last = %s WHERE id = %s",
-                            (new_count, now, order_id)
-                        )
-                    conn.commit()
-                    
-                    # Create appropriate message based on attempt count
-                    if new_count == 1:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه"
-                        full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد"
-                    elif new_count == 2:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه (دفعهٔ دوم)"
-                        full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد (دفعهٔ دوم)."
-                    else:
-                        alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه"
-                        full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد"
-                    
-                    # Show alert with code and TTL
-                    await query.answer(alert_message, show_alert=True)
-                    
-                    # Also send the code as a separate message for easier copying
-                    await context.bot.send_message(
-                        chat_id=user.id,
-                        text=full_message,
-                        parse_mode="Markdown"
-                    )
-                    
-        except Exception as e:
-            logger.error(f"Error generating TOTP code: {e}")
-            # Log detailed error information using the enhanced logger
-            if ENHANCED_LOGGING:
-                log_exception(e, {"order_id": order_id, "callback_data": data})
-            await query.answer("خطا در تولید کد", show_alert=True)
-    
-    # Handle no-operation callback (navigation spacer buttons)
-    elif data == "noop":
-        # Just answer the callback query to acknowledge it, no action needed
-        await query.answer()
+
+# Answers to a code: press that doesn't get a code, as (alert, message) per outcome of _db_claim_twofa_code
+TWOFA_CODE_REFUSALS = {
+    "not_found": (
+        "خطا: سفارش یافت نشد",
+        "❌ خطا: سفارش یافت نشد"
+    ),
+    "disabled": (
+        "شما کد رو دریافت کردید و در صورت مشکل با پشتیبانی @AccountYarSup تماس بگیرید.",
+        "⏰ *مهلت استفاده از کد 2FA به پایان رسیده*\n\n"
+        "شما قبلاً کد 2FA خود را دریافت کرده‌اید. اگر مشکلی دارید، "
+        "لطفاً با پشتیبانی تماس بگیرید.\n\n"
+        "💬 پشتیبانی: @AccountYarSup"
+    ),
+    "expired": (
+        "مهلت دریافت کد به پایان رسیده است. در صورت مشکل با پشتیبانی تماس بگیرید.",
+        "⏰ *مهلت دریافت کد 2FA به پایان رسیده*\n\n"
+        "بیش از 2 دقیقه از اولین درخواست شما گذشته است. "
+        "اگر مشکلی دارید، لطفاً با پشتیبانی تماس بگیرید."
+    ),
+    "limit": (
+        "شما کد رو دریافت کردید و در صورت مشکل با پشتیبانی تماس بگیرید.",
+        "⚡ *حداکثر تعداد درخواست کد 2FA*\n\n"
+        "شما 2 بار کد 2FA دریافت کرده‌اید و دیگر امکان دریافت کد جدید وجود ندارد. "
+        "اگر مشکلی دارید، لطفاً با پشتیبانی تماس بگیرید."
+    ),
+    "no_seat": (
+        "خطا: اطلاعات صندلی یافت نشد",
+        "❌ خطا: اطلاعات صندلی یافت نشد"
+    ),
+    "no_secret": (
+        "خطا: اطلاعات رمز یافت نشد",
+        "❌ خطا: اطلاعات رمز یافت نشد"
+    ),
+}
+
+
+def _db_claim_twofa_code(order_id: int) -> tuple:
+    """
+    Use one of the two 2FA code attempts of an order.
     
-    # Handle 2FA setup request
-    elif data.startswith("setup2fa:"):
-        # Extract order ID
-        order_id = int(data.split(":")[1])
-        
-        try:
-            # Answer the callback query first
-            await query.answer()
+    Returns (outcome, code, attempt). outcome is "ok" when a code was claimed, "busy" when a
+    simultaneous press of the same button claimed this attempt first, or a key of
+    TWOFA_CODE_REFUSALS.
+    """
+    with db.get_conn() as conn:
+        with conn.cursor() as cur:
+            # 2FA usage info, seat and secret of the order in one round-trip
+            cur.execute(
+                """SELECT o.twofa_count, o.twofa_last, o.twofa_disabled, o.seat_id, s.secret_enc
+                   FROM orders o
+                   LEFT JOIN seats s ON s.id = o.seat_id
+                   WHERE o.id = %s""",
+                (order_id,)
+            )
+            result = cur.fetchone()
+            
+            if not result:
+                return "not_found", None, None
+            
+            twofa_count, twofa_last, twofa_disabled, seat_id, secret_enc = result
+            now = datetime.now(timezone.utc)
+            
+            # Check if 2FA is permanently disabled
+            if twofa_disabled:
+                return "disabled", None, None
+            
+            # Check if we need to disable 2FA due to timeout
+            if twofa_count > 0 and twofa_last and (now - twofa_last).total_seconds() >= 120:
+                # 120 seconds passed since first attempt - disable permanently
+                cur.execute("UPDATE orders SET twofa_disabled = TRUE WHERE id = %s", (order_id,))
+                conn.commit()
+                return "expired", None, None
             
-            # Send tutorial message as a separate message (not editing the original)
-            tutorial_message = (
-                f"📱 *آموزش ورود به اکانت در ویندسکرایب*\n\n"
-                f"📥 *دانلود اپلیکیشن:*\n"
-                f"• [لینک پلی استور](https://play.google.com/store/apps/details?id=com.windscribe.vpn)\n"
-                f"• [دانلود لینک مستقیم](https://t.me/AccYarVPN/5)\n\n"
-                f"🔧 *آموزش ورود:*\n"
-                f"1️⃣ برنامه ویندسکرایب را نصب و باز کنید\n"
-                f"2️⃣ روی دکمه *Login* کلیک کنید\n"
-                f"3️⃣ نام کاربری و پسورد خریداری شده را وارد کنید\n"
-                f"4️⃣ پیام *Two-Factor Authentication* ظاهر می‌شود\n"
-                f"5️⃣ روی دکمه زیر برای دریافت کد 2FA بزنید\n"
-                f"6️⃣ کد دریافتی را در برنامه وارد کنید\n\n"
-                f"⚠️ *توجه:* هر کد 60 ثانیه اعتبار دارد و حداکثر 2 بار می‌توانید کد دریافت کنید."
+            # Check retry limits
+            if twofa_count >= 2:
+                # Already used 2 times - disable permanently
+                cur.execute("UPDATE orders SET twofa_disabled = TRUE WHERE id = %s", (order_id,))
+                conn.commit()
+                return "limit", None, None
+            
+            if not seat_id:
+                return "no_seat", None, None
+            
+            if secret_enc is None:
+                return "no_secret", None, None
+            
+            # Get the TOTP code (cached per seat and time window) before claiming the attempt,
+            # so a secret that can't be decrypted doesn't use it up
+            code = get_seat_code(seat_id, secret_enc)
+            
+            # Update usage count and timestamp
+            new_count = twofa_count + 1
+            
+            # Claim the code only if the count is still what we read (compare-and-set),
+            # so two simultaneous taps can't both use the same attempt.
+            # The second code disables 2FA permanently.
+            cur.execute(
+                """UPDATE orders
+                   SET twofa_count = %(new_count)s, twofa_last = %(now)s,
+                       twofa_disabled = (%(new_count)s >= 2)
+                   WHERE id = %(order_id)s AND twofa_count = %(count)s
+                     AND NOT COALESCE(twofa_disabled, FALSE)
+                   RETURNING 1""",
+                {"new_count": new_count, "now": now, "order_id": order_id, "count": twofa_count}
             )
+            claimed = cur.fetchone() is not None
+            conn.commit()
             
-            await context.bot.send_message(
+            if not claimed:
+                return "busy", None, None
+            return "ok", code, new_count
+
+
+async def _cb_code(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Quick 2FA code for an order, limited to two codes within two minutes (code:<order_id>)."""
+    query = update.callback_query
+    user = update.effective_user
+    
+    # Extract order ID from callback data
+    order_id = int(arg)
+    
+    try:
+        outcome, code, new_count = await asyncio.to_thread(_db_claim_twofa_code, order_id)
+        
+        if outcome == "busy":
+            # Another tap of the same button got this attempt first and sends the code
+            logger.info(f"Concurrent 2FA code request for order {order_id} ignored")
+            return
+        
+        if outcome != "ok":
+            alert_message, full_message = TWOFA_CODE_REFUSALS[outcome]
+            await query.answer(alert_message, show_alert=True)
+            # Also send as regular message
+            await outbox.send(
+                context.bot.send_message,
                 chat_id=user.id,
-                text=tutorial_message,
-                parse_mode="Markdown",
-                reply_markup=get_code_2fa_button(order_id)
+                text=full_message,
+                parse_mode="Markdown"
             )
-            
-        except Exception as e:
-            logger.error(f"Error sending 2FA tutorial: {e}")
-            await query.answer("خطا در ارسال آموزش", show_alert=True)
+            return
+        
+        # Calculate remaining seconds until code expires (codes are valid for 30 seconds + 30 sec buffer)
+        remaining_seconds = (30 - (int(time.time()) % 30)) + 30
+        
+        # Create appropriate message based on attempt count
+        if new_count == 2:
+            alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه (دفعهٔ دوم)"
+            full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد (دفعهٔ دوم)."
+        else:
+            alert_message = f"📲 کد 2FA شما: {code}\n\n⏰ اعتبار {remaining_seconds} ثانیه"
+            full_message = f"📲 *کد 2FA شما:*\n\n`{code}`\n\n⏰ این کد {remaining_seconds} ثانیه اعتبار دارد"
+        
+        # Show alert with code and TTL
+        await query.answer(alert_message, show_alert=True)
+        
+        # Also send the code as a separate message for easier copying
+        await outbox.send(
+            context.bot.send_message,
+            chat_id=user.id,
+            text=full_message,
+            parse_mode="Markdown"
+        )
+        
+    except Exception as e:
+        logger.error(f"Error generating TOTP code: {e}")
+        # Log detailed error information using the enhanced logger
+        if ENHANCED_LOGGING:
+            log_exception(e, {"order_id": order_id, "callback_data": query.data})
+        await query.answer("خطا در تولید کد", show_alert=True)
+
+
+async def _cb_setup2fa(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> Any:
+    """Send the login and 2FA tutorial for an order (setup2fa:<order_id>)."""
+    query = update.callback_query
+    user = update.effective_user
+    
+    # Extract order ID
+    order_id = int(arg)
     
-    # Handle 2FA code request
+    try:
+        # Answer the callback query first
+        await query.answer()
+        
+        # Send tutorial message as a separate message (not editing the original)
+        tutorial_message = (
+            f"📱 *آموزش ورود به اکانت در ویندسکرایب*\n\n"
+            f"📥 *دانلود اپلیکیشن:*\n"
+            f"• [لینک پلی استور](https://play.google.com/store/apps/details?id=com.windscribe.vpn)\n"
+            f"• [دانلود لینک مستقیم](https://t.me/AccYarVPN/5)\n\n"
+            f"🔧 *آموزش ورود:*\n"
+            f"1️⃣ برنامه ویندسکرایب را نصب و باز کنید\n"
+            f"2️⃣ روی دکمه *Login* کلیک کنید\n"
+            f"3️⃣ نام کاربری و پسورد خریداری شده را وارد کنید\n"
+            f"4️⃣ پیام *Two-Factor Authentication* ظاهر می‌شود\n"
+            f"5️⃣ روی دکمه زیر برای دریافت کد 2FA بزنید\n"
+            f"6️⃣ کد دریافتی را در برنامه وارد کنید\n\n"
+            f"⚠️ *توجه:* هر کد 60 ثانیه اعتبار دارد و حداکثر 2 بار می‌توانید کد دریافت کنید."
+        )
+        
+        await context.bot.send_message(
+            chat_id=user.id,
+            text=tutorial_message,
+            parse_mode="Markdown",
+            reply_markup=get_code_2fa_button(order_id)
+        )
+        
+    except Exception as e:
+        logger.error(f"Error sending 2FA tutorial: {e}")
+        await query.answer("خطا در ارسال آموزش", show_alert=True)
+
+
+# Callback data handled as a whole
+CALLBACK_HANDLERS = {
+    "buy_service": show_subscription_options,
+    "buy:1mo": show_purchase_info,
+    "wallet": show_wallet,
+    "menu:ref": _cb_referral_menu,
+    "manage_service": manage_services,
+    "back_to_menu": _cb_back_to_menu,
+    "check_membership": _cb_check_membership,
+    "noop": _cb_noop,
+}
+
+# Callback data dispatched on the part before the first ':'; handlers get the rest after the ':'
+CALLBACK_PREFIX_HANDLERS = {
+    "seat": _cb_seat,
+    "admin": _cb_admin,
+    "approve": _cb_approve,
+    "reject": _cb_reject,
+    "card": _cb_card,
+    "code": _cb_code,
+    "setup2fa": _cb_setup2fa,
+}
+
+# Seconds the Telegram client may reuse our answer for repeated presses of the same button.
+# Only buttons whose press does nothing at all: a cached answer means the press never reaches the bot,
+# which would swallow a legitimate second press of a menu button after navigating back to it.
+CALLBACK_ANSWER_CACHE_TIME = {
+    "noop": 300,
+}
+
+# Prefixes of admin/order callbacks that skip the channel membership check
+_MEMBERSHIP_EXEMPT_PREFIXES = frozenset({"admin", "approve", "reject", "seat"})
+
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+    """Handle callback queries from inline keyboards."""
+    query = update.callback_query
+    
+    # Extract callback data
+    data = query.data
+    
+    # Answer the callback query to stop loading indicator
+    await query.answer(cache_time=CALLBACK_ANSWER_CACHE_TIME.get(data, 0))
+    user = update.effective_user
+    
+    # Log all callback queries for debugging
+    logger.debug("Callback handler processing: %r from user %s", data, user.id)
+    
+    # Parse the callback data once
+    prefix, has_prefix, arg = data.partition(":")
+    
+    # Skip membership check for admin callbacks and check_membership itself
+    skip_membership_check = (
+        data == "check_membership" or
+        (has_prefix and prefix in _MEMBERSHIP_EXEMPT_PREFIXES) or
+        await check_admin(user.id)
+    )
+    
+    # Check channel membership for regular users (not admins)
+    if not skip_membership_check:
+        is_member, missing_channels = await check_channel_membership(user.id, context.bot)
+        if not is_member:
+            await send_join_channels_message(update, context, missing_channels)
+            return
+    
+    # Exact matches first (e.g. "buy:1mo"), then dispatch on the prefix
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler is not None:
+        return await handler(update, context)
+    
+    handler = CALLBACK_PREFIX_HANDLERS.get(prefix) if has_prefix else None
+    if handler is not None:
+        return await handler(update, context, arg)
+
+
+# Static parts of the error notifications
+ERROR_ALERT_HEADER = "⚠️ *خطای سیستمی*\n\n"
+ERROR_ALERT_FOOTER = f"📂 فایل لاگ: `{os.path.join(LOG_DIR, 'error.log')}`"
+USER_ERROR_TEXT = (
+    "❌ خطایی در سیستم رخ داده است. لطفاً مجدداً تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n"
+    "💬 پشتیبانی: @AccountYarSup"
+)
+
+# Admin error alerts are sent at most once per interval; errors in between are
+# held back and sent as one summary per exception type
+ERROR_ALERT_INTERVAL = 5.0  # seconds
+_error_alert_next = 0.0
+_error_alert_pending: Dict[str, list] = {}  # exception type -> [count, first alert text]
+
+
+async def send_error_alert(bot, error_type: str, text: str) -> None:
+    """Send an error alert to ADMIN_ID, or hold it for the next summary if an alert was sent recently."""
+    global _error_alert_next
+    if not ADMIN_ID:
+        return
+    
+    now = time.monotonic()
+    if _error_alert_pending or now < _error_alert_next:
+        entry = _error_alert_pending.setdefault(error_type, [0, text])
+        entry[0] += 1
+        return
+    
+    _error_alert_next = now + ERROR_ALERT_INTERVAL
+    await bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="Markdown")
+
+
+async def flush_error_alerts(bot) -> None:
+    """Send the error alerts held back since the last alert, once the interval has passed."""
+    global _error_alert_next
+    now = time.monotonic()
+    if not _error_alert_pending or now < _error_alert_next:
+        return
+    if not ADMIN_ID:
+        _error_alert_pending.clear()
+        return
+    
+    # Swap the pending alerts out before awaiting so new errors start a fresh summary
+    pending = list(_error_alert_pending.items())
+    _error_alert_pending.clear()
+    _error_alert_next = now + ERROR_ALERT_INTERVAL
+    
+    if len(pending) == 1 and pending[0][1][0] == 1:
+        # A single held-back error is sent as is
+        text = pending[0][1][1]
+    else:
+        lines = [f"❌ `{error_type}` × {count}" for error_type, (count, _) in pending]
+        text = (
+            "⚠️ *خلاصه خطاهای سیستمی*\n\n"
+            + "\n".join(lines)
+            + f"\n\n📝 نمونه اول:\n{pending[0][1][1]}"
+        )
+    await bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode="Markdown")
+
+
+async def error_alert_flush_loop(bot) -> None:
+    """Periodically send the summary of held-back error alerts."""
+    while True:
+        await asyncio.sleep(ERROR_ALERT_INTERVAL)
+        try:
+            await flush_error_alerts(bot)
+        except Exception as e:
+            logger.error(f"Failed to notify admin about errors: {e}")
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -3529,23 +3883,29 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     # Record full stack trace and context
     error_context = {}
     
-    # Safely extract information from update
+    # Safely extract information from update once; the admin message below reuses it
+    message = callback_query = effective_user = effective_chat = None
     try:
         if update:
-            error_context["update_id"] = update.update_id if hasattr(update, "update_id") else None
-            error_context["user_id"] = update.effective_user.id if hasattr(update, "effective_user") and update.effective_user else None
-            error_context["chat_id"] = update.effective_chat.id if hasattr(update, "effective_chat") and update.effective_chat else None
+            message = getattr(update, "message", None)
+            callback_query = getattr(update, "callback_query", None)
+            effective_user = getattr(update, "effective_user", None)
+            effective_chat = getattr(update, "effective_chat", None)
+            
+            error_context["update_id"] = getattr(update, "update_id", None)
+            error_context["user_id"] = effective_user.id if effective_user else None
+            error_context["chat_id"] = effective_chat.id if effective_chat else None
             
             # Add callback data if present
-            if hasattr(update, "callback_query") and update.callback_query:
-                error_context["callback_data"] = update.callback_query.data
+            if callback_query:
+                error_context["callback_data"] = callback_query.data
             
             # Add message text or document if present
-            if hasattr(update, "message") and update.message:
-                if update.message.text:
-                    error_context["message_text"] = update.message.text
-                elif update.message.document:
-                    error_context["document_filename"] = update.message.document.file_name
+            if message:
+                if message.text:
+                    error_context["message_text"] = message.text
+                elif message.document:
+                    error_context["document_filename"] = message.document.file_name
     except Exception as context_error:
         error_context["context_extraction_error"] = str(context_error)
     
@@ -3558,65 +3918,59 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # Use enhanced logging if available
     if ENHANCED_LOGGING:
-        error_details = log_exception(error, error_context)
+        log_exception(error, error_context)
     else:
-        # Basic logging
-        logger.error("Exception while handling an update:", exc_info=error)
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        stack_trace = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        error_details = f"Error: {str(error)}\nStack Trace: {''.join(stack_trace)}"
-        
-    # Format error message for admin notification
-    error_message = f"⚠️ *خطای سیستمی*\n\n"
-    
-    # Add user information
-    if hasattr(update, "effective_user") and update.effective_user:
-        user = update.effective_user
-        error_message += f"👤 کاربر: {user.full_name} (@{user.username})\n"
-        error_message += f"🆔 آیدی: `{user.id}`\n\n"
-    
-    # Add error type and message
-    error_message += f"❌ نوع خطا: `{error.__class__.__name__}`\n"
-    error_message += f"📝 پیام خطا: `{str(error)[:100]}`\n\n"
-    
-    # Add context of where error occurred
-    if hasattr(update, "callback_query") and update.callback_query:
-        error_message += f"🔄 Callback: `{update.callback_query.data}`\n"
-    elif hasattr(update, "message") and update.message:
-        if update.message.text:
-            error_message += f"💬 پیام: `{update.message.text[:50]}`\n"
-        elif update.message.document:
-            error_message += f"📎 فایل: `{update.message.document.file_name}`\n"
-    
-    # Add timestamp
-    error_message += f"⏰ زمان: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`\n"
-    
-    # Add log file location
-    error_message += f"📂 فایل لاگ: `{os.path.join(LOG_DIR, 'error.log')}`"
-    
-    # Try to notify admin
-    try:
-        admin_id = os.environ.get("ADMIN_ID")
-        if admin_id:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=error_message,
-                parse_mode="Markdown"
-            )
-    except Exception as notify_error:
-        logger.error(f"Failed to notify admin about error: {notify_error}")
+        # Basic logging; the handler formats the traceback of exc_info itself
+        logger.error("Exception while handling an update: %s", error_context, exc_info=error)
         
-    # If this was from a user, inform them about the error (only private chats)
-    try:
-        if (hasattr(update, "effective_chat") and update.effective_chat and 
-            hasattr(update, "effective_user") and update.effective_user and
-            update.effective_chat.type == "private"):
-            await context.bot.send_message(
-                chat_id=update.effective_user.id,  # Use user ID instead of chat ID
-                text="❌ خطایی در سیستم رخ داده است. لطفاً مجدداً تلاش کنید یا با پشتیبانی تماس بگیرید.\n\n💬 پشتیبانی: @AccountYarSup"
-            )
-    except Exception as inform_error:
-        logger.error(f"Failed to inform user about error: {inform_error}")
+    async def notify_admin():
+        # Format error message for admin notification
+        parts = [ERROR_ALERT_HEADER]
+        
+        # Add user information
+        if effective_user:
+            user = effective_user
+            parts.append(f"👤 کاربر: {user.full_name} (@{user.username})\n🆔 آیدی: `{user.id}`\n\n")
+        
+        # Add error type and message
+        parts.append(f"❌ نوع خطا: `{error.__class__.__name__}`\n📝 پیام خطا: `{str(error)[:100]}`\n\n")
+        
+        # Add context of where error occurred
+        if callback_query:
+            parts.append(f"🔄 Callback: `{callback_query.data}`\n")
+        elif message:
+            if message.text:
+                parts.append(f"💬 پیام: `{message.text[:50]}`\n")
+            elif message.document:
+                parts.append(f"📎 فایل: `{message.document.file_name}`\n")
+        
+        # Add timestamp and log file location
+        parts.append(f"⏰ زمان: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`\n")
+        parts.append(ERROR_ALERT_FOOTER)
+        error_message = "".join(parts)
+        
+        try:
+            await send_error_alert(context.bot, error.__class__.__name__, error_message)
+        except Exception as notify_error:
+            logger.error(f"Failed to notify admin about error: {notify_error}")
+    
+    async def inform_user():
+        # If this was from a user, inform them about the error (only private chats)
+        try:
+            if effective_chat and effective_user and effective_chat.type == "private":
+                await context.bot.send_message(
+                    chat_id=effective_user.id,  # Use user ID instead of chat ID
+                    text=USER_ERROR_TEXT
+                )
+        except Exception as inform_error:
+            logger.error(f"Failed to inform user about error: {inform_error}")
+    
+    # The admin notification and the user's apology are independent, so they are sent concurrently;
+    # without ADMIN_ID the admin message isn't even built
+    if ADMIN_ID:
+        await asyncio.gather(notify_admin(), inform_user(), return_exceptions=True)
+    else:
+        await inform_user()
 
 
 async def async_main() -> None:
@@ -3630,7 +3984,13 @@ async def async_main() -> None:
             return
 
         logger.info("BOT_TOKEN is set, creating application...")
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Dispatch updates of different users concurrently, while each user's updates stay in order
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(PerUserUpdateProcessor(256))
+            .build()
+        )
         logger.info("Application created successfully")
 
         # Initialize database
@@ -3658,7 +4018,6 @@ async def async_main() -> None:
         
         # Admin conversation handlers - MOVED BEFORE main CallbackQueryHandler
         logger.info("Setting up conversation handlers...")
-        from telegram.ext import ConversationHandler
         
         # Try to import seat editing handler, fallback if not available
         try:
@@ -3730,11 +4089,15 @@ async def async_main() -> None:
         await application.start()
         await application.updater.start_polling()
         
+        # Start the outgoing message workers and background flushing of buffered writes
+        outbox.start()
+        utm_flush_task = asyncio.create_task(utm_flush_loop())
+        receipt_msg_flush_task = asyncio.create_task(receipt_msg_flush_loop())
+        error_alert_flush_task = asyncio.create_task(error_alert_flush_loop(application.bot))
+        
         logger.info("Bot is now running. Press Ctrl+C to stop.")
         
         # Keep the bot running until interrupted
-        import signal
-        import asyncio
         
         stop_event = asyncio.Event()
         
@@ -3749,20 +4112,23 @@ async def async_main() -> None:
             await stop_event.wait()
         finally:
             logger.info("Shutting down bot...")
+            utm_flush_task.cancel()
+            receipt_msg_flush_task.cancel()
+            error_alert_flush_task.cancel()
+            await flush_utm_starts()
+            await flush_receipt_msgs()
             await application.updater.stop()
             await application.stop()
+            await outbox.stop()
             await application.shutdown()
         
     except Exception as e:
-        logger.error(f"Critical error in async_main: {e}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Critical error in async_main: %s", e)
         raise
 
 
 def main() -> None:
     """Start the bot."""
-    import asyncio
     asyncio.run(async_main())
 
 
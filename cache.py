@@ -0,0 +1,85 @@
+"""
+In-process caches for Wind Reseller
+- Small TTL cache used for hot lookups (admin flags, decrypted secrets, ...)
+- Shared cache instances, kept here so bot.py and the handlers modules use the same objects
+"""
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Small dict-backed cache whose entries expire `ttl` seconds after being set.
+
+    When `maxsize` is reached the cache is simply cleared; entries are cheap to refill.
+    Each call is a single dict operation, so it may also be used from to_thread workers.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[Hashable, Tuple[Any, float]] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, or default if missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[1] <= time.monotonic():
+            self._data.pop(key, None)
+            return default
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Cache a value for key."""
+        if len(self._data) >= self.maxsize and key not in self._data:
+            self._data.clear()
+        self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def pop(self, key: Hashable) -> None:
+        """Drop a cached value, if present."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all cached values."""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Admin flag per Telegram user id. Admin changes are made from other processes (cli.py,
+# web_admin), so a promotion or demotion reaches the bot once the entry expires.
+admin_cache = TTLCache(ttl=300)
+
+# Decrypted TOTP secret per seat id
+seat_secret_cache = TTLCache(ttl=600, maxsize=10000)
+
+# pyotp.TOTP object per seat id, so the base32 secret is not parsed on every code request
+seat_totp_cache = TTLCache(ttl=600, maxsize=10000)
+
+# Current (time window, 2FA code) per seat id; a code stays the same for its whole 30 second window
+seat_code_cache = TTLCache(ttl=30, maxsize=10000)
+
+# Settings table values per key
+settings_cache = TTLCache(ttl=30)
+
+# Active payment cards (title, card_number), stored under a single key
+cards_cache = TTLCache(ttl=30)
+
+
+def invalidate_seat(seat_id: Optional[int] = None) -> None:
+    """Drop cached data of a seat (or of all seats) after its credentials change."""
+    if seat_id is None:
+        seat_secret_cache.clear()
+        seat_totp_cache.clear()
+        seat_code_cache.clear()
+    else:
+        seat_secret_cache.pop(seat_id)
+        seat_totp_cache.pop(seat_id)
+        seat_code_cache.pop(seat_id)
+
+
+def invalidate_cards() -> None:
+    """Drop the cached payment cards after a card is added, edited or removed."""
+    cards_cache.clear()
@@ -6,13 +6,18 @@ Database module for Wind Reseller
 """
 import logging
 import os
+import weakref
 from contextlib import contextmanager
 from pathlib import Path
+from urllib.parse import urlparse
 
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+import cache
+
 # Load environment variables
 load_dotenv()
 
@@ -25,10 +30,24 @@ if not DB_URI:
     logger.error("DB_URI environment variable not set")
     raise ValueError("DB_URI environment variable not set")
 
-# Create a global connection pool (min: 1, max: 10 connections)
+# Parse DB_URI once for anything that needs its parts (never log the password)
+_db_url = urlparse(DB_URI)
+DB_HOST = _db_url.hostname or "localhost"
+DB_PORT = _db_url.port or 5432
+DB_NAME = _db_url.path.lstrip("/")
+
+# Pool sizing (can be tuned from the environment)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "50"))
+
+# Create a global thread-safe connection pool, so connections can be shared
+# between the event loop and worker threads
 try:
-    connection_pool = pool.SimpleConnectionPool(1, 10, DB_URI)
-    logger.info("Database connection pool initialized")
+    connection_pool = pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_URI)
+    logger.info(
+        f"Database connection pool initialized ({DB_HOST}:{DB_PORT}/{DB_NAME}, "
+        f"{DB_POOL_MIN}-{DB_POOL_MAX} connections)"
+    )
 except psycopg2.Error as e:
     logger.error(f"Error initializing database connection pool: {e}")
     raise
@@ -57,7 +76,108 @@ def get_conn():
         raise
     finally:
         if conn:
-            connection_pool.putconn(conn)
+            # Don't hand a dead connection (e.g. after a server restart) to the next caller
+            connection_pool.putconn(conn, close=bool(conn.closed))
+
+
+# Hot statements, prepared once per pooled connection on first use: name -> (argument types, query)
+PREPARED_STATEMENTS = {
+    "is_admin": ("bigint", "SELECT is_admin FROM users WHERE tg_id = $1"),
+    "upsert_user": (
+        "bigint, text, text",
+        """WITH u AS (
+               INSERT INTO users (tg_id, first_name, username) VALUES ($1, $2, $3)
+               ON CONFLICT (tg_id) DO UPDATE
+               SET first_name = EXCLUDED.first_name, username = EXCLUDED.username
+               RETURNING id, (xmax = 0) AS created
+           ), w AS (
+               INSERT INTO wallets (user_id)
+               SELECT id FROM u WHERE created
+               ON CONFLICT (user_id) DO NOTHING
+           )
+           SELECT id, created FROM u""",
+    ),
+    "approved_services": (
+        "bigint",
+        """SELECT o.id, s.email 
+           FROM users u 
+           JOIN orders o ON o.user_id = u.id 
+           JOIN seats s ON o.seat_id = s.id 
+           WHERE u.tg_id = $1 AND o.status = 'approved' 
+           ORDER BY o.approved_at DESC""",
+    ),
+    "create_order": (
+        "bigint, numeric, text",
+        """WITH u AS (
+               SELECT id FROM users WHERE tg_id = $1
+           ), o AS (
+               INSERT INTO orders (user_id, amount, utm_keyword)
+               SELECT id, $2, $3 FROM u
+               RETURNING id
+           ), l AS (
+               INSERT INTO order_log (order_id, event)
+               SELECT id, 'Order created for one-month plan' FROM o
+           )
+           SELECT id FROM o""",
+    ),
+    "pending_order": (
+        "bigint",
+        """SELECT o.id FROM orders o JOIN users u ON o.user_id = u.id
+           WHERE u.tg_id = $1 AND o.status = 'pending' ORDER BY o.created_at DESC LIMIT 1""",
+    ),
+    "submit_receipt": (
+        "bigint, text, bigint",
+        """WITH o AS (
+               UPDATE orders SET status = 'receipt' WHERE id = $1 AND status = 'pending'
+               RETURNING id
+           ), r AS (
+               INSERT INTO receipts (order_id, tg_file_id, orig_chat_id)
+               SELECT id, $2, $3 FROM o
+               ON CONFLICT (order_id) DO NOTHING
+               RETURNING order_id
+           )
+           INSERT INTO order_log (order_id, event)
+           SELECT order_id, 'Receipt submitted' FROM r
+           RETURNING order_id""",
+    ),
+    "take_seat": (
+        "",
+        """UPDATE seats SET sold = sold + 1
+           WHERE id = (
+               SELECT id FROM seats
+               WHERE status = 'active' AND sold < max_slots
+               ORDER BY sold DESC
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, email, pass_enc, secret_enc, max_slots, sold""",
+    ),
+}
+
+# Names prepared on each connection (prepared statements live as long as the session)
+_prepared_names = weakref.WeakKeyDictionary()
+
+
+def execute_prepared(cur, name, params=()):
+    """
+    Execute one of PREPARED_STATEMENTS with the given cursor.
+    The statement is prepared on the cursor's connection the first time it is used there.
+    """
+    prepared = _prepared_names.setdefault(cur.connection, set())
+    if name not in prepared:
+        arg_types, query = PREPARED_STATEMENTS[name]
+        signature = f" ({arg_types})" if arg_types else ""
+        cur.execute(f"PREPARE {name}{signature} AS {query}")
+        prepared.add(name)
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+# Marks a settings key that isn't cached
+_MISSING = object()
 
 
 def get_setting(key, default=None):
@@ -71,17 +191,52 @@ def get_setting(key, default=None):
     Returns:
         The setting value or default if not found
     """
+    # Settings change rarely, so values are cached for a few seconds
+    val = cache.settings_cache.get(key, _MISSING)
+    if val is not _MISSING:
+        return default if val is None else val
+    
     try:
         with get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT val FROM settings WHERE key = %s", (key,))
                 result = cur.fetchone()
-                return result[0] if result else default
+                val = result[0] if result else None
+                cache.settings_cache.set(key, val)
+                return default if val is None else val
     except Exception as e:
         logger.error(f"Error getting setting {key}: {e}")
         return default
 
 
+def get_setting_int(key, default):
+    """
+    Get a setting value parsed as an integer.
+    The parsed value is cached, so hot paths don't re-parse the string on every call.
+    
+    Args:
+        key: The setting key
+        default: Integer to return if the setting is missing or not a number
+        
+    Returns:
+        The setting value as an int
+    """
+    cache_key = (key, int)
+    val = cache.settings_cache.get(cache_key)
+    if val is not None:
+        return val
+    
+    raw = get_setting(key)
+    try:
+        val = int(raw) if raw is not None else default
+    except (TypeError, ValueError):
+        logger.error(f"Setting {key} is not an integer: {raw!r}")
+        val = default
+    
+    cache.settings_cache.set(cache_key, val)
+    return val
+
+
 def set_setting(key, val):
     """
     Set a setting value in the settings table.
@@ -103,6 +258,8 @@ def set_setting(key, val):
                     (key, val, val)
                 )
                 conn.commit()
+                cache.settings_cache.pop(key)
+                cache.settings_cache.pop((key, int))
                 return True
     except Exception as e:
         logger.error(f"Error setting {key}={val}: {e}")
@@ -151,6 +308,67 @@ def inc_utm(keyword, field, inc_amount=1):
         return False
 
 
+def add_utm_starts(counts):
+    """
+    Add buffered start counts to utm_stats in a single statement.
+    
+    Args:
+        counts: Iterable of (keyword, starts) pairs
+        
+    Returns:
+        True if successful, False otherwise
+    """
+    counts = [(keyword, starts) for keyword, starts in counts if keyword]
+    if not counts:
+        return True
+    
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO utm_stats (keyword, starts) VALUES %s "
+                    "ON CONFLICT (keyword) DO UPDATE SET starts = utm_stats.starts + EXCLUDED.starts",
+                    counts
+                )
+                conn.commit()
+                return True
+    except Exception as e:
+        logger.error(f"Error adding UTM starts for {len(counts)} keywords: {e}")
+        return False
+
+
+def set_receipt_channel_msgs(rows):
+    """
+    Store the receipt channel message IDs of several orders in a single statement.
+    
+    Args:
+        rows: Iterable of (order_id, channel_msg_id) pairs
+        
+    Returns:
+        True if successful, False otherwise
+    """
+    rows = list(rows)
+    if not rows:
+        return True
+    
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "UPDATE receipts SET channel_msg_id = data.msg_id "
+                    "FROM (VALUES %s) AS data (order_id, msg_id) "
+                    "WHERE receipts.order_id = data.order_id",
+                    rows
+                )
+                conn.commit()
+                return True
+    except Exception as e:
+        logger.error(f"Error storing channel message IDs of {len(rows)} receipts: {e}")
+        return False
+
+
 def table_exists(table_name):
     """Check if a table exists in the database."""
     try:
@@ -192,6 +410,24 @@ def apply_migrations():
                 CREATE INDEX IF NOT EXISTS idx_orders_twofa_last ON orders(twofa_last);
                 """)
                 
+                # Partial index so the approved-sales aggregates of the admin stats are index-only
+                cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_approved_amount ON orders(amount) WHERE status = 'approved';
+                """)
+                
+                # Partial index for the latest-pending-order lookup of receipt photos
+                cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_user_pending ON orders(user_id, created_at DESC) INCLUDE (id) WHERE status = 'pending';
+                """)
+                
+                # Stored free_slots column plus covering index for free-slot totals of active seats
+                cur.execute("""
+                ALTER TABLE seats ADD COLUMN IF NOT EXISTS free_slots INTEGER GENERATED ALWAYS AS (max_slots - sold) STORED;
+                """)
+                cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_seats_active_free ON seats(status) INCLUDE (free_slots) WHERE status = 'active';
+                """)
+                
                 # Update existing orders to have default twofa_count values
                 cur.execute("""
                 UPDATE orders SET twofa_count = 0 WHERE twofa_count IS NULL;
@@ -2,13 +2,13 @@
 Admin account management handlers.
 Implements list view with pagination and CRUD operations for seat accounts.
 """
-import re
 import logging
 from typing import Optional, Tuple, List, Dict, Any
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
+import cache
 import db
 from bot import encrypt, decrypt, check_admin
 
@@ -37,7 +37,7 @@ async def handle_accounts_list(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     # Store the current page in user_data for reference when returning from other operations
-    context.user_data['last_list_page'] = f"admin:list|{page}"
+    context.user_data['last_list_page'] = page
     
     # Calculate offset
     offset = (page - 1) * PAGE_SIZE
@@ -161,8 +161,7 @@ async def handle_seat_delete(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     return
                 
                 # Get the current page to return to it after deletion
-                match = re.search(r"admin:list\|(\d+)", context.user_data.get('last_list_page', 'admin:list|1'))
-                current_page = int(match.group(1)) if match else 1
+                current_page = context.user_data.get('last_list_page', 1)
                 
                 # Soft delete the seat by setting status to 'disabled'
                 cur.execute(
@@ -215,17 +214,11 @@ async def handle_seat_edit_prompt(update: Update, context: ContextTypes.DEFAULT_
                 
                 seat_id, username, pass_enc, secret_enc, max_slots, sold = result  # content is username but column is email
                 
-                # Set editing mode in user_data
-                context.user_data['editing_seat'] = seat_id
-                
-                # Import the state constant
-                from bot import ADMIN_WAITING_EDIT_SEAT
-                # Return the conversation state
-                return ADMIN_WAITING_EDIT_SEAT
+                # Set editing mode in user_data; the next text message is routed to process_seat_edit in bot.py
+                context.user_data['edit_seat_id'] = seat_id
                 
                 # Get the current page to return to after editing
-                match = re.search(r"admin:list\|(\d+)", context.user_data.get('last_list_page', 'admin:list|1'))
-                current_page = int(match.group(1)) if match else 1
+                current_page = context.user_data.get('last_list_page', 1)
                 context.user_data['edit_return_page'] = current_page
                 
                 # Create keyboard
@@ -374,6 +367,7 @@ async def process_seat_edit(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 query = f"UPDATE seats SET {', '.join(update_fields)} WHERE id = %s"
                 cur.execute(query, update_values)
                 conn.commit()
+                cache.invalidate_seat(seat_id)
                 
                 # Send confirmation
                 await message.reply_text(
@@ -8,6 +8,7 @@ from typing import Optional, List, Dict, Any, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
+import cache
 import db
 
 # Setup logging
@@ -204,6 +205,7 @@ async def process_add_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 )
                 card_id = cur.fetchone()[0]
                 conn.commit()
+                cache.invalidate_cards()
         
         # Success message
         await message.reply_text(
@@ -240,6 +242,7 @@ async def delete_card(update: Update, context: ContextTypes.DEFAULT_TYPE, card_i
                 )
                 result = cur.fetchone()
                 conn.commit()
+                cache.invalidate_cards()
                 
                 if result:
                     title, number = result
@@ -392,6 +395,7 @@ async def process_edit_card(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     (new_title, new_number, card_id)
                 )
                 conn.commit()
+                cache.invalidate_cards()
                 
                 if cur.rowcount == 0:
                     await message.reply_text(
@@ -2,6 +2,7 @@
 Admin pricing handlers.
 Handles setting and updating prices for different subscription periods.
 """
+import asyncio
 import logging
 from typing import Optional, Union
 
@@ -35,10 +36,9 @@ async def handle_change_price(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text("شما دسترسی ادمین ندارید.")
         return -1
     
-    # Get current price
-    default_value = '70000'
+    # Get current price (parsed and cached by the settings layer)
     price_label = "سرویس" if price_type == "service_price" else "یک‌ماهه"
-    current_price = db.get_setting(price_type, default_value)
+    current_price = await asyncio.to_thread(db.get_setting_int, price_type, 70000)
     
     # Set the awaiting flag and send instructions
     context.user_data['awaiting_price'] = True
@@ -46,7 +46,7 @@ async def handle_change_price(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     await query.edit_message_text(
         f"💸 *تغییر قیمت {price_label}*\n\n"
-        f"قیمت فعلی: {int(current_price):,} تومان\n\n"
+        f"قیمت فعلی: {current_price:,} تومان\n\n"
         f"قیمت جدید {price_label} (تومان) را وارد کنید:",
         parse_mode="Markdown"
     )
@@ -81,7 +81,7 @@ async def process_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             return -1
         
         # Update price in database
-        if db.set_setting(price_type, str(price)):
+        if await asyncio.to_thread(db.set_setting, price_type, str(price)):
             await update.message.reply_text(
                 f"✅ *قیمت {price_label} با موفقیت به {price:,} تومان تغییر یافت*",
                 parse_mode="Markdown",
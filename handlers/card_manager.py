@@ -6,6 +6,7 @@ import logging
 import random
 from typing import Tuple, Optional
 
+import cache
 import db
 from debug_logger import log_function_call
 
@@ -22,11 +23,18 @@ def get_random_payment_card() -> Tuple[Optional[str], Optional[str]]:
         Tuple[str, str]: Title and number of the card, or (None, None) if no cards
     """
     try:
+        # Active cards change rarely, so the list is cached for a few seconds
+        cards = cache.cards_cache.get("active")
+        if cards:
+            card = random.choice(cards)
+            return card[0], card[1]
+        
         with db.get_conn() as conn:
             with conn.cursor() as cur:
                 # Try to get active cards from the cards table
                 cur.execute("SELECT title, card_number FROM cards WHERE active = TRUE")
                 cards = cur.fetchall()
+                cache.cards_cache.set("active", cards)
                 
                 if not cards:
                     # Fallback: Get card from settings
@@ -0,0 +1,4 @@
+-- Migration: Partial index for approved-order aggregates
+-- Description: Lets the admin stats count and sum approved orders with an index-only scan
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_approved_amount ON orders(amount) WHERE status = 'approved';
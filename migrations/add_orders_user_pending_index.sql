@@ -0,0 +1,4 @@
+-- Migration: Partial index for the pending-order lookup
+-- Description: Finds a user's latest pending order (receipt photos) with an index-only scan
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_user_pending ON orders(user_id, created_at DESC) INCLUDE (id) WHERE status = 'pending';
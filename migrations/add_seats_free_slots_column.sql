@@ -0,0 +1,6 @@
+-- Migration: Stored free_slots column on seats
+-- Description: Keeps max_slots - sold precomputed so free-slot totals of active seats are index-only
+
+ALTER TABLE seats ADD COLUMN IF NOT EXISTS free_slots INTEGER GENERATED ALWAYS AS (max_slots - sold) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_seats_active_free ON seats(status) INCLUDE (free_slots) WHERE status = 'active';
@@ -18,9 +18,13 @@ CREATE TABLE seats (
     secret_enc BYTEA NOT NULL,
     max_slots INTEGER DEFAULT 15,
     sold INTEGER DEFAULT 0,
-    status VARCHAR(10) DEFAULT 'active'
+    status VARCHAR(10) DEFAULT 'active',
+    free_slots INTEGER GENERATED ALWAYS AS (max_slots - sold) STORED
 );
 
+-- Covering index so free-slot totals of active seats are index-only
+CREATE INDEX idx_seats_active_free ON seats(status) INCLUDE (free_slots) WHERE status = 'active';
+
 -- Order status enum
 CREATE TYPE order_status AS ENUM ('pending', 'receipt', 'approved', 'rejected');
 
@@ -90,4 +94,6 @@ CREATE INDEX idx_orders_user_id ON orders(user_id);
 CREATE INDEX idx_orders_status ON orders(status);
 CREATE INDEX idx_orders_created_at ON orders(created_at);
 CREATE INDEX idx_orders_twofa_last ON orders(twofa_last);
+CREATE INDEX idx_orders_approved_amount ON orders(amount) WHERE status = 'approved';
+CREATE INDEX idx_orders_user_pending ON orders(user_id, created_at DESC) INCLUDE (id) WHERE status = 'pending';
 CREATE INDEX idx_order_log_order_id ON order_log(order_id);
@@ -0,0 +1,109 @@
+"""Order approval: seat claim and approval statements in one transaction."""
+from contextlib import contextmanager
+
+import pytest
+
+ORDER = ("receipt", 5, 100000, "instagram", 111, 7, 55)
+SEAT = (3, "user@example.com", b"pass-token", b"secret-token", 3, 2)
+
+
+class FakeCursor:
+    """Cursor that answers fetchone() from a script and records executed statements."""
+
+    def __init__(self, conn, results, fail_on=None):
+        self.connection = conn
+        self.results = list(results)
+        self.fail_on = fail_on
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        query = " ".join(query.split())
+        if self.fail_on and query.startswith(self.fail_on):
+            raise RuntimeError("statement failed")
+        self.executed.append((query, params))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+class FakeConn:
+    def __init__(self, results, fail_on=None):
+        self.cur = FakeCursor(self, results, fail_on)
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+@pytest.fixture
+def approve(bot, monkeypatch):
+    """Run _db_approve_order(42) against scripted query results; returns (result, conns)."""
+
+    def run(*results, fail_on=None):
+        conns = []
+
+        @contextmanager
+        def get_conn():
+            conn = FakeConn(results, fail_on)
+            conns.append(conn)
+            yield conn
+
+        monkeypatch.setattr(bot.db, "get_conn", get_conn)
+        try:
+            return bot._db_approve_order(42), conns
+        except RuntimeError:
+            return None, conns
+
+    return run
+
+
+def test_seat_is_claimed_in_the_approval_transaction(approve):
+    (ok, info), conns = approve(ORDER, SEAT)
+
+    assert ok is True
+    assert info["seat"]["id"] == 3 and info["seat"]["sold"] == 2
+    # One connection, one commit covering both the seat claim and the approval
+    assert len(conns) == 1
+    conn = conns[0]
+    assert conn.commits == 1 and conn.rollbacks == 0
+    queries = [query for query, _ in conn.cur.executed]
+    claim = queries.index("EXECUTE take_seat")
+    approval = next(i for i, query in enumerate(queries) if query.startswith("WITH ord AS"))
+    assert claim < approval
+    assert conn.cur.executed[approval][1]["seat_id"] == 3
+
+
+def test_no_free_seat_rolls_back_the_order_lock(approve):
+    (ok, _), conns = approve(ORDER, None)
+
+    assert ok is False
+    conn = conns[0]
+    assert conn.commits == 0 and conn.rollbacks == 1
+    assert not any(query.startswith("WITH ord AS") for query, _ in conn.cur.executed)
+
+
+def test_failed_approval_does_not_commit_the_seat_claim(approve):
+    result, conns = approve(ORDER, SEAT, fail_on="WITH ord AS")
+
+    assert result is None
+    assert len(conns) == 1 and conns[0].commits == 0
+
+
+def test_order_that_is_not_pending_takes_no_seat(approve):
+    (ok, _), conns = approve(("approved",) + ORDER[1:])
+
+    assert ok is False
+    assert not any("take_seat" in query for query, _ in conns[0].cur.executed)
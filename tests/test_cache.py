@@ -0,0 +1,51 @@
+"""TTLCache expiry and size handling."""
+import cache
+
+
+def test_get_returns_value_until_it_expires(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: clock[0])
+    ttl_cache = cache.TTLCache(ttl=30)
+
+    ttl_cache.set("key", "value")
+    clock[0] = 129.9
+    assert ttl_cache.get("key") == "value"
+
+    clock[0] = 130.0
+    assert ttl_cache.get("key", "default") == "default"
+    assert len(ttl_cache) == 0
+
+
+def test_cached_falsy_values_are_returned():
+    ttl_cache = cache.TTLCache(ttl=30)
+    ttl_cache.set("flag", False)
+
+    assert ttl_cache.get("flag", "missing") is False
+
+
+def test_full_cache_is_cleared_before_adding_a_new_key():
+    ttl_cache = cache.TTLCache(ttl=30, maxsize=2)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+
+    # Updating an existing key keeps the others
+    ttl_cache.set("b", 3)
+    assert len(ttl_cache) == 2
+
+    ttl_cache.set("c", 4)
+    assert len(ttl_cache) == 1
+    assert ttl_cache.get("a") is None
+    assert ttl_cache.get("c") == 4
+
+
+def test_invalidate_seat_drops_one_or_all_seats():
+    for seat_cache in (cache.seat_secret_cache, cache.seat_totp_cache, cache.seat_code_cache):
+        seat_cache.set(1, "one")
+        seat_cache.set(2, "two")
+
+    cache.invalidate_seat(1)
+    assert cache.seat_secret_cache.get(1) is None
+    assert cache.seat_code_cache.get(2) == "two"
+
+    cache.invalidate_seat()
+    assert len(cache.seat_secret_cache) == len(cache.seat_totp_cache) == len(cache.seat_code_cache) == 0
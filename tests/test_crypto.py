@@ -0,0 +1,46 @@
+"""Batch decryption and encryption helpers used by the CSV export and import."""
+import pytest
+from cryptography.fernet import Fernet
+
+
+def test_decrypt_many_accepts_stored_token_types(bot):
+    token = bot.encrypt("value")
+
+    assert bot.decrypt_many([token, memoryview(token), token.decode()]) == ["value"] * 3
+
+
+def test_decrypt_many_reads_tokens_from_a_stock_fernet(bot):
+    fernet = Fernet(bot.FERNET_KEY.encode())
+
+    assert bot.decrypt_many([fernet.encrypt(b"legacy"), fernet.encrypt("رمز".encode())]) == ["legacy", "رمز"]
+
+
+def test_decrypt_many_rejects_foreign_tokens(bot):
+    foreign = Fernet(Fernet.generate_key()).encrypt(b"value")
+
+    with pytest.raises(ValueError):
+        bot.decrypt_many([bot.encrypt("ok"), foreign])
+
+
+def test_decrypt_many_keeps_order(bot):
+    values = [str(i) for i in range(50)]
+
+    assert bot.decrypt_many([bot.encrypt(value) for value in values]) == values
+    assert bot.decrypt_many([]) == []
+
+
+def test_encrypt_many_round_trip(bot):
+    values = ["secret", "", "رمز عبور", 'a,b"c\nd']
+    tokens = bot.encrypt_many(values)
+
+    assert len(tokens) == len(values)
+    assert bot.decrypt_many(tokens) == values
+
+
+def test_encrypt_many_tokens_are_plain_fernet(bot):
+    # Tokens must stay readable by a stock Fernet with the configured key
+    fernet = Fernet(bot.FERNET_KEY.encode())
+    tokens = bot.encrypt_many(["one", b"two"])
+
+    assert [fernet.decrypt(token) for token in tokens] == [b"one", b"two"]
+    assert bot.encrypt_many([]) == []
@@ -0,0 +1,74 @@
+"""Parsing of the COPY ... TO STDOUT stream in the seats CSV export."""
+import csv
+import io
+
+
+def _copy_line(bot, username, password, secret, free_slots):
+    """One COPY csv record the way Postgres writes it: username quoted, tokens as text."""
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerow([
+        username,
+        bot.encrypt(password).decode(),
+        bot.encrypt(secret).decode(),
+        free_slots,
+    ])
+    return buf.getvalue().encode()
+
+
+def _export(bot, stream, chunk_size):
+    out = io.BytesIO()
+    sink = bot._SeatsCsvSink(out)
+    for start in range(0, len(stream), chunk_size):
+        sink.write(stream[start:start + chunk_size])
+    sink.flush()
+    return out.getvalue()
+
+
+SEATS = [
+    ("plain", "pass1", "SECRET1", 3),
+    ("with,comma", "p,ss", "SECRET2", 0),
+    ('with "quotes"', 'pa"ss', "SECRET3", 1),
+    ("multi\nline", "line\nbreak", "SECRET4", 2),
+    ("last", "", "SECRET5", 5),
+]
+
+
+def test_sink_decrypts_every_record(bot):
+    stream = b"".join(_copy_line(bot, *seat) for seat in SEATS)
+    rows = list(csv.reader(io.StringIO(_export(bot, stream, len(stream)).decode(), newline="")))
+
+    assert rows == [[username, password, secret, str(slots)] for username, password, secret, slots in SEATS]
+
+
+def test_sink_handles_arbitrary_chunk_boundaries(bot):
+    stream = b"".join(_copy_line(bot, *seat) for seat in SEATS)
+    expected = _export(bot, stream, len(stream))
+
+    for chunk_size in (1, 2, 7, 64):
+        assert _export(bot, stream, chunk_size) == expected
+
+
+def test_sink_writes_crlf_rows_and_quotes_only_when_needed(bot):
+    stream = _copy_line(bot, "user", "pass", "SECRET", 4) + _copy_line(bot, "user2", "a,b", "SECRET", 0)
+
+    assert _export(bot, stream, 5) == b'user,pass,SECRET,4\r\nuser2,"a,b",SECRET,0\r\n'
+
+
+def test_sink_flushes_full_chunks_while_writing(bot, monkeypatch):
+    monkeypatch.setattr(bot, "CSV_EXPORT_CHUNK_SIZE", 2)
+    out = io.BytesIO()
+    sink = bot._SeatsCsvSink(out)
+
+    sink.write(_copy_line(bot, "user0", "pass", "SECRET", 0))
+    assert out.getvalue() == b""
+
+    # The second record fills the chunk, the third waits for the next one or flush()
+    sink.write(_copy_line(bot, "user1", "pass", "SECRET", 1))
+    sink.write(_copy_line(bot, "user2", "pass", "SECRET", 2))
+    assert out.getvalue().count(b"\r\n") == 2
+    sink.flush()
+    assert out.getvalue().count(b"\r\n") == 3
+
+
+def test_sink_flush_without_records_writes_nothing(bot):
+    assert _export(bot, b"", 1) == b""
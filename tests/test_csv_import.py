@@ -0,0 +1,62 @@
+"""Row validation of the seats CSV import."""
+import io
+from contextlib import contextmanager
+
+import pytest
+
+
+@pytest.fixture
+def ingest(bot, monkeypatch):
+    """Run _ingest_seats_csv over CSV text; returns (stats, {username: max_slots} inserted)."""
+    inserted = {}
+
+    @contextmanager
+    def get_conn():
+        yield object()
+
+    def insert_seats(conn, rows):
+        for email, pass_enc, secret_enc, max_slots in rows:
+            inserted[email] = max_slots
+        return len(rows)
+
+    monkeypatch.setattr(bot.db, "get_conn", get_conn)
+    monkeypatch.setattr(bot, "_db_insert_seats", insert_seats)
+
+    def run(text):
+        stats = bot._ingest_seats_csv(io.BytesIO(text.encode()), "utf-8", lambda snapshot: None)
+        return stats, inserted
+
+    return run
+
+
+def test_slots_default_and_explicit_values(ingest):
+    stats, inserted = ingest(
+        "username,password,secret,slots\n"
+        "alice,pw,SECRET,\n"
+        "bobby,pw,SECRET,4\n"
+        "carol,pw,SECRET,+7\n"
+    )
+
+    assert inserted == {"alice": 15, "bobby": 4, "carol": 7}
+    assert stats["error_count"] == 0 and stats["errors"] == []
+
+
+def test_slots_below_one_reject_the_row(ingest):
+    stats, inserted = ingest(
+        "username,password,secret,slots\n"
+        "alice,pw,SECRET,0\n"
+        "bobby,pw,SECRET,-2\n"
+        "carol,pw,SECRET,3\n"
+    )
+
+    assert inserted == {"carol": 3}
+    assert stats["error_count"] == 2
+    assert stats["errors"] == ["Row 1: Slots must be at least 1", "Row 2: Slots must be at least 1"]
+
+
+def test_non_numeric_slots_fall_back_to_the_default(ingest):
+    stats, inserted = ingest("username,password,secret,slots\nalice,pw,SECRET,many\n")
+
+    assert inserted == {"alice": 15}
+    assert stats["error_count"] == 0
+    assert stats["errors"] == ["Row 1: Invalid slots value, using default"]
@@ -0,0 +1,122 @@
+"""Ordering, per-chat pacing and rate limiting of the central outbox."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep; sleeping just moves the clock forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(bot, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(bot.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def test_rate_limiter_refills_one_token_per_interval(bot, clock):
+    async def main():
+        limiter = bot.AsyncRateLimiter(2, period=1.0)
+
+        # The bucket starts full
+        await limiter.acquire()
+        await limiter.acquire()
+        assert clock.sleeps == []
+
+        # Empty: wait for a single token, refilled at rate/period
+        await limiter.acquire()
+        assert clock.sleeps == [0.5]
+
+        # A long idle period refills the bucket, but only up to its size
+        clock.now += 60
+        await limiter.acquire()
+        await limiter.acquire()
+        await limiter.acquire()
+        assert clock.sleeps == [0.5, 0.5]
+
+    asyncio.run(main())
+
+
+def test_pace_chat_spaces_sends_to_the_same_chat(bot, clock):
+    sent = []
+
+    async def send_message(chat_id):
+        sent.append((chat_id, clock.now))
+
+    async def main():
+        # Not started, so requests go out directly and only the per-chat pacing applies
+        outbox = bot.Outbox(bot.AsyncRateLimiter(100), workers=1, chat_interval=3.0)
+        for chat_id in ("channel", "channel", "group", "channel"):
+            await outbox.send(send_message, chat_id, pace_chat=chat_id)
+
+    asyncio.run(main())
+
+    assert sent == [("channel", 1000.0), ("channel", 1003.0), ("group", 1003.0), ("channel", 1006.0)]
+
+
+def test_replies_are_sent_before_queued_bulk_sends(bot):
+    order = []
+
+    async def main():
+        outbox = bot.Outbox(bot.AsyncRateLimiter(1000), workers=1)
+        outbox.start()
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+            order.append("first")
+
+        async def record(label):
+            order.append(label)
+            return label
+
+        # Occupy the only worker, then queue a bulk send ahead of a reply
+        first = asyncio.create_task(outbox.send(blocker))
+        for _ in range(3):
+            await asyncio.sleep(0)
+        bulk = asyncio.create_task(outbox.send(record, "bulk", priority=bot.Outbox.PRIORITY_BULK))
+        reply = asyncio.create_task(outbox.send(record, "reply"))
+        for _ in range(3):
+            await asyncio.sleep(0)
+        gate.set()
+
+        results = await asyncio.gather(first, bulk, reply)
+        await outbox.stop()
+        return results
+
+    assert asyncio.run(main()) == [None, "bulk", "reply"]
+    assert order == ["first", "reply", "bulk"]
+
+
+def test_send_returns_results_and_raises_errors_of_the_call(bot):
+    async def ok():
+        return "sent"
+
+    async def fail():
+        raise RuntimeError("flood")
+
+    async def main():
+        outbox = bot.Outbox(bot.AsyncRateLimiter(1000), workers=2)
+        outbox.start()
+        try:
+            assert await outbox.send(ok) == "sent"
+            with pytest.raises(RuntimeError, match="flood"):
+                await outbox.send(fail)
+        finally:
+            await outbox.stop()
+
+    asyncio.run(main())
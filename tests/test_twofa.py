@@ -0,0 +1,126 @@
+"""Outcomes of claiming a 2FA code for an order."""
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+class FakeCursor:
+    """Cursor that answers fetchone() from a script and records executed statements."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.executed.append((" ".join(query.split()), params))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+class FakeConn:
+    def __init__(self, results):
+        self.cur = FakeCursor(results)
+        self.commits = 0
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def claim(bot, monkeypatch):
+    """Run _db_claim_twofa_code(1) against scripted query results; returns (result, conn)."""
+    monkeypatch.setattr(bot, "get_seat_code", lambda seat_id, secret_enc: "123456")
+
+    def run(*results):
+        conn = FakeConn(results)
+
+        @contextmanager
+        def get_conn():
+            yield conn
+
+        monkeypatch.setattr(bot.db, "get_conn", get_conn)
+        return bot._db_claim_twofa_code(1), conn
+
+    return run
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _disables(conn):
+    return [params for query, params in conn.cur.executed if query.startswith("UPDATE orders SET twofa_disabled = TRUE")]
+
+
+def test_missing_order(claim):
+    assert claim(None)[0] == ("not_found", None, None)
+
+
+def test_disabled_order(claim):
+    result, conn = claim((1, _now(), True, 7, b"token"))
+
+    assert result == ("disabled", None, None)
+    assert conn.commits == 0
+
+
+def test_expired_after_two_minutes_disables_the_order(claim):
+    result, conn = claim((1, _now() - timedelta(seconds=121), False, 7, b"token"))
+
+    assert result == ("expired", None, None)
+    assert _disables(conn) == [(1,)]
+    assert conn.commits == 1
+
+
+def test_limit_after_two_codes_disables_the_order(claim):
+    result, conn = claim((2, _now(), False, 7, b"token"))
+
+    assert result == ("limit", None, None)
+    assert _disables(conn) == [(1,)]
+
+
+def test_order_without_seat(claim):
+    assert claim((0, None, False, None, None))[0] == ("no_seat", None, None)
+
+
+def test_seat_without_secret(claim):
+    assert claim((0, None, False, 7, None))[0] == ("no_secret", None, None)
+
+
+def test_first_code_is_claimed(claim):
+    result, conn = claim((0, None, False, 7, b"token"), (1,))
+
+    assert result == ("ok", "123456", 1)
+    query, params = conn.cur.executed[-1]
+    assert "AND twofa_count = %(count)s" in query
+    assert params["count"] == 0 and params["new_count"] == 1
+    assert conn.commits == 1
+
+
+def test_second_code_within_the_window_is_claimed(claim):
+    result, conn = claim((1, _now() - timedelta(seconds=30), False, 7, b"token"), (1,))
+
+    assert result == ("ok", "123456", 2)
+    assert conn.cur.executed[-1][1]["new_count"] == 2
+
+
+def test_concurrent_press_loses_the_claim(claim):
+    # The compare-and-set update matched no row: another press used this attempt
+    result, conn = claim((0, None, False, 7, b"token"), None)
+
+    assert result == ("busy", None, None)
+    assert conn.commits == 1
+
+
+def test_every_refusal_has_a_message(bot):
+    assert set(bot.TWOFA_CODE_REFUSALS) == {"not_found", "disabled", "expired", "limit", "no_seat", "no_secret"}
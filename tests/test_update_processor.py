@@ -0,0 +1,43 @@
+"""Per-user ordering of concurrently processed updates."""
+import asyncio
+
+
+def _callback_update(bot, update_id, user_id):
+    from telegram import CallbackQuery, User
+    query = CallbackQuery(str(update_id), User(user_id, "user", False), "chat-instance", data="noop")
+    return bot.Update(update_id, callback_query=query)
+
+
+def _run(bot, updates):
+    """Process (update, label) pairs together; return the order labels started and finished in."""
+    events = []
+
+    async def handle(label):
+        events.append(("start", label))
+        await asyncio.sleep(0.01)
+        events.append(("end", label))
+
+    async def main():
+        processor = bot.PerUserUpdateProcessor(16)
+        await asyncio.gather(*(processor.process_update(update, handle(label)) for update, label in updates))
+
+    asyncio.run(main())
+    return events
+
+
+def test_updates_of_one_user_run_one_at_a_time(bot):
+    events = _run(bot, [(_callback_update(bot, 1, 10), "a"), (_callback_update(bot, 2, 10), "b")])
+
+    assert events == [("start", "a"), ("end", "a"), ("start", "b"), ("end", "b")]
+
+
+def test_updates_of_different_users_run_concurrently(bot):
+    events = _run(bot, [(_callback_update(bot, 1, 10), "a"), (_callback_update(bot, 2, 20), "b")])
+
+    assert events[:2] == [("start", "a"), ("start", "b")]
+
+
+def test_updates_without_a_user_are_not_serialized(bot):
+    events = _run(bot, [(object(), "a"), (object(), "b")])
+
+    assert events[:2] == [("start", "a"), ("start", "b")]
@@ -0,0 +1,20 @@
+"""Layout of the UTM stats table."""
+
+
+def test_columns_fit_the_widest_cell_and_totals_are_set_apart(bot):
+    table = bot.format_utm_table([
+        ("instagram", "12", "3", "450,000"),
+        ("x", "5", "0", "0"),
+        ("Total", "17", "3", "450,000"),
+    ])
+
+    assert table.splitlines() == [
+        "+-----------+--------+------+------------+",
+        "| Keyword   | Starts | Buys | Amount (T) |",
+        "+===========+========+======+============+",
+        "| instagram |     12 |    3 |    450,000 |",
+        "| x         |      5 |    0 |          0 |",
+        "+-----------+--------+------+------------+",
+        "| Total     |     17 |    3 |    450,000 |",
+        "+-----------+--------+------+------------+",
+    ]
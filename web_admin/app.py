@@ -117,7 +117,7 @@ def dashboard():
                 stats['active_seats'] = cur.fetchone()['count']
                 
                 # Available slots
-                cur.execute("SELECT SUM(max_slots - sold) as available FROM seats WHERE status = 'active'")
+                cur.execute("SELECT SUM(free_slots) as available FROM seats WHERE status = 'active'")
                 result = cur.fetchone()
                 stats['available_slots'] = result['available'] or 0
                 